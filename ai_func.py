@@ -1,38 +1,26 @@
 from dotenv import load_dotenv
-import google.generativeai as genai
-from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain.prompts import ChatPromptTemplate
 from langchain_community.utilities import SQLDatabase
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough
-from langchain_core.messages import AIMessage, HumanMessage
-import streamlit as st
 import os
-import sqlite3
-import datetime
-import pandas as pd
+import re
+import threading
+from collections import OrderedDict
 
-from os import path
-from pathlib import Path
-
-import gtfs_kit as gk
-
-from db_builder import create_db
+from sql_guard import GuardrailError, QueryGuard
 
 
 load_dotenv()
 
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+# nyc_gtfs.db, or the read-only copy from `db_builder.py --immutable-copy` with CHAT_DB_IMMUTABLE=1
+DB_PATH = os.getenv("CHAT_DB_PATH", "nyc_gtfs.db")
+DB_IMMUTABLE = os.getenv("CHAT_DB_IMMUTABLE") == "1"
 
-# create_db()
-
-def init_database() -> SQLDatabase:
-    db = SQLDatabase.from_uri(database_uri="sqlite:///nyc_gtfs.db")
-    # print(db.get_table_info())
-    return db
+# Answers kept for repeated questions, and how many earlier turns of the history are part of the cache key
+ANSWER_CACHE_SIZE = int(os.getenv("CHAT_ANSWER_CACHE_SIZE", "256"))
+HISTORY_TURNS = 4
 
-def get_sql_chain(db, max_retries=3):
-    template = """
+SQL_TEMPLATE = """
     You are a sophisticated AI agent designed to interact with a SQL database. 
     Your goal is to accurately retrieve information by crafting SQL queries based on user questions 
     Your task is to generate SQL queries based on the table schema provided and the conversation history.
@@ -56,11 +44,12 @@ def get_sql_chain(db, max_retries=3):
     User Question: what are the different routes from stop College Places to Skytop office?
     SQL Query: 
     SELECT DISTINCT T1.route_short_name 
-    FROM RouteStats AS T1 JOIN StopTimes AS T2 
-    ON T1.route_id = T2.trip_id JOIN Stops AS T3 ON T2.stop_id = T3.stop_id 
+    FROM Routes AS T1 JOIN Trips AS T4 ON T1.route_id = T4.route_id 
+    JOIN StopTimes AS T2 ON T4.trip_id = T2.trip_id JOIN Stops AS T3 ON T2.stop_id = T3.stop_id 
     WHERE T3.stop_name = 'College Places' 
-    INTERSECT SELECT DISTINCT T1.route_short_name FROM RouteStats AS T1 
-    JOIN StopTimes AS T2 ON T1.route_id = T2.trip_id JOIN Stops AS T3 ON T2.stop_id = T3.stop_id 
+    INTERSECT SELECT DISTINCT T1.route_short_name FROM Routes AS T1 
+    JOIN Trips AS T4 ON T1.route_id = T4.route_id JOIN StopTimes AS T2 ON T4.trip_id = T2.trip_id 
+    JOIN Stops AS T3 ON T2.stop_id = T3.stop_id 
     WHERE T3.stop_name = 'Skytop Office';
 
     Your Turn:
@@ -69,28 +58,7 @@ def get_sql_chain(db, max_retries=3):
     SQL Query: 
     """
 
-    prompt = ChatPromptTemplate.from_template(template=template)
-
-    llm = ChatGoogleGenerativeAI(
-        model="gemini-1.5-flash",
-        temperature=0,
-    )
-
-    def get_db_schema(_):
-        return db.get_table_info()
-
-    return (
-        RunnablePassthrough.assign(schema=get_db_schema)
-        | prompt
-        | llm
-        | StrOutputParser()
-    )
-
-
-def get_sql_response(user_query: str, db: SQLDatabase, chat_history: list, max_retries=3):
-    sql_chain = get_sql_chain(db, max_retries=max_retries)
-
-    template = """
+ANSWER_TEMPLATE = """
     You are a sophisticated AI agent designed to interact with a SQL database.
     Your primary goal is to accurately retrieve information by crafting SQL queries based on user questions. 
     Additionally, you should provide a detailed natural human like explanation of the results retrieved from the database.
@@ -106,39 +74,149 @@ def get_sql_response(user_query: str, db: SQLDatabase, chat_history: list, max_r
     SQL Response: {response}
     """
 
-    prompt = ChatPromptTemplate.from_template(template=template)
 
-    llm = ChatGoogleGenerativeAI(
+def init_database() -> SQLDatabase:
+    if DB_IMMUTABLE:
+        db = SQLDatabase.from_uri(database_uri=f"sqlite:///file:{DB_PATH}?immutable=1&uri=true")
+    else:
+        db = SQLDatabase.from_uri(database_uri=f"sqlite:///{DB_PATH}")
+    # print(db.get_table_info())
+    return db
+
+def get_llm():
+    import google.generativeai as genai
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+    return ChatGoogleGenerativeAI(
         model="gemini-1.5-flash",
         temperature=0,
     )
 
-    def run_query(query):
-        if "`" in query:
-            query = query.replace("`", "")
-            if "sql" in query:
-                query = query.replace("sql", "")
-        query = query.strip()
-        return db.run(query)
-
-    chain = (
-        RunnablePassthrough.assign(query=sql_chain).assign(
-            schema=lambda _: db.get_table_info(),
-            response=lambda variables: run_query(variables["query"]),
-        )
-        | prompt
-        | llm
-        | StrOutputParser()
-    )
+def db_version(db_path=DB_PATH):
+    """Changes whenever the database file is replaced or rewritten (inode, mtime and size)."""
+    try:
+        stat = os.stat(db_path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+def normalize_question(text):
+    return re.sub(r"\s+", " ", str(text)).strip().rstrip("?.!").lower()
 
-    retires = 0
-    while retires < max_retries:
-        try:
-            return chain.invoke({
-                "question": user_query,
-                "chat_history": chat_history
-            })
-        except Exception as e:
-            retires += 1
-            if retires >= max_retries:
-                raise Exception(f"Failed to generate a correct SQL query after {max_retries} attempts. Last error: {e}")
+def clean_query(query):
+    if "`" in query:
+        query = query.replace("`", "")
+        if "sql" in query:
+            query = query.replace("sql", "")
+    return query.strip()
+
+
+class SQLAssistant:
+    """
+    Text-to-SQL over nyc_gtfs.db: the SQL and answer chains are built once, the schema
+    text (db.get_table_info(), which samples rows of every table) is read once per
+    database file version, and answers are kept in an LRU cache keyed by the database
+    version and the normalized question and recent history.
+    """
+
+    def __init__(self, db, llm=None, db_path=DB_PATH, cache_size=ANSWER_CACHE_SIZE, immutable=DB_IMMUTABLE):
+        self.db = db
+        self.db_path = db_path
+        self.llm = llm if llm is not None else get_llm()
+        self.cache_size = cache_size
+
+        self.sql_chain = ChatPromptTemplate.from_template(template=SQL_TEMPLATE) | self.llm | StrOutputParser()
+        self.answer_chain = ChatPromptTemplate.from_template(template=ANSWER_TEMPLATE) | self.llm | StrOutputParser()
+
+        # EXPLAIN QUERY PLAN checks, LIMIT and time budget for the generated SQL
+        self.guard = QueryGuard(db_path, immutable=immutable)
+
+        self._schema = (None, None)  # (db version, table info)
+        self._answers = OrderedDict()  # key -> {"query", "response", "answer"}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def schema(self):
+        """
+        db.get_table_info(), read again only when the database file changed. The
+        engine's pooled connections still read the file they were opened on, so
+        they are closed then and the tables reflected again.
+        """
+        version = db_version(self.db_path)
+        if self._schema[0] != version or self._schema[1] is None:
+            if self._schema[0] is not None:
+                self.db._engine.dispose()
+                self.db = SQLDatabase(self.db._engine)
+            self._schema = (version, self.db.get_table_info())
+        return self._schema[1]
+
+    def run_query(self, query):
+        rows = self.guard.run(clean_query(query))["rows"]
+        # Formatted like SQLDatabase.run
+        return str(rows) if rows else ""
+
+    def cache_key(self, question, chat_history):
+        recent = tuple(normalize_question(value) for turn in chat_history[-HISTORY_TURNS:] for value in turn.values())
+        return (db_version(self.db_path), normalize_question(question), recent)
+
+    def ask(self, question, chat_history=(), max_retries=3):
+        """{"query", "response", "answer"} for a question, from the cache when it was asked before in the same context."""
+        chat_history = list(chat_history)
+        # The history the frontend sends ends with the question itself
+        if chat_history and chat_history[-1] == {"User": question}:
+            earlier = chat_history[:-1]
+        else:
+            earlier = chat_history
+        key = self.cache_key(question, earlier)
+
+        with self._lock:
+            if key in self._answers:
+                self._answers.move_to_end(key)
+                self.hits += 1
+                return self._answers[key]
+            self.misses += 1
+
+        schema = self.schema()
+        variables = {"question": question, "chat_history": chat_history, "schema": schema}
+
+        retires = 0
+        while True:
+            try:
+                query = self.sql_chain.invoke(variables)
+                response = self.run_query(query)
+                answer = self.answer_chain.invoke({**variables, "query": query, "response": response})
+                break
+            except Exception as e:
+                retires += 1
+                if retires >= max_retries:
+                    raise Exception(f"Failed to generate a correct SQL query after {max_retries} attempts. Last error: {e}")
+                if isinstance(e, GuardrailError):
+                    # Ask for a different query rather than the same one again
+                    variables["chat_history"] = chat_history + [{"System": f"The query {clean_query(query)} was not run: {e}"}]
+
+        result = {"query": clean_query(query), "response": response, "answer": answer}
+        with self._lock:
+            self._answers[key] = result
+            while len(self._answers) > self.cache_size:
+                self._answers.popitem(last=False)
+        return result
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._answers), "max_size": self.cache_size}
+
+
+_assistants = {}
+_assistants_lock = threading.Lock()
+
+def get_assistant(db: SQLDatabase) -> SQLAssistant:
+    """The SQLAssistant of db, created on first use."""
+    with _assistants_lock:
+        if id(db) not in _assistants:
+            _assistants[id(db)] = SQLAssistant(db)
+        return _assistants[id(db)]
+
+def get_sql_response(user_query: str, db: SQLDatabase, chat_history: list, max_retries=3):
+    return get_assistant(db).ask(user_query, chat_history, max_retries=max_retries)["answer"]
@@ -1,62 +1,45 @@
-from flask import Flask, request, jsonify
-from flask_restful import Api, Resource
-from flask_cors import CORS
-
-import os
-import io
-import datetime
-import json
-from os import path
-from pathlib import Path
-
-import numpy as np
-import pandas as pd
-
-# import modin.pandas as pd
-
-import matplotlib.pyplot as plt
-import seaborn as sns
-import plotly.express as px
-import plotly.graph_objects as go
-import plotly.io as pio
-from plotly.subplots import make_subplots
-
-import folium
-from shapely.geometry import LineString, Point
-from folium.plugins import MarkerCluster, HeatMap
-from folium import Marker, Icon, Circle, CircleMarker, GeoJson, PolyLine, Map
-from geopy.distance import geodesic
-
-from sklearnex import patch_sklearn
-patch_sklearn()
-
-from sklearn import config_context
-from sklearn.preprocessing import StandardScaler
-from sklearn.preprocessing import OneHotEncoder
-import category_encoders as ce
-from sklearn.model_selection import train_test_split
-from sklearn.ensemble import RandomForestRegressor, GradientBoostingRegressor
-# from sklearnex.ensemble import RandomForestRegressor
-from xgboost import  XGBRegressor
-from sklearn.cluster import KMeans
-from sklearn.metrics import mean_absolute_error, mean_squared_error
-
-import daal4py as d4p
-
-
-from ai_func import init_database, get_sql_chain, get_sql_response
-
-import joblib
-
-import gtfs_kit as gk
-from dotenv import load_dotenv
+from startup import StartupTimer, BackgroundLoader
+
+startup_timer = StartupTimer()
+
+with startup_timer.phase('imports'):
+    from flask import Flask, request, jsonify
+    from flask_cors import CORS
+
+    import os
+    import re
+    import sys
+    import subprocess
+    import threading
+    from pathlib import Path
+
+    import numpy as np
+    import pandas as pd
+
+    from stats_cache import StatsCache
+    from feed_index import FeedIndex
+    from raptor import RaptorRouter, MAX_TRANSFERS
+    from spatial_index import SpatialIndex
+    from name_search import NameIndex
+    from segment_speeds import SegmentSpeeds
+    from shape_index import ShapeIndex, SIMPLIFY_TOLERANCES, parse_tolerance, encode_polyline
+    from table_stream import parse_fields, parse_page, iter_records, json_array_stream, ndjson_stream
+    from snapshot_store import SnapshotStore
+    from feed_compact import compact_feed, expand_categoricals
+    from feed_snapshot import expand_times
+    from model_registry import ModelRegistry, current_artifacts
+    from demand_training import TrainingJobs
+    from demand_forecast import DEMAND_INPUT_FIELDS, ForecastStore, encode_features, model_version
+    from analytics import PAYLOAD_BUILDERS
+    import gtfs_time
+
+# gtfs_kit (geopandas), the ML stack and the LLM chain are imported where they are
+# first needed so the server can bind its port immediately
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-Next-Cursor', 'X-Total-Count'])
 
 path = Path('data/gtfs-nyc-2023.zip')
-feed = gk.read_feed(path, dist_units='km')
-# print(feed.validate())
 
 model = None
 
@@ -74,30 +57,175 @@ def clean_feed_data(feed):
 
   return feed
 
-feed = clean_feed_data(feed=feed)
-# print(feed.validate())
+# Stop columns returned by the nearby / bbox endpoints
+STOP_FIELDS = ['stop_id', 'stop_code', 'stop_name', 'stop_lat', 'stop_lon', 'wheelchair_boarding']
+
+# Set by load_server_state once the feed is loaded; requests other than the health
+# checks get a 503 until then
+feed = None
+feed_key = None  # snapshot key of the feed (zip and cleaning), see snapshot_store
+feed_index = None
+shape_index = None
+stop_locator = None
+stop_records = None
+stop_search = None
+route_search = None
+route_records = None
+raptor_router = None
+segment_table = None
+stats_cache = None
+
+# Per-date payloads precomputed offline by `python db_builder.py --materialize`
+snapshot_store = SnapshotStore()
+
+# Demand model and encoders of the live version, reloaded when a training job swaps it
+model_registry = ModelRegistry()
+
+# Route x date x time_of_day demand grid scored by `python db_builder.py --forecast`
+forecast_store = ForecastStore()
+
+def load_server_state(timer):
+    global feed, feed_key, feed_index, shape_index, stop_locator, stop_records, stop_search, route_search, route_records, raptor_router, segment_table, stats_cache
+
+    with timer.phase('import gtfs_kit'):
+        import gtfs_kit
+        from feed_snapshot import load_feed, zip_digest
+
+    # Memory-mapped snapshot of the cleaned feed, written on the first start after the zip changes
+    with timer.phase('load_feed'):
+        loaded_feed = load_feed(path, clean=clean_feed_data)
+        loaded_key = zip_digest(path, clean_feed_data)
+
+    # Optional categorical / int32 columns for the big tables, see feed_compact
+    if os.getenv('FEED_COMPACT_DTYPES') == '1':
+        with timer.phase('compact_feed'):
+            compact_feed(loaded_feed)
+
+    # Id -> rows lookups for the by-ID endpoints (also sorts stop_times by trip/sequence)
+    with timer.phase('feed_index'):
+        loaded_index = FeedIndex(loaded_feed)
+
+    # Per-shape point arrays with Douglas-Peucker ranks for the map geometries
+    with timer.phase('shape_index'):
+        loaded_shapes = ShapeIndex(loaded_feed)
+
+    # Grid over the stop coordinates for the nearby / bbox endpoints and the footpaths,
+    # and the stops as ready-to-serialize records
+    with timer.phase('spatial_index'):
+        loaded_locator = SpatialIndex(loaded_feed.stops['stop_lat'].to_numpy(), loaded_feed.stops['stop_lon'].to_numpy())
+        stops = loaded_feed.stops[[column for column in STOP_FIELDS if column in loaded_feed.stops]]
+        loaded_records = stops.astype(object).where(stops.notna(), None).to_dict(orient='records')
+
+    # Trigram / prefix indexes over the stop names and the route short and long names
+    with timer.phase('name_search'):
+        loaded_stop_search = NameIndex(loaded_feed.stops['stop_name'], loaded_feed.stops['stop_id'])
+        routes = expand_categoricals(loaded_feed.routes)
+        loaded_route_search = NameIndex(pd.concat([routes['route_short_name'], routes['route_long_name']]),
+                                        pd.concat([routes['route_id'], routes['route_id']]))
+        loaded_route_records = routes.drop_duplicates('route_id').set_index('route_id', drop=False).fillna('NA').to_dict(orient='index')
+
+    # RAPTOR timetable (stop patterns + footpaths) for the journey planner
+    with timer.phase('raptor_router'):
+        loaded_router = RaptorRouter(loaded_index, spatial_index=loaded_locator)
+
+    # Stop-to-stop segments with their scheduled traversals grouped by route, service and hour
+    with timer.phase('segment_speeds'):
+        loaded_segments = SegmentSpeeds(loaded_index)
+
+    # trip_stats once per feed load, route_stats memoized per date
+    with timer.phase('trip_stats'):
+        loaded_stats = StatsCache(loaded_feed)
+        loaded_stats.trip_stats()
+
+    feed, feed_key, feed_index, shape_index, raptor_router, stats_cache = loaded_feed, loaded_key, loaded_index, loaded_shapes, loaded_router, loaded_stats
+    stop_locator, stop_records = loaded_locator, loaded_records
+    stop_search, route_search, route_records = loaded_stop_search, loaded_route_search, loaded_route_records
+    segment_table = loaded_segments
+    print(timer.format_report(), flush=True)
+
+    # The chat chains need the LLM key and the text-to-SQL database (db_builder.py)
+    if os.getenv('GOOGLE_API_KEY') and os.path.exists(os.getenv('CHAT_DB_PATH', 'nyc_gtfs.db')):
+        threading.Thread(target=warm_chat, name='warm-chat', daemon=True).start()
+
+feed_loader = BackgroundLoader(load_server_state, timer=startup_timer)
+
+# Under `python analysis_apis.py` the werkzeug reloader re-runs this module in a child
+# process that serves the requests; only load the feed there. Spawned worker processes
+# (training jobs) import the main module as __mp_main__ and must not load it either.
+if __name__ == 'analysis_apis' or (__name__ == '__main__' and os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+    feed_loader.start()
+
+HEALTH_ENDPOINTS = {'home', 'healthz', 'readyz', 'static'}
+
+@app.before_request
+def require_feed():
+    if request.method == 'OPTIONS' or request.endpoint in HEALTH_ENDPOINTS:
+        return None
+    if not feed_loader.ready.is_set():
+        state = feed_loader.status()['status']
+        response = jsonify({'error': f'The GTFS feed is not available yet ({state}). Retry shortly.'})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    return None
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """
+    Liveness: the process is up and serving requests.
+    """
+    return jsonify({'status': 'ok'}), 200
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """
+    Readiness: 200 once the feed and its indexes are loaded, 503 while loading or if
+    loading failed. The body carries the startup timing breakdown.
+    """
+    status = feed_loader.status()
+    return jsonify(status), 200 if status['status'] == 'ready' else 503
 
 @app.route('/', methods=['GET'])
 def home():
     return jsonify({"message": "Welcome to the GTFS API of New York City!"})
 
+def table_response(df, fill_na=None):
+    """
+    Stream a feed table as a JSON array, honouring the common table query parameters:
+      ?fields=a,b        only return these columns
+      ?limit=N&cursor=C  return N rows starting at cursor C; the cursor of the next
+                         page is sent in the X-Next-Cursor header
+      ?format=ndjson     newline delimited JSON instead of a JSON array
+    """
+    try:
+        fields = parse_fields(request.args.get('fields'), df.columns)
+        start, stop, next_cursor = parse_page(request.args.get('cursor'), request.args.get('limit'), len(df))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    chunks = iter_records(df, fields, start, stop, fill_na=fill_na)
+    if request.args.get('format') == 'ndjson':
+        response = app.response_class(ndjson_stream(chunks), mimetype='application/x-ndjson')
+    else:
+        response = app.response_class(json_array_stream(chunks), mimetype='application/json')
+
+    response.headers['X-Total-Count'] = str(len(df))
+    if next_cursor is not None:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response, 200
+
 @app.route('/routes', methods=['GET'])
 def get_routes():
     """
     API to get the list of routes from the GTFS feed.
     """
-    routes_df = feed.routes.fillna('NA')  # Replace NaN with a placeholder like 'NA'
-    routes_json = routes_df.to_dict(orient='records')
-    
-    # print("Routes JSON (after replacing NaN):", routes_json)  # Log modified response
-    return jsonify(routes_json), 200
+    return table_response(feed.routes, fill_na='NA')  # Replace NaN with a placeholder like 'NA'
 
 @app.route('/route/<route_id>', methods=['GET'])
 def get_route_by_id(route_id):
     """
     API to get the details of a specific route by its ID.
     """
-    route = feed.routes[feed.routes['route_id'] == route_id]
+    route = feed_index.route(route_id)
 
     if not route.empty:
         route = route.fillna('NA')  # Replace NaN with 'NA'
@@ -111,41 +239,105 @@ def get_stops():
     """
     API to get the list of all stops from the GTFS feed, replacing NaN values.
     """
-    stops_df = feed.stops.fillna("NA")  # Replace NaN with "NA" or choose None to send null
-    stops_json = stops_df.to_dict(orient='records')
-    return jsonify(stops_json), 200
+    return table_response(feed.stops, fill_na="NA")  # Replace NaN with "NA" or choose None to send null
 
 @app.route('/stop/<stop_id>', methods=['GET'])
 def get_stop_by_id(stop_id):
     """
     API to get the details of a specific stop by its ID.
     """
-    stop = feed.stops[feed.stops['stop_id'] == stop_id]
+    stop = feed_index.stop(stop_id)
     if not stop.empty:
         stop_json = stop.to_dict(orient='records')
         return jsonify(stop_json), 200
     else:
         return jsonify({'error': 'Stop not found'}), 404
 
+def parse_float_args(*names):
+    """Required finite float query parameters, in order (KeyError / ValueError otherwise)."""
+    values = []
+    for name in names:
+        value = float(request.args[name])
+        if not np.isfinite(value):
+            raise ValueError(name)
+        values.append(value)
+    return values
+
+def parse_limit(default=None, maximum=None):
+    """The positive integer ?limit= parameter, capped at maximum."""
+    limit = request.args.get('limit')
+    if limit is None:
+        return default
+    limit = int(limit)
+    if limit < 1:
+        raise ValueError('limit')
+    return min(limit, maximum) if maximum else limit
+
+@app.route('/api/stops/nearby', methods=['GET'])
+def get_nearby_stops():
+    """
+    API to get the stops around a point, nearest first, with their distance in meters.
+      lat, lon: the point
+      radius: meters, default 500 (at most 10000)
+      limit: default 20 (at most 1000)
+    """
+    try:
+        lat, lon = parse_float_args('lat', 'lon')
+        radius = min(float(request.args.get('radius', 500)), 10000.0)
+        limit = parse_limit(default=20, maximum=1000)
+        if not radius >= 0:
+            raise ValueError('radius')
+    except (KeyError, ValueError):
+        return jsonify({'error': 'lat and lon are required; lat, lon, radius (meters) and limit must be numbers'}), 400
+
+    positions, meters = stop_locator.within(lat, lon, radius, limit=limit)
+    stops = [dict(stop_records[position], distance_m=round(distance, 1))
+             for position, distance in zip(positions.tolist(), meters.tolist())]
+    return jsonify({
+        'lat': lat,
+        'lon': lon,
+        'radius': radius,
+        'total_results': len(stops),
+        'stops': stops
+    }), 200
+
+@app.route('/api/stops/bbox', methods=['GET'])
+def get_stops_in_bbox():
+    """
+    API to get the stops inside a bounding box (e.g. the visible map area).
+      min_lat, min_lon, max_lat, max_lon: the box
+      limit: optional maximum number of stops
+    """
+    try:
+        min_lat, min_lon, max_lat, max_lon = parse_float_args('min_lat', 'min_lon', 'max_lat', 'max_lon')
+        limit = parse_limit()
+    except (KeyError, ValueError):
+        return jsonify({'error': 'min_lat, min_lon, max_lat and max_lon are required numbers; limit must be a positive integer'}), 400
+
+    positions = stop_locator.in_bbox(min_lat, min_lon, max_lat, max_lon)
+    total = len(positions)
+    stops = [stop_records[position] for position in positions[:limit].tolist()]
+    return jsonify({
+        'bbox': [min_lat, min_lon, max_lat, max_lon],
+        'total_results': total,
+        'stops': stops
+    }), 200
+
 @app.route('/trips', methods=['GET'])
 def get_trips():
     """
     API to get the list of all trips from the GTFS feed.
     """
-    trips_df = feed.trips.fillna('NA')  # Replace NaN with a placeholder like 'NA'
-    trips_json = trips_df.to_dict(orient='records')
-    
-    # print("Trips JSON (after replacing NaN):", trips_json)  # Optional: Log modified response
-    return jsonify(trips_json), 200
+    return table_response(feed.trips, fill_na='NA')  # Replace NaN with a placeholder like 'NA'
   
 @app.route('/trip/<trip_id>', methods=['GET'])
 def get_trip_by_id(trip_id):
     """
     API to get the details of a specific trip by its ID.
     """
-    trip = feed.trips[feed.trips['trip_id'] == trip_id]
+    trip = feed_index.trip(trip_id)
     if not trip.empty:
-        trip_json = trip.fillna('NA').to_dict(orient='records')  # Replace NaN with 'NA'
+        trip_json = expand_categoricals(trip).fillna('NA').to_dict(orient='records')  # Replace NaN with 'NA'
         return jsonify(trip_json), 200
     else:
         return jsonify({'error': 'Trip not found'}), 404
@@ -155,27 +347,88 @@ def get_stop_times_by_trip(trip_id):
     """
     API to get the stop times for a specific trip ID.
     """
-    stop_times = feed.stop_times[feed.stop_times['trip_id'] == trip_id]
+    stop_times = feed_index.stop_times_for_trip(trip_id)
     if not stop_times.empty:
-        stop_times_json = stop_times.to_dict(orient='records')
+        stop_times_json = expand_times(stop_times).to_dict(orient='records')
         return jsonify(stop_times_json), 200
     else:
         return jsonify({'error': 'No stop times found for this trip'}), 404
 
+# Characters that make a /routes/search name a regular expression rather than plain text
+REGEX_SPECIAL = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
 @app.route('/routes/search/<route_name>', methods=['GET'])
 def search_routes_by_name(route_name):
     """
-    API to search for routes by their short name or long name.
+    API to search for routes by their short name or long name. Ranked prefix and
+    fuzzy matches are served by /api/autocomplete/routes.
     """
-    routes = feed.routes[(feed.routes['route_short_name'].str.contains(route_name, case=False, na=False) | 
-                          feed.routes['route_long_name'].str.contains(route_name, case=False, na=False))]
-
-    if not routes.empty:
-        routes_json = routes.to_dict(orient='records')
+    try:
+        pattern = re.compile(route_name, re.IGNORECASE)
+    except re.error:
+        return jsonify({'error': 'Invalid route name pattern'}), 400
+
+    # The trigram index narrows plain names down to candidate routes; patterns are matched against every route
+    route_ids = route_search.substring_candidates(route_name) if not REGEX_SPECIAL.search(route_name) else feed_index.route_rows
+    rows = sorted({row for route_id in route_ids for row in feed_index.route_rows.get(route_id, [])})
+    names = feed.routes[['route_short_name', 'route_long_name']].to_numpy()
+    rows = [row for row in rows if any(isinstance(name, str) and pattern.search(name) for name in names[row])]
+
+    if rows:
+        routes_json = expand_categoricals(feed.routes.iloc[rows]).to_dict(orient='records')
         return jsonify(routes_json), 200
     else:
         return jsonify({'error': 'No routes found matching the short name'}), 404
 
+def ranked_routes(query, limit):
+    """route_ids matching query by either name, best first, each once."""
+    ranked = {}
+    for match in route_search.search(query, limit=2 * limit):
+        for route_id in match['keys']:
+            ranked.setdefault(route_id, match)
+    return list(ranked)[:limit]
+
+def parse_search_args(default_limit=10, max_limit=50):
+    """(?q=, ?limit=) of the autocomplete endpoints."""
+    query = request.args.get('q', '')
+    limit = request.args.get('limit', default_limit)
+    limit = min(int(limit), max_limit)
+    if limit < 1:
+        raise ValueError('limit')
+    return query, limit
+
+@app.route('/api/autocomplete/stops', methods=['GET'])
+def autocomplete_stops():
+    """
+    API to suggest stops as a name is typed: ?q=<partial name>&limit=10 (at most 50).
+    Every stop sharing a suggested name is returned under it.
+    """
+    try:
+        query, limit = parse_search_args()
+    except ValueError:
+        return jsonify({'error': 'limit must be a positive integer'}), 400
+
+    suggestions = [{
+        'stop_name': match['name'],
+        'score': match['score'],
+        'stop_ids': match['keys'],
+        'stops': [stop_records[position] for stop_id in match['keys'] for position in feed_index.stop_rows.get(stop_id, [])],
+    } for match in stop_search.search(query, limit=limit)]
+    return jsonify({'query': query, 'total_results': len(suggestions), 'suggestions': suggestions}), 200
+
+@app.route('/api/autocomplete/routes', methods=['GET'])
+def autocomplete_routes():
+    """
+    API to suggest routes by short or long name as it is typed: ?q=<partial name>&limit=10 (at most 50).
+    """
+    try:
+        query, limit = parse_search_args()
+    except ValueError:
+        return jsonify({'error': 'limit must be a positive integer'}), 400
+
+    suggestions = [route_records[route_id] for route_id in ranked_routes(query, limit)]
+    return jsonify({'query': query, 'total_results': len(suggestions), 'suggestions': suggestions}), 200
+
 @app.route('/routes_with_trips', methods=['GET'])
 def get_routes_with_trips():
     # Get the route_id from the query parameters
@@ -185,7 +438,7 @@ def get_routes_with_trips():
         return jsonify({"error": "route_id is required"}), 400
 
     # Filter trips based on the provided route_id
-    trips_filtered = feed.trips[feed.trips['route_id'] == route_id]
+    trips_filtered = feed_index.trips_for_route(route_id)
 
     if trips_filtered.empty:
         return jsonify({"error": "No trips found for the given route_id"}), 404
@@ -200,8 +453,18 @@ def get_calendar_dates():
     """
     API to get the list of calendar dates from the GTFS feed.
     """
-    calendar_dates = feed.calendar.to_dict(orient='records')
-    return jsonify(calendar_dates), 200
+    return table_response(feed.calendar)
+
+def analytics_response(endpoint, date):
+    """
+    Serve a per-date analytics payload, from the materialized snapshot store when the
+    date has been precomputed by db_builder from the loaded feed, otherwise computed live.
+    """
+    payload = snapshot_store.get(endpoint, date, feed_key)
+    if payload is not None:
+        return app.response_class(payload, mimetype='application/json'), 200
+
+    return jsonify(PAYLOAD_BUILDERS[endpoint](feed, stats_cache, date)), 200
 
 @app.route('/api/route_stats', methods=['GET'])
 def get_route_stats():
@@ -213,51 +476,8 @@ def get_route_stats():
         pd.to_datetime(date, format="%Y%m%d")  # Validate date format
     except ValueError as e:
         return jsonify({'error': f'Invalid date format. Use YYYYMMDD., {e}'}), 400
-    
-    # date = "".join(date.split("-"))
-    
-    # Compute trip_stats
-    trip_stats = feed.compute_trip_stats()
-
-    # Compute route_stats for the specific date
-    route_stats = feed.compute_route_stats(trip_stats, dates=[date])
-    cols_round_off = ['mean_headway', 'mean_trip_distance', 'mean_trip_duration', 'service_distance', 'service_duration', 'service_speed']
-    route_stats[cols_round_off] = route_stats[cols_round_off].round(2)
-    route_stats['mean_trip_duration'] = route_stats['mean_trip_duration'] * 60
-    route_stats['service_duration'] = route_stats['service_duration'] * 60
-    route_stats[['mean_headway', 'min_headway', 'max_headway']].fillna(0, inplace=True)
-    route_stats.fillna('NA',  inplace=True)
-    route_stats = route_stats.merge(feed.routes[['route_id', 'route_long_name', 'route_color']], on='route_id', how='left')
-
-    # Convert route_stats DataFrame to JSON and return it
-    route_stats_json = route_stats.to_dict(orient='records')
-    return jsonify({'route_stats': route_stats_json})
-
-def classify_time_of_day(start_time):
-    """Classify time of day based on the start_time (HH:MM:SS)."""
-    hour = int(start_time.split(":")[0])
-    
-    if 4 <= hour < 8:
-        return 'Morning'
-    elif 8 <= hour < 12:
-        return "Peak Morning"
-    elif 12 <= hour < 16:
-        return 'Afternoon'
-    elif 16 <= hour < 20:
-        return 'Peak Evening'
-    elif 20 <=  hour < 24:
-        return 'Night'
-    else:
-        return 'Mid Night'
-
-def classify_time_period(start_time):
-    """Classify time period based on the start_time (HH:MM:SS)."""
-    hour = int(start_time.split(":")[0])
 
-    for i in range(0, 23, 2):
-        if i <= hour < i + 2:
-            return f'{i}:00-{i+1}:59'
-  
+    return analytics_response('route_stats', date)
 
 @app.route('/api/trip_stats', methods=['GET'])
 def get_trip_stats():
@@ -269,44 +489,8 @@ def get_trip_stats():
         pd.to_datetime(date, format="%Y%m%d")  # Validate date format
     except ValueError:
         return jsonify({'error': 'Invalid date format. Use YYYYMMDD.'}), 400
-    
-    # Compute trip_stats
-    trip_stats = feed.compute_trip_stats()
-
-    # Add time of day classification
-    trip_stats['time_of_day'] = trip_stats['start_time'].apply(classify_time_of_day)
-    trip_stats['time_period'] = trip_stats['start_time'].apply(classify_time_period)
-
-    # Now we can analyze trip duration and speed by time of day
-    trip_duration_analysis = trip_stats.groupby('time_of_day').agg({
-        'trip_id': ['count'],
-        'duration': ['mean', 'min', 'max'],  # Analyze duration (in minutes)
-        'speed': ['mean', 'min', 'max']     # Analyze speed (km/h)
-    }).reset_index()
 
-    trip_period_analysis = trip_stats.groupby("time_period").agg({
-        'trip_id': ['count'],
-        'duration': ['mean', 'min', 'max'],  # Analyze duration (in minutes)
-        'speed': ['mean', 'min', 'max'] 
-    }).reset_index()
-
-    trip_duration_cols = ['mean_duration', 'min_duration', 'max_duration', 'mean_speed', 'min_speed', 'max_speed']
-    trip_period_cols = ['mean_duration', 'min_duration', 'max_duration', 'mean_speed', 'min_speed', 'max_speed']
-
-    
-    # Convert analysis DataFrame to JSON
-    trip_duration_analysis.columns = ['time_of_day', 'num_trips', 'mean_duration', 'min_duration', 'max_duration',
-                                      'mean_speed', 'min_speed', 'max_speed']
-    trip_duration_analysis[trip_duration_cols] = trip_duration_analysis[trip_duration_cols].round(2)
-    trip_duration_analysis_json = trip_duration_analysis.to_dict(orient='records')
-
-    trip_period_analysis.columns = ['period_time', 'num_trips', 'mean_duration', 'min_duration', 'max_duration',
-                                      'mean_speed', 'min_speed', 'max_speed']
-    trip_period_analysis[trip_period_cols] = trip_period_analysis[trip_period_cols].round(2)
-    trip_period_analysis_json = trip_period_analysis.to_dict(orient='records')
-    
-    return jsonify({'trip_duration_analysis': trip_duration_analysis_json, 
-                    'trip_period_analysis': trip_period_analysis_json})
+    return analytics_response('trip_stats', date)
 
 
 @app.route('/api/frequent_routes', methods=['GET'])
@@ -319,21 +503,8 @@ def get_frequent_routes():
         pd.to_datetime(date, format="%Y%m%d")  # Validate date format
     except ValueError:
         return jsonify({'error': 'Invalid date format. Use YYYYMMDD.'}), 400
-    
-    # Compute trip_stats
-    trip_stats = feed.compute_trip_stats()
-
-    route_stats = feed.compute_route_stats(trip_stats, dates=[date])
-    route_stats = route_stats.merge(feed.routes[['route_id', 'route_long_name', 'route_color']])
-
-    frequent_routes = route_stats.sort_values(by=['max_headway', 'min_headway']).reset_index(drop=True)
-    most_frequent_routes =  frequent_routes.head(10)
-    least_frequent_routes =  frequent_routes.iloc[-10::-1]
 
-    most_frequent_routes_json =  most_frequent_routes.to_dict(orient='records')
-    least_frequent_routes_json =  least_frequent_routes.to_dict(orient='records')
-    return jsonify({'most_frequent_routes': most_frequent_routes_json, 
-                    'least_frequent_routes': least_frequent_routes_json}), 200
+    return analytics_response('frequent_routes', date)
 
 @app.route('/api/shortest_longest_routes', methods=['GET'])
 def get_shortest_longest_routes():
@@ -344,19 +515,8 @@ def get_shortest_longest_routes():
         pd.to_datetime(date, format="%Y%m%d")  # Validate date format
     except ValueError:
         return jsonify({'error': 'Invalid date format. Use YYYYMMDD.'}), 400
-    
-    # Compute trip_stats
-    trip_stats = feed.compute_trip_stats()
-
-    route_stats = feed.compute_route_stats(trip_stats, dates=[date])
-    route_stats['mean_trip_distance'] = route_stats['mean_trip_distance'].round(2)
-    route_stats = route_stats.merge(feed.routes[['route_id', 'route_long_name', 'route_color']],on='route_id', how='left')
 
-    shortest_routes = route_stats.sort_values(by='mean_trip_distance').head(10)
-    longest_routes = route_stats.sort_values(by='mean_trip_distance', ascending=False).head(10)
-
-    return jsonify({'shortest_routes': shortest_routes.to_dict(orient='records'), 
-                    'longest_routes': longest_routes.to_dict(orient='records')})
+    return analytics_response('shortest_longest_routes', date)
 
 @app.route('/api/slowest_fastest_routes', methods=['GET'])
 def get_slowest_fastest_routes():
@@ -366,21 +526,8 @@ def get_slowest_fastest_routes():
         pd.to_datetime(date, format="%Y%m%d")  # Validate date format
     except ValueError:
         return jsonify({'error': 'Invalid date format. Use YYYYMMDD.'}), 400
-    
-    # Compute trip_stats
-    trip_stats = feed.compute_trip_stats()
 
-    route_stats = feed.compute_route_stats(trip_stats, dates=[date])
-    route_stats['service_speed'] = route_stats['service_speed'].round(2)
-    route_stats = route_stats.merge(feed.routes[['route_id', 'route_long_name', 'route_color']])
-
-    slowest_routes = route_stats.sort_values(by='service_speed').head(10)
-    fastest_routes = route_stats.sort_values(by='service_speed', ascending=False).head(10)
-
-    return jsonify({
-        'slowest_routes': slowest_routes.to_dict(orient='records'),
-        'fastest_routes': fastest_routes.to_dict(orient='records')
-    }), 200
+    return analytics_response('slowest_fastest_routes', date)
 
 
 @app.route('/api/peak_hour_traffic',  methods=['GET'])
@@ -391,25 +538,8 @@ def get_peak_hour_traffic():
         pd.to_datetime(date, format="%Y%m%d")  # Validate date format
     except ValueError:
         return jsonify({'error': 'Invalid date format. Use YYYYMMDD.'}), 400
-    
-    trip_stats = feed.compute_trip_stats()
-
-    route_stats = feed.compute_route_stats(trip_stats, dates=[date])
-    route_stats = route_stats.merge(feed.routes[['route_id', 'route_long_name', 'route_color']],on='route_id', how='left')
-
-    trip_stats['time_of_day'] = trip_stats['start_time'].apply(classify_time_of_day)
-    trip_stats['time_period'] = trip_stats['start_time'].apply(classify_time_period)
-
-    # routes with most traffic during peak hours
-    peak_hour_trips =  trip_stats[trip_stats['time_of_day'].str.contains("peak", case=False)]
-    peak_hour_routes = peak_hour_trips.groupby('route_id').agg({
-        'trip_id': 'count',
-        'time_period': 'unique',
-    }).reset_index()
-    peak_hour_routes['time_period'] = peak_hour_routes['time_period'].apply(lambda x: list(x))
-    peak_hour_routes = peak_hour_routes.merge(route_stats)
 
-    return  jsonify({'peak_hour_routes': peak_hour_routes.to_dict(orient='records')}), 200
+    return analytics_response('peak_hour_traffic', date)
 
 
 @app.route('/api/distance_coverage_optimization', methods=['GET'])
@@ -420,19 +550,8 @@ def get_distance_coverage_optimization():
         pd.to_datetime(date, format="%Y%m%d")  # Validate date format
     except ValueError:
         return jsonify({'error': 'Invalid date format. Use YYYYMMDD.'}), 400
-    
-    trip_stats = feed.compute_trip_stats()
-
-    route_stats = feed.compute_route_stats(trip_stats, dates=[date])
-    route_stats = route_stats.merge(feed.routes[['route_id', 'route_long_name', 'route_color']])
-
-    trip_stats['time_of_day'] = trip_stats['start_time'].apply(classify_time_of_day)
-    trip_stats['time_period'] = trip_stats['start_time'].apply(classify_time_period)
 
-    inefficient_routes = route_stats[(route_stats['mean_trip_distance'] > 15) & (route_stats['num_trips'] < 10)]
-    inefficient_routes.sort_values(by='mean_trip_distance', ascending=False)
-
-    return  jsonify({'inefficient_routes': inefficient_routes.to_dict(orient='records')}), 200
+    return analytics_response('distance_coverage_optimization', date)
 
 @app.route('/api/route_efficiency',  methods=['GET'])
 def  get_route_efficiency():
@@ -442,297 +561,461 @@ def  get_route_efficiency():
         pd.to_datetime(date, format="%Y%m%d")  # Validate date format
     except ValueError:
         return jsonify({'error': 'Invalid date format. Use YYYYMMDD.'}), 400
-    
-    trip_stats = feed.compute_trip_stats()
-
-    route_stats = feed.compute_route_stats(trip_stats, dates=[date])
-    route_stats = route_stats.merge(feed.routes[['route_id', 'route_long_name', 'route_color']])
-
-    trip_stats['time_of_day'] = trip_stats['start_time'].apply(classify_time_of_day)
-    trip_stats['time_period'] = trip_stats['start_time'].apply(classify_time_period)
 
-    route_trips = trip_stats.groupby(by=['route_id']).agg(
-        avg_stops=('num_stops', 'mean'),
-        avg_trip_speed=('speed', 'mean')
-    ).reset_index()
-
-    route_stats = route_stats.merge(route_trips, on='route_id', how='inner')
-
-    max_service_speed = route_stats['service_speed'].max()
-    max_avg_trip_speed = route_stats['avg_trip_speed'].max()
-    max_num_trips = route_stats['num_trips'].max()
-    max_headway = route_stats['mean_headway'].max()
-    max_avg_stops = route_stats['avg_stops'].max()
-
-    route_stats['efficiency_score'] = (0.225 * (route_stats['service_speed'] / max_service_speed) + 
-                                       0.225 * (route_stats['avg_trip_speed'] / max_avg_trip_speed) + 
-                                       0.225 * (route_stats['num_trips'] / max_num_trips) + 
-                                       0.225 * (route_stats['avg_stops'] / max_avg_stops) - 
-                                       0.1 * (route_stats['mean_headway'] / max_headway))
-    
-    return  jsonify({
-        'most_efficient_routes': route_stats.sort_values(by=['efficiency_score'], ascending=False).iloc[:10].to_dict(orient='records'),
-        'least_efficient_routes':  route_stats.sort_values(by=['efficiency_score'], ascending=True).iloc[:10].to_dict(orient='records')
-    }), 200
-
-def clean_time(x):
-    date = datetime.datetime.today()
-    hr, min, sec = x.split(':')
-    if x.startswith('24'):
-        date = date + datetime.timedelta(days=1)
-        hr = '00'
-    x = f"{date.strftime('%Y-%m-%d')} {hr}:{min}:{sec}"
-    return x
+    return analytics_response('route_efficiency', date)
 
 def get_in_between_stops(trip_id, start_stop_id, end_stop_id):
-    stop_times = feed.stop_times
-
-    trip_stop_times = stop_times[stop_times['trip_id'] == trip_id].sort_values(by=['stop_sequence'])
-
-    trip_stop_times['at'] = pd.to_datetime(trip_stop_times['arrival_time'].apply(clean_time))
-    trip_stop_times['dt'] = pd.to_datetime(trip_stop_times['departure_time'].apply(clean_time))
-    # print(trip_stop_times)
-
-    trip_stop_times['time_diff'] = trip_stop_times.groupby(by="trip_id")['at'].diff().dt.total_seconds() / 60
-    trip_stop_times['time_diff'] = trip_stop_times['time_diff'].fillna(0)
-
-    trip_stop_times['shape_dist_traveled'] = trip_stop_times['shape_dist_traveled'].fillna(0)
+    """
+    The stop_times of a trip from start_stop_id to end_stop_id merged with the stops,
+    None when the trip does not go from one to the other. time_diff is the minutes
+    since the previous stop's arrival (0 at the trip's first stop), split into
+    travel_time from its departure and the dwell_time there.
+    """
+    rows = feed_index.segment_rows(trip_id, start_stop_id, end_stop_id)
+    if rows is None:
+        return None
+    first, last = rows
+    in_between_stops = expand_times(feed.stop_times.iloc[first:last + 1]).copy()
 
-    trip_stop_times = trip_stop_times.drop(['at', 'dt'], axis=1)
+    travel = feed_index.hop_seconds[first:last + 1]
+    trip_start, _ = feed_index.stop_time_range(trip_id)
+    previous = np.r_[feed_index.dwell_seconds[first - 1] if first > trip_start else 0.0, feed_index.dwell_seconds[first:last]]
+    in_between_stops['travel_time'] = travel / 60
+    in_between_stops['dwell_time'] = previous / 60
+    in_between_stops['time_diff'] = (travel + previous) / 60
 
-    start_sequence = trip_stop_times[trip_stop_times['stop_id'] == start_stop_id]['stop_sequence'].values[0]
-    end_sequence = trip_stop_times[trip_stop_times['stop_id'] == end_stop_id]['stop_sequence'].values[0]
+    in_between_stops['shape_dist_traveled'] = in_between_stops['shape_dist_traveled'].fillna(0)
 
-    in_between_stops = trip_stop_times[(trip_stop_times['stop_sequence'] >= start_sequence) &
-                                       (trip_stop_times['stop_sequence'] <= end_sequence)]
-    
     in_between_stops_details = in_between_stops.merge(feed.stops, on='stop_id', how='left')
     drop_cols = ['location_type', 'parent_station', 'stop_desc', 'stop_headsign', 'stop_timezone', 'stop_url', 'zone_id']
     in_between_stops_details = in_between_stops_details.drop(drop_cols, axis=1)
 
     return in_between_stops_details
 
-def get_stop_id(stop_name):
-    stop_row = feed.stops[feed.stops['stop_name'] == stop_name]
-    if not stop_row.empty:
-        return stop_row['stop_id'].values[0]
-    return None
+def get_stop_ids(stop_name):
+    """Every stop_id named stop_name (compared case and punctuation insensitively), [] if none."""
+    if not stop_name:
+        return []
+    return stop_search.lookup(stop_name)
+
+def parse_time_arg(value):
+    """HH:MM:SS query parameter to seconds since midnight (None when absent)."""
+    if not value:
+        return None
+    hr, min, sec = value.split(':')
+    return int(hr) * 3600 + int(min) * 60 + int(sec)
 
 @app.route('/api/trips_between_stops', methods=['GET'])
 def trips_between_stops():
     start_stop_name = request.args.get('start_stop_name')
     end_stop_name = request.args.get('end_stop_name')
+    date = request.args.get('date')
 
     if not start_stop_name or not end_stop_name:
         return jsonify({"error": "start_stop_name and end_stop_name are required"}), 400
 
-    start_stop_id = get_stop_id(start_stop_name)
-    end_stop_id = get_stop_id(end_stop_name)
+    # Optional service date and departure window (HH:MM:SS) at the start stop
+    try:
+        if date:
+            pd.to_datetime(date, format="%Y%m%d")  # Validate date format
+        depart_after = parse_time_arg(request.args.get('depart_after'))
+        depart_before = parse_time_arg(request.args.get('depart_before'))
+    except ValueError:
+        return jsonify({'error': 'Invalid date or time format. Use YYYYMMDD and HH:MM:SS.'}), 400
+
+    start_stop_ids = get_stop_ids(start_stop_name)
+    end_stop_ids = get_stop_ids(end_stop_name)
 
-    if not start_stop_id or not end_stop_id:
+    if not start_stop_ids or not end_stop_ids:
         return jsonify({"error": "Invalid stop names"}), 404
-    
-    trips_start_id = feed.stop_times[feed.stop_times['stop_id'] == start_stop_id]['trip_id'].unique()
-    trips_end_id = feed.stop_times[feed.stop_times['stop_id'] == end_stop_id]['trip_id'].unique()
 
-    possible_trips = set(trips_start_id).intersection(set(trips_end_id))
+    # A name can belong to several stops (e.g. both sides of a street): search every pair
+    possible_trips = pd.concat([
+        feed_index.trips_between(start_stop_id, end_stop_id, date=date or None,
+                                 depart_after=depart_after, depart_before=depart_before)
+        .assign(boarding_stop_id=start_stop_id, alighting_stop_id=end_stop_id)
+        for start_stop_id in start_stop_ids for end_stop_id in end_stop_ids
+    ], ignore_index=True)
+    if len(start_stop_ids) * len(end_stop_ids) > 1:
+        by_departure = np.argsort(gtfs_time.to_seconds(possible_trips['departure_time']), kind='stable')
+        possible_trips = possible_trips.iloc[by_departure].drop_duplicates('trip_id').reset_index(drop=True)
 
     if len(possible_trips) == 0:
         return jsonify({"message": "No routes found between the given stops"}), 404
     
-    trips_stats = feed.compute_trip_stats()
+    trips_stats = stats_cache.trip_stats()
     
-    trip_ids = list(possible_trips)
-    trip_route_infos = trips_stats[trips_stats['trip_id'].isin(trip_ids)].merge(feed.routes[['route_id', 'route_short_name', 'route_long_name', 'route_color']], on='route_id', how='left')
+    trip_route_infos = possible_trips.merge(trips_stats, on='trip_id', how='left').merge(feed.routes[['route_id', 'route_short_name', 'route_long_name', 'route_color']], on='route_id', how='left')
 
     return  jsonify({
         'start_stop_name':  start_stop_name,
         'end_stop_name': end_stop_name,
-        'start_stop_id':  start_stop_id,
-        'end_stop_id': end_stop_id,
-        'total_results':  len(trip_ids),
+        'start_stop_id':  start_stop_ids[0],
+        'end_stop_id': end_stop_ids[0],
+        'start_stop_ids': start_stop_ids,
+        'end_stop_ids': end_stop_ids,
+        'total_results':  len(possible_trips),
         'trips_between_stops': trip_route_infos.to_dict(orient='records')
     }), 200
 
+@app.route('/api/journey', methods=['GET'])
+def plan_journey():
+    """
+    API to plan journeys with transfers (and walks between nearby stops) from one stop
+    to another, using the RAPTOR router.
+      start_stop_id / end_stop_id (repeatable), or start_stop_name / end_stop_name for
+      every stop with that name
+      date: YYYYMMDD, time: HH:MM:SS departure
+      max_transfers: default 3, at most MAX_TRANSFERS
+      mode: 'earliest' (default) for the earliest arrival per number of transfers, or
+            'profile' for every Pareto-optimal journey departing between time and window_end
+    """
+    # Every stop sharing a name is a possible origin / destination
+    start_stop_ids = request.args.getlist('start_stop_id') or get_stop_ids(request.args.get('start_stop_name'))
+    end_stop_ids = request.args.getlist('end_stop_id') or get_stop_ids(request.args.get('end_stop_name'))
+    date = request.args.get('date')
+    mode = request.args.get('mode', 'earliest')
+
+    if not start_stop_ids or not end_stop_ids:
+        return jsonify({"error": "Valid start and end stops are required"}), 400
+    if not date:
+        return jsonify({'error': 'date is required'}), 400
+
+    try:
+        pd.to_datetime(date, format="%Y%m%d")  # Validate date format
+        departure = parse_time_arg(request.args.get('time'))
+        window_end = parse_time_arg(request.args.get('window_end'))
+        max_transfers = int(request.args.get('max_transfers', 3))
+        if not 0 <= max_transfers <= MAX_TRANSFERS:
+            raise ValueError('max_transfers')
+    except (TypeError, ValueError):
+        return jsonify({'error': f'Invalid parameters. Use date=YYYYMMDD, time=HH:MM:SS and max_transfers from 0 to {MAX_TRANSFERS}.'}), 400
+
+    if departure is None:
+        return jsonify({'error': 'time is required'}), 400
+
+    if mode == 'profile':
+        if window_end is None:
+            window_end = departure + 3600
+        journeys = raptor_router.profile(start_stop_ids, end_stop_ids, date, departure, window_end,
+                                         max_transfers=max_transfers)
+    elif mode == 'earliest':
+        journeys = raptor_router.earliest_arrival(start_stop_ids, end_stop_ids, date, departure,
+                                                  max_transfers=max_transfers)
+    else:
+        return jsonify({'error': "mode must be 'earliest' or 'profile'"}), 400
+
+    if not journeys:
+        return jsonify({"message": "No journeys found between the given stops"}), 404
+
+    return jsonify({
+        'start_stop_id': start_stop_ids[0],
+        'end_stop_id': end_stop_ids[0],
+        'start_stop_ids': start_stop_ids,
+        'end_stop_ids': end_stop_ids,
+        'date': date,
+        'mode': mode,
+        'total_results': len(journeys),
+        'journeys': journeys
+    }), 200
+
+def parse_shape_args():
+    """
+    (tolerance in meters or None, encoding) from the geometry query parameters:
+      simplify: a zoom level (full, high, medium, low) or a tolerance in meters; default full
+      encoding: 'coordinates' (default) for [lat, lon] pairs or 'polyline' for an encoded polyline
+    """
+    encoding = request.args.get('encoding', 'coordinates')
+    if encoding not in ('coordinates', 'polyline'):
+        raise ValueError("encoding must be 'coordinates' or 'polyline'")
+    try:
+        tolerance = parse_tolerance(request.args.get('simplify'))
+    except ValueError:
+        raise ValueError(f"simplify must be one of {', '.join(SIMPLIFY_TOLERANCES)} or a tolerance in meters")
+    return tolerance, encoding
+
+def encode_shape(coords, encoding):
+    return encode_polyline(coords) if encoding == 'polyline' else coords.tolist()
+
+def clip_stops(trip_id, in_between_stops):
+    """(lat, lon, shape_dist_traveled) of the first and last of in_between_stops, to clip the trip's shape with."""
+    distances = feed_index.stop_times_for_trip(trip_id).set_index('stop_sequence')['shape_dist_traveled']
+    ends = in_between_stops.iloc[[0, -1]]
+    return [(row.stop_lat, row.stop_lon, float(distances.get(row.stop_sequence, np.nan))) for row in ends.itertuples()]
+
+@app.route('/shape/<shape_id>', methods=['GET'])
+def get_shape_by_id(shape_id):
+    """
+    API to get the geometry of a shape, optionally simplified (?simplify=) and
+    polyline-encoded (?encoding=polyline).
+    """
+    if shape_id not in shape_index:
+        return jsonify({'error': 'Shape not found'}), 404
+    try:
+        tolerance, encoding = parse_shape_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    coords = shape_index.geometry(shape_id, tolerance)
+    return jsonify({
+        'shape_id': shape_id,
+        'num_points': len(coords),
+        'encoding': encoding,
+        'shape': encode_shape(coords, encoding)
+    }), 200
+
 @app.route('/api/routes_between_stops', methods=['GET'])
 def routes_between_stops():
+    """
+    API to get a trip's route, stops and shape between two of its stops.
+      trip_id, start_stop_id, end_stop_id
+      clip: 1 to return only the part of the shape between the two stops
+      simplify / encoding: see parse_shape_args
+    """
     trip_id = request.args.get('trip_id')
     start_stop_id = request.args.get('start_stop_id')
     end_stop_id = request.args.get('end_stop_id')
+    clip = request.args.get('clip', '').lower() in ('1', 'true', 'yes')
 
-    trips_stats = feed.compute_trip_stats()
+    try:
+        tolerance, encoding = parse_shape_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    trips_stats = stats_cache.trip_stats()
 
     trip_route_info = trips_stats[trips_stats['trip_id'] == trip_id].merge(feed.routes[['route_id', 'route_short_name', 'route_long_name', 'route_color']], on='route_id', how='left')
+    if trip_route_info.empty:
+        return jsonify({'error': 'Trip not found'}), 404
 
     shape_id = trip_route_info['shape_id'].values[0]
-    route_shape = feed.shapes[feed.shapes['shape_id'] == trip_route_info['shape_id'].values[0]].sort_values(
-        by=['shape_pt_sequence']
-    ).reset_index(drop=True)
-    route_shape = route_shape[['shape_pt_lat', 'shape_pt_lon']].values.tolist()
 
+    rows = feed_index.segment_rows(trip_id, start_stop_id, end_stop_id)
+    if rows is None:
+        return jsonify({'error': 'The trip does not go from start_stop_id to end_stop_id'}), 404
     in_between_stops = get_in_between_stops(trip_id, start_stop_id, end_stop_id)
 
-    
-    total_distance = in_between_stops.iloc[-1]['shape_dist_traveled']
-    total_duration = in_between_stops.iloc[-1]['time_diff'].sum()
+    if clip:
+        start_stop, end_stop = clip_stops(trip_id, in_between_stops)
+        route_shape = shape_index.geometry(shape_id, tolerance, start_stop, end_stop)
+    else:
+        route_shape = shape_index.geometry(shape_id, tolerance)
 
-    expected_speed_kmph = total_distance / total_duration
+    # Departure from the start stop to arrival at the end stop, distance in km
+    duration_seconds, total_distance = feed_index.segment_summary(*rows)
+    total_duration = duration_seconds / 60
+    expected_speed_kmph = total_distance / (duration_seconds / 3600) if duration_seconds > 0 else None
 
     return jsonify({
         'trip_route_info':  trip_route_info.to_dict(orient='records'),
-        'route_shape': route_shape,
+        'route_shape': encode_shape(route_shape, encoding),
+        'route_shape_encoding': encoding,
         'in_between_stops':  in_between_stops.to_dict(orient='records'),
         'total_distance':  total_distance,
         'expected_duration': total_duration,
         'expected_speed_kmph': expected_speed_kmph
     }), 200
 
-# Load and Preprocess The Data For Model
-def load_preprocess_data():
-    # Compute trip_stats
-    trips_stats = feed.compute_trip_stats()
-
-    # Add time of day classification
-    trips_stats['time_of_day'] = trips_stats['start_time'].apply(classify_time_of_day)
-
-    trips_stats['start_hour'] = pd.to_datetime(trips_stats['start_time'].apply(clean_time), format="mixed").dt.hour
-    trips_stats['end_hour'] = pd.to_datetime(trips_stats['end_time'].apply(clean_time), format="mixed").dt.hour
-
-    trips_stats['is_peak_hours'] = trips_stats['start_hour'].apply(lambda x: 1 if (8 <= x <= 12 or 16 <= x <= 20) else 0)
-
-    trips_stats1 = trips_stats.merge(feed.trips[['trip_id', 'route_id', 'service_id']], left_on=['trip_id', 'route_id'], right_on=['trip_id', 'route_id'], how='left')
-
-    trips_stats1 = trips_stats1.merge(feed.calendar_dates[['service_id', 'date']], on='service_id', how='left')
-    trips_stats1.dropna(subset=['date'], inplace=True)
-
-    trips_stats1['Date'] = pd.to_datetime(trips_stats1['date'], format='%Y%m%d')
-    trips_stats1['day'] = trips_stats1['Date'].dt.day
-    trips_stats1['month'] = trips_stats1['Date'].dt.month
-    trips_stats1['weekday'] = trips_stats1['Date'].dt.weekday
-
-    trips_stats1['is_weekend'] = trips_stats1['weekday'].apply(lambda x: 1 if x >= 5 else 0)
-    trips_stats1 = trips_stats1.merge(feed.routes[['route_id', 'route_long_name']], on='route_id', how='left')
-
-    trips_demand = trips_stats1.groupby(by=['route_id', 'Date', 'month', 'day', 'weekday', 'is_weekend', 'time_of_day', 'is_peak_hours']).agg(
-        TotalTrips=('trip_id', 'nunique'),
-        TotalStops=('num_stops', 'median'),
-        AvgDuration=('duration', 'mean'),
-        AvgDistance=('distance', 'mean'),
-        AvgSpeed=('speed', 'mean'),
-    ).reset_index()
-
-    encoder = OneHotEncoder(sparse_output=False, handle_unknown='ignore')
-    encoded_data = encoder.fit_transform(trips_demand.drop(['TotalTrips'], axis=1)[['time_of_day']])
-
-    timeofday_encoded_df = pd.DataFrame(encoded_data, columns=encoder.get_feature_names_out(['time_of_day']))
-    trips_demand = pd.concat([trips_demand, timeofday_encoded_df], axis=1)
-
-
-    joblib.dump(encoder, "onehot_encoder.pkl")
-
-    
-    X = trips_demand.drop(columns=['TotalTrips', 'Date', 'time_of_day'])
-    y = trips_demand['TotalTrips']
-
-    return X, y
-
-def train_model():
-    global model
-
-    X, y = load_preprocess_data()
-
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
-
-    target_encoder = ce.TargetEncoder(cols=['route_id'])
-
-    X_train = target_encoder.fit_transform(X_train, y_train)
-    X_test = target_encoder.transform(X_test)
-    # print(X_test.columns)
-
-    joblib.dump(target_encoder, "target_encoder.pkl")
-    
-    xgb_model = XGBRegressor(n_estimators=200, random_state=42)
-    xgb_model.fit(X_train, y_train)
-
-    d4p_model = d4p.mb.convert_model(xgb_model)
-
-    y_pred_d4p = d4p_model.predict(X_test)
-
-    mse_d4p = mean_squared_error(y_test, y_pred_d4p)
-    mae_d4p = mean_absolute_error(y_test, y_pred_d4p)
+def parse_hours(value):
+    """Hours of the ?hour= parameter: one hour (8) or an inclusive range (7-9, or 22-2 across midnight)."""
+    if not value:
+        return None
+    first, _, last = value.partition('-')
+    first, last = int(first), int(last or first)
+    if not (0 <= first < 24 and 0 <= last < 24):
+        raise ValueError('hour')
+    return list(range(first, last + 1)) if first <= last else list(range(first, 24)) + list(range(0, last + 1))
+
+SEGMENT_SORTS = {
+    'slowest': (['speed_kmph', 'trips'], [True, False]),
+    'fastest': (['speed_kmph', 'trips'], [False, False]),
+    'busiest': (['trips', 'speed_kmph'], [False, True]),
+}
+
+@app.route('/api/segment_speeds', methods=['GET'])
+def get_segment_speeds():
+    """
+    API to get the scheduled speed of the stop-to-stop segments of the network.
+      date: YYYYMMDD, only the trips running that day (default: every trip of the feed)
+      route_id: repeatable, only the trips of these routes
+      hour: departure hour from the first stop, 8 or a range 7-9
+      min_lat, min_lon, max_lat, max_lon: only segments with a stop in the box
+      by_hour: 1 for one row per segment and hour
+      min_trips: drop segments traversed fewer times
+      sort: slowest (default), fastest or busiest; limit: default 500
+      format: geojson for a FeatureCollection of LineStrings
+      geometry: stops (default, a straight line) or shape (the trip's shape between the
+        two stops, see parse_shape_args for simplify)
+    """
+    date = request.args.get('date')
+    bbox_args = ('min_lat', 'min_lon', 'max_lat', 'max_lon')
+    try:
+        if date:
+            pd.to_datetime(date, format="%Y%m%d")
+        hours = parse_hours(request.args.get('hour'))
+        bbox = parse_float_args(*bbox_args) if any(name in request.args for name in bbox_args) else None
+        min_trips = int(request.args.get('min_trips', 1))
+        limit = parse_limit(default=500)
+        tolerance, _ = parse_shape_args()
+    except (KeyError, ValueError):
+        return jsonify({'error': 'date must be YYYYMMDD, hour 0-23 or a range like 7-9, the bbox needs all of '
+                                 'min_lat, min_lon, max_lat and max_lon, min_trips and limit must be integers'}), 400
+
+    sort = request.args.get('sort', 'slowest')
+    output = request.args.get('format', 'json')
+    geometry = request.args.get('geometry', 'stops')
+    if sort not in SEGMENT_SORTS or output not in ('json', 'geojson') or geometry not in ('stops', 'shape'):
+        return jsonify({'error': f"sort must be one of {sorted(SEGMENT_SORTS)}, format json or geojson, geometry stops or shape"}), 400
+
+    route_ids = request.args.getlist('route_id') or None
+    services = feed_index.active_services(date) if date else None
+    by_hour = request.args.get('by_hour', '').lower() in ('1', 'true', 'yes')
+
+    table = segment_table.query(route_ids=route_ids, hours=hours, services=services, bbox=bbox, by_hour=by_hour)
+    table = table[table['trips'] >= min_trips]
+    columns, ascending = SEGMENT_SORTS[sort]
+    table = table.sort_values(columns, ascending=ascending, na_position='last', kind='stable')
+    total = len(table)
+    table = table.head(limit)
+
+    segments = []
+    for row in table.itertuples(index=False):
+        record = segment_table.segment_record(row.segment)
+        if by_hour:
+            record['hour'] = int(row.hour)
+        record.update({
+            'route_ids': row.route_ids,
+            'trips': int(row.trips),
+            'mean_seconds': round(float(row.mean_seconds), 1),
+            'distance_km': round(float(row.km), 4),
+            'speed_kmph': round(float(row.speed_kmph), 2) if np.isfinite(row.speed_kmph) else None,
+        })
+        segments.append(record)
+
+    if output == 'json':
+        return jsonify({
+            'date': date,
+            'total_results': total,
+            'segments': segments
+        }), 200
 
-    feature_importances = xgb_model.feature_importances_
-    feature_importances_df = pd.DataFrame({'Feature': X_train.columns, 'Importance': feature_importances.round(4)})
-    feature_importances_df.sort_values(by=['Importance'], ascending=False, inplace=True)
+    features = []
+    for segment, record in zip(table['segment'].tolist(), segments):
+        start_stop, end_stop = segment_table.ends(segment)
+        shape_id = segment_table.shape_ids[segment]
+        if geometry == 'shape' and shape_id in shape_index:
+            coords = shape_index.geometry(shape_id, tolerance, start_stop, end_stop)
+        else:
+            coords = np.array([start_stop[:2], end_stop[:2]])
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'LineString', 'coordinates': coords[:, ::-1].tolist()},
+            'properties': record
+        })
+    response = jsonify({'type': 'FeatureCollection', 'features': features})
+    response.mimetype = 'application/geo+json'
+    return response, 200
+
+def training_inputs():
+    """The feed tables a training job needs, copied out so the worker process gets plain frames."""
+    return {
+        'trip_stats': stats_cache.trip_stats(),
+        'trips': expand_categoricals(feed.trips[['trip_id', 'route_id', 'service_id']]),
+        'calendar_dates': feed.calendar_dates[['service_id', 'date']].copy(),
+    }
 
-    joblib.dump(d4p_model, 'trained_model.pkl')
+def on_model_trained(job):
+    # The new model invalidates the precomputed forecast grid
+    refresh_forecasts()
 
-    return mse_d4p, mae_d4p, feature_importances_df
+# Background training jobs; a finished job swaps its model version in for the predict endpoints
+training_jobs = TrainingJobs(on_success=on_model_trained)
 
 # API route to trigger model training
 @app.route('/train_model', methods=['POST'])
 def train_model_api():
+    """
+    Start a training job and return its id right away (202). Poll
+    GET /train_model/<job_id> for progress and the evaluation results.
+    """
     try:
-        # Call the training function
-        mse, mae, feature_importances = train_model()
-        
-        # Return success message with evaluation results
-        return jsonify({
-            'message': 'Model trained successfully!',
-            'mse': mse,
-            'mae': mae,
-            'feature_importance': feature_importances.to_dict(orient="records")
-        }), 200
+        job_id = training_jobs.submit(training_inputs())
     except Exception as e:
         return jsonify({
-            'message': 'Error during model training.',
+            'message': 'Error starting model training.',
             'error': str(e)
         }), 500
 
-def preprocess_input(route_id, date, time, total_stops, avg_speed, avg_distance, avg_duration):
-
-    onehot_encoder = joblib.load("onehot_encoder.pkl")
-    target_encoder = joblib.load("target_encoder.pkl")
+    response = jsonify(training_jobs.status(job_id))
+    response.headers['Location'] = f'/train_model/{job_id}'
+    return response, 202
 
-    # Convert the time to a time_of_day classification
-    time_of_day = classify_time_of_day(time)
+@app.route('/train_model/jobs', methods=['GET'])
+def list_training_jobs():
+    return jsonify({'jobs': training_jobs.list()}), 200
 
-    input_data = {
-        'route_id': route_id,
-        'Date': pd.to_datetime(date, format="%Y%m%d"),
-        'time_of_day': time_of_day,
-        'is_peak_hours': 1 if 8 <= int(time.split(":")[0]) <= 12 or 16 <= int(time.split(":")[0]) <= 20 else 0,
-        'month': pd.to_datetime(date).month,
-        'day': pd.to_datetime(date).day,
-        'weekday': pd.to_datetime(date).weekday(),
-        'is_weekend': 1 if pd.to_datetime(date).weekday() >= 5 else 0,
-        'TotalStops':  total_stops,
-        'AvgSpeed': avg_speed,
-        'AvgDistance': avg_distance,
-        'AvgDuration': avg_duration,
-    }
-
-    input_df = pd.DataFrame([input_data])
-
-    # # Encode time_of_day using the saved onehot encoder
-    time_of_day_encoded = onehot_encoder.transform(input_df[['time_of_day']])
-    time_of_day_encoded_df = pd.DataFrame(time_of_day_encoded, columns=onehot_encoder.get_feature_names_out(['time_of_day']))
-    input_df = pd.concat([input_df, time_of_day_encoded_df], axis=1)
+@app.route('/train_model/<job_id>', methods=['GET'])
+def get_training_job(job_id):
+    """
+    Status of a training job: queued, running, cancelling, succeeded, failed or
+    cancelled, with progress ({stage, progress}) while it runs and the mse, mae and
+    feature_importance once it succeeded.
+    """
+    status = training_jobs.status(job_id)
+    if status is None:
+        return jsonify({'error': f'Unknown training job {job_id}'}), 404
+    return jsonify(status), 200
+
+@app.route('/train_model/<job_id>', methods=['DELETE'])
+def cancel_training_job(job_id):
+    """Cancel a queued or running training job. The live model is left as it is."""
+    if training_jobs.status(job_id) is None:
+        return jsonify({'error': f'Unknown training job {job_id}'}), 404
+    if not training_jobs.cancel(job_id):
+        return jsonify({'error': 'The job has already finished', **training_jobs.status(job_id)}), 409
+    return jsonify(training_jobs.status(job_id)), 202
+
+class InvalidInputs(ValueError):
+    """Rows of a prediction request whose date or time cannot be read, by field."""
+
+    def __init__(self, rows):
+        super().__init__('; '.join(f"invalid {field} in rows {indexes}" for field, indexes in rows.items()))
+        self.rows = rows
+
+def input_seconds(times):
+    """HH:MM[:SS] request times to seconds since midnight, gtfs_time.MISSING where malformed."""
+    times = pd.Series(times, copy=False).astype(str).str.strip()
+    return gtfs_time.to_seconds(times.where(times.str.count(':') != 1, times + ':00'))
+
+def preprocess_inputs(rows, artifacts=None):
+    """
+    Model features for a DataFrame with the DEMAND_INPUT_FIELDS columns, one row per
+    prediction. Dates are YYYYMMDD, times HH:MM[:SS]; raises InvalidInputs with the
+    indexes of the rows where either is malformed. artifacts is a
+    model_registry.artifacts() set (the live one by default).
+    """
+    seconds = input_seconds(rows['time'])
+    dates = pd.to_datetime(rows['date'].astype(str), format="%Y%m%d", errors='coerce')
+    invalid = {field: np.flatnonzero(bad).tolist()
+               for field, bad in (('date', dates.isna().to_numpy()), ('time', seconds == gtfs_time.MISSING)) if bad.any()}
+    if invalid:
+        raise InvalidInputs(invalid)
 
-    # # Drop unnecessary columns
-    input_df.drop(columns=['Date', 'time_of_day'], inplace=True)
+    if artifacts is None:
+        artifacts = model_registry.artifacts()
+    hours = gtfs_time.service_hour(seconds)
+    rows = rows.assign(time_of_day=gtfs_time.time_of_day(hours * 3600), is_peak_hours=gtfs_time.is_peak_hours(hours))
 
-    # # Encode  route_id using the saved target encoder
-    input_df = target_encoder.transform(input_df)
+    return encode_features(rows, artifacts['onehot_encoder'], artifacts['target_encoder'])
 
-    return input_df
+def preprocess_input(route_id, date, time, total_stops, avg_speed, avg_distance, avg_duration, artifacts=None):
+    row = dict(zip(DEMAND_INPUT_FIELDS, [route_id, date, time, total_stops, avg_speed, avg_distance, avg_duration]))
+    return preprocess_inputs(pd.DataFrame([row]), artifacts)
 
 @app.route('/predict_demand', methods=['POST'])
 def predict_demand():
     try:
         # Get the request data (ensure the required fields are present)
-        model = joblib.load("trained_model.pkl")
-        
         data = request.get_json()
         route_id = data['route_id']
         date = data['date']
@@ -742,32 +1025,135 @@ def predict_demand():
         avg_distance = data['avg_distance']
         avg_duration = data['avg_duration']
 
-        # Preprocess the input data
-        input_data = preprocess_input(route_id, date, time, total_stops, avg_speed, avg_distance, avg_duration)
-        cols = ['route_id', 'month', 'day', 'weekday', 'is_weekend', 'is_peak_hours', 
-                'TotalStops', 'AvgDuration', 'AvgDistance', 'AvgSpeed', 
-                'time_of_day_Afternoon', 'time_of_day_Mid Night', 'time_of_day_Morning',
-                'time_of_day_Night', 'time_of_day_Peak Evening', 'time_of_day_Peak Morning']
+        # Model and encoders of one version, even if a training job swaps them meanwhile
+        artifacts = model_registry.artifacts()
 
-        input_data = input_data[cols]
+        # Preprocess the input data
+        input_data = preprocess_input(route_id, date, time, total_stops, avg_speed, avg_distance, avg_duration, artifacts)
 
         # Use the model to predict trip demand
-        predicted_demand = model.predict(input_data)
-        print(predicted_demand[0])
+        predicted_demand = artifacts['model'].predict(input_data)
 
         # Return the prediction result
         return jsonify({
             'predicted_demand': int(predicted_demand[0])
         }), 200
 
+    except InvalidInputs as e:
+        return jsonify({'error': 'Use date=YYYYMMDD and time=HH:MM[:SS].', 'invalid_rows': e.rows}), 400
+    except Exception as e:
+        return jsonify({
+            'message': 'Error during prediction.',
+            'error': str(e)
+        }), 500
+
+@app.route('/predict_demand_batch', methods=['POST'])
+def predict_demand_batch():
+    """
+    API to predict trip demand for many inputs at once:
+      {"rows": [{"route_id", "date", "time", "total_stops", "avg_speed", "avg_distance", "avg_duration"}, ...]}
+    Returns the predictions in the order of the rows. All rows are encoded together and
+    scored with a single model call.
+    """
+    data = request.get_json(silent=True) or {}
+    rows = data.get('rows')
+    if not isinstance(rows, list) or not rows:
+        return jsonify({'error': 'rows must be a non-empty list'}), 400
+
+    rows = pd.DataFrame(rows)
+    missing = [field for field in DEMAND_INPUT_FIELDS if field not in rows.columns or rows[field].isna().any()]
+    if missing:
+        return jsonify({'error': f"Every row needs {', '.join(missing)}"}), 400
+
+    try:
+        artifacts = model_registry.artifacts()
+        predicted_demand = artifacts['model'].predict(preprocess_inputs(rows, artifacts))
+        return jsonify({
+            'predicted_demand': np.asarray(predicted_demand).astype(int).tolist()
+        }), 200
+
+    except InvalidInputs as e:
+        return jsonify({'error': 'Every row needs date=YYYYMMDD and time=HH:MM[:SS].', 'invalid_rows': e.rows}), 400
     except Exception as e:
         return jsonify({
             'message': 'Error during prediction.',
             'error': str(e)
         }), 500
 
+# Outcome of the last forecast rescoring, reported by /api/demand_forecast
+forecast_refresh = {'status': None, 'returncode': None}
+
+def refresh_forecasts():
+    """Rescore the stale dates of the forecast grid in a separate process (see db_builder --forecast)."""
+    process = subprocess.Popen([sys.executable, str(Path(__file__).with_name('db_builder.py')), '--forecast'])
+    forecast_refresh.update(status='running', returncode=None)
+
+    def wait():
+        returncode = process.wait()
+        forecast_refresh.update(status='done' if returncode == 0 else 'failed', returncode=returncode)
+        if returncode != 0:
+            print(f"Forecast refresh failed with exit code {returncode}", flush=True)
+
+    threading.Thread(target=wait, name='forecast-refresh', daemon=True).start()
+    return process
 
-db = init_database()
+@app.route('/api/demand_forecast', methods=['GET'])
+def get_demand_forecast():
+    """
+    API to read the precomputed demand forecast grid.
+      start_date, end_date: YYYYMMDD range (end_date defaults to start_date)
+      route_id: optional, one route
+    `stale` is true when some of the dates were scored with another model than the
+    current model (a rebuild is started after each training job); `refresh` has the
+    status and exit code of the last rebuild.
+    """
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date') or start_date
+    route_id = request.args.get('route_id')
+
+    if not start_date:
+        return jsonify({'error': 'start_date is required'}), 400
+    try:
+        pd.to_datetime(start_date, format="%Y%m%d")  # Validate date format
+        pd.to_datetime(end_date, format="%Y%m%d")
+    except ValueError:
+        return jsonify({'error': 'Invalid date format. Use YYYYMMDD.'}), 400
+
+    forecasts = forecast_store.query(start_date, end_date, route_id=route_id)
+    current_version = model_version(current_artifacts())
+    scored_versions = forecast_store.scored_versions(start_date, end_date)
+
+    return jsonify({
+        'start_date': start_date,
+        'end_date': end_date,
+        'route_id': route_id,
+        'model_version': current_version,
+        'stale': any(version != current_version for version in scored_versions),
+        'refresh': dict(forecast_refresh),
+        'total_results': len(forecasts),
+        'forecasts': forecasts
+    }), 200
+
+
+db = None
+db_lock = threading.Lock()
+
+def get_db():
+    """The LangChain SQLDatabase, created on the first chat query."""
+    global db
+    with db_lock:
+        if db is None:
+            from ai_func import init_database
+            db = init_database()
+    return db
+
+def warm_chat():
+    """Build the text-to-SQL chains and read the schema ahead of the first chat query."""
+    try:
+        from ai_func import get_assistant
+        get_assistant(get_db()).schema()
+    except Exception as e:
+        print(f"Chat assistant not warmed up: {e}", flush=True)
 
 chat_history = {}
 
@@ -784,11 +1170,19 @@ def chat():
 
     try:
         # db = session.get("db")
-        response = get_sql_response(user_query=user_query, db=db, chat_history=chat_history)
+        from ai_func import get_sql_response
+        response = get_sql_response(user_query=user_query, db=get_db(), chat_history=chat_history[user_id])
         return jsonify({"response": response})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/cache_stats', methods=['GET'])
+def get_cache_stats():
+    """
+    API to inspect the trip/route stats cache (hit/miss counters and size).
+    """
+    return jsonify(stats_cache.stats()), 200
+
 
 if  __name__ == '__main__':
   app.run(debug=True)
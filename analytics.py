@@ -0,0 +1,164 @@
+"""
+Payload builders for the date based /api/* analytics endpoints.
+
+Each builder takes the feed, a StatsCache and a YYYYMMDD date and returns the
+JSON-serialisable dict the endpoint responds with. They are shared by the Flask
+handlers (live computation) and by db_builder.materialize_snapshots (offline).
+"""
+import gtfs_time
+
+
+def route_stats_payload(feed, stats, date):
+    route_stats = stats.route_stats(date)
+    cols_round_off = ['mean_headway', 'mean_trip_distance', 'mean_trip_duration', 'service_distance', 'service_duration', 'service_speed']
+    route_stats[cols_round_off] = route_stats[cols_round_off].round(2)
+    route_stats['mean_trip_duration'] = route_stats['mean_trip_duration'] * 60
+    route_stats['service_duration'] = route_stats['service_duration'] * 60
+    route_stats[['mean_headway', 'min_headway', 'max_headway']].fillna(0, inplace=True)
+    route_stats.fillna('NA',  inplace=True)
+    route_stats = route_stats.merge(feed.routes[['route_id', 'route_long_name', 'route_color']], on='route_id', how='left')
+
+    return {'route_stats': route_stats.to_dict(orient='records')}
+
+def trip_stats_payload(feed, stats, date):
+    trip_stats = stats.trip_stats()
+
+    # Add time of day classification
+    start_seconds = gtfs_time.to_seconds(trip_stats['start_time'])
+    trip_stats['time_of_day'] = gtfs_time.time_of_day(start_seconds)
+    trip_stats['time_period'] = gtfs_time.time_period(start_seconds)
+
+    # Now we can analyze trip duration and speed by time of day
+    trip_duration_analysis = trip_stats.groupby('time_of_day').agg({
+        'trip_id': ['count'],
+        'duration': ['mean', 'min', 'max'],  # Analyze duration (in minutes)
+        'speed': ['mean', 'min', 'max']     # Analyze speed (km/h)
+    }).reset_index()
+
+    trip_period_analysis = trip_stats.groupby("time_period").agg({
+        'trip_id': ['count'],
+        'duration': ['mean', 'min', 'max'],  # Analyze duration (in minutes)
+        'speed': ['mean', 'min', 'max']
+    }).reset_index()
+
+    trip_duration_cols = ['mean_duration', 'min_duration', 'max_duration', 'mean_speed', 'min_speed', 'max_speed']
+    trip_period_cols = ['mean_duration', 'min_duration', 'max_duration', 'mean_speed', 'min_speed', 'max_speed']
+
+    trip_duration_analysis.columns = ['time_of_day', 'num_trips', 'mean_duration', 'min_duration', 'max_duration',
+                                      'mean_speed', 'min_speed', 'max_speed']
+    trip_duration_analysis[trip_duration_cols] = trip_duration_analysis[trip_duration_cols].round(2)
+
+    trip_period_analysis.columns = ['period_time', 'num_trips', 'mean_duration', 'min_duration', 'max_duration',
+                                      'mean_speed', 'min_speed', 'max_speed']
+    trip_period_analysis[trip_period_cols] = trip_period_analysis[trip_period_cols].round(2)
+
+    return {'trip_duration_analysis': trip_duration_analysis.to_dict(orient='records'),
+            'trip_period_analysis': trip_period_analysis.to_dict(orient='records')}
+
+def frequent_routes_payload(feed, stats, date):
+    route_stats = stats.route_stats(date)
+    route_stats = route_stats.merge(feed.routes[['route_id', 'route_long_name', 'route_color']])
+
+    frequent_routes = route_stats.sort_values(by=['max_headway', 'min_headway']).reset_index(drop=True)
+    most_frequent_routes =  frequent_routes.head(10)
+    least_frequent_routes =  frequent_routes.iloc[-10::-1]
+
+    return {'most_frequent_routes': most_frequent_routes.to_dict(orient='records'),
+            'least_frequent_routes': least_frequent_routes.to_dict(orient='records')}
+
+def shortest_longest_routes_payload(feed, stats, date):
+    route_stats = stats.route_stats(date)
+    route_stats['mean_trip_distance'] = route_stats['mean_trip_distance'].round(2)
+    route_stats = route_stats.merge(feed.routes[['route_id', 'route_long_name', 'route_color']],on='route_id', how='left')
+
+    shortest_routes = route_stats.sort_values(by='mean_trip_distance').head(10)
+    longest_routes = route_stats.sort_values(by='mean_trip_distance', ascending=False).head(10)
+
+    return {'shortest_routes': shortest_routes.to_dict(orient='records'),
+            'longest_routes': longest_routes.to_dict(orient='records')}
+
+def slowest_fastest_routes_payload(feed, stats, date):
+    route_stats = stats.route_stats(date)
+    route_stats['service_speed'] = route_stats['service_speed'].round(2)
+    route_stats = route_stats.merge(feed.routes[['route_id', 'route_long_name', 'route_color']])
+
+    slowest_routes = route_stats.sort_values(by='service_speed').head(10)
+    fastest_routes = route_stats.sort_values(by='service_speed', ascending=False).head(10)
+
+    return {
+        'slowest_routes': slowest_routes.to_dict(orient='records'),
+        'fastest_routes': fastest_routes.to_dict(orient='records')
+    }
+
+def peak_hour_traffic_payload(feed, stats, date):
+    trip_stats = stats.trip_stats()
+
+    route_stats = stats.route_stats(date)
+    route_stats = route_stats.merge(feed.routes[['route_id', 'route_long_name', 'route_color']],on='route_id', how='left')
+
+    start_seconds = gtfs_time.to_seconds(trip_stats['start_time'])
+    trip_stats['time_of_day'] = gtfs_time.time_of_day(start_seconds)
+    trip_stats['time_period'] = gtfs_time.time_period(start_seconds)
+
+    # routes with most traffic during peak hours
+    peak_hour_trips =  trip_stats[trip_stats['time_of_day'].str.contains("peak", case=False)]
+    peak_hour_routes = peak_hour_trips.groupby('route_id').agg({
+        'trip_id': 'count',
+        'time_period': 'unique',
+    }).reset_index()
+    peak_hour_routes['time_period'] = peak_hour_routes['time_period'].apply(lambda x: list(x))
+    peak_hour_routes = peak_hour_routes.merge(route_stats)
+
+    return {'peak_hour_routes': peak_hour_routes.to_dict(orient='records')}
+
+def distance_coverage_optimization_payload(feed, stats, date):
+    route_stats = stats.route_stats(date)
+    route_stats = route_stats.merge(feed.routes[['route_id', 'route_long_name', 'route_color']])
+
+    inefficient_routes = route_stats[(route_stats['mean_trip_distance'] > 15) & (route_stats['num_trips'] < 10)]
+    inefficient_routes.sort_values(by='mean_trip_distance', ascending=False)
+
+    return {'inefficient_routes': inefficient_routes.to_dict(orient='records')}
+
+def route_efficiency_payload(feed, stats, date):
+    trip_stats = stats.trip_stats()
+
+    route_stats = stats.route_stats(date)
+    route_stats = route_stats.merge(feed.routes[['route_id', 'route_long_name', 'route_color']])
+
+    route_trips = trip_stats.groupby(by=['route_id']).agg(
+        avg_stops=('num_stops', 'mean'),
+        avg_trip_speed=('speed', 'mean')
+    ).reset_index()
+
+    route_stats = route_stats.merge(route_trips, on='route_id', how='inner')
+
+    max_service_speed = route_stats['service_speed'].max()
+    max_avg_trip_speed = route_stats['avg_trip_speed'].max()
+    max_num_trips = route_stats['num_trips'].max()
+    max_headway = route_stats['mean_headway'].max()
+    max_avg_stops = route_stats['avg_stops'].max()
+
+    route_stats['efficiency_score'] = (0.225 * (route_stats['service_speed'] / max_service_speed) +
+                                       0.225 * (route_stats['avg_trip_speed'] / max_avg_trip_speed) +
+                                       0.225 * (route_stats['num_trips'] / max_num_trips) +
+                                       0.225 * (route_stats['avg_stops'] / max_avg_stops) -
+                                       0.1 * (route_stats['mean_headway'] / max_headway))
+
+    return {
+        'most_efficient_routes': route_stats.sort_values(by=['efficiency_score'], ascending=False).iloc[:10].to_dict(orient='records'),
+        'least_efficient_routes':  route_stats.sort_values(by=['efficiency_score'], ascending=True).iloc[:10].to_dict(orient='records')
+    }
+
+
+# endpoint name -> payload builder, shared by the API and the snapshot materializer
+PAYLOAD_BUILDERS = {
+    'route_stats': route_stats_payload,
+    'trip_stats': trip_stats_payload,
+    'frequent_routes': frequent_routes_payload,
+    'shortest_longest_routes': shortest_longest_routes_payload,
+    'slowest_fastest_routes': slowest_fastest_routes_payload,
+    'peak_hour_traffic': peak_hour_traffic_payload,
+    'distance_coverage_optimization': distance_coverage_optimization_payload,
+    'route_efficiency': route_efficiency_payload,
+}
@@ -0,0 +1,85 @@
+"""
+Query times of typical chat questions against nyc_gtfs.db as db_builder now writes it
+(covering indexes, ANALYZE) and against a copy without the indexes and statistics,
+which is what the previous to_sql(if_exists='replace') build produced.
+
+    python benchmarks/bench_chat_db.py [nyc_gtfs.db] [repeat]
+"""
+import sys
+import time
+import shutil
+import sqlite3
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+QUERIES = {
+    "routes between two stops": """
+        SELECT DISTINCT T1.route_short_name FROM Routes AS T1
+        JOIN Trips AS T4 ON T1.route_id = T4.route_id JOIN StopTimes AS T2 ON T4.trip_id = T2.trip_id
+        JOIN Stops AS T3 ON T2.stop_id = T3.stop_id WHERE T3.stop_name = '{stop_a}'
+        INTERSECT SELECT DISTINCT T1.route_short_name FROM Routes AS T1
+        JOIN Trips AS T4 ON T1.route_id = T4.route_id JOIN StopTimes AS T2 ON T4.trip_id = T2.trip_id
+        JOIN Stops AS T3 ON T2.stop_id = T3.stop_id WHERE T3.stop_name = '{stop_b}'""",
+    "stops of a trip": "SELECT stop_id, arrival_time FROM StopTimes WHERE trip_id = '{trip_id}' ORDER BY stop_sequence",
+    "departures at a stop": "SELECT trip_id, departure_time FROM StopTimes WHERE stop_id = '{stop_id}' ORDER BY departure_time LIMIT 20",
+    "trips of a route": "SELECT COUNT(*) FROM Trips WHERE route_id = '{route_id}'",
+    "route stats on a date": "SELECT num_trips, mean_headway FROM RouteStats WHERE route_id = '{route_id}' AND Date = '{date}'",
+    "mean trip duration of a route": "SELECT AVG(duration) FROM TripStats WHERE route_id = '{route_id}'",
+}
+
+
+def sample_values(conn):
+    trip_id, stop_id = conn.execute("SELECT trip_id, stop_id FROM StopTimes WHERE rowid = 1000").fetchone()
+    route_id, = conn.execute("SELECT route_id FROM Trips WHERE trip_id = ?", (trip_id,)).fetchone()
+    stop_a, = conn.execute("SELECT stop_name FROM Stops WHERE stop_id = ?", (stop_id,)).fetchone()
+    other, = conn.execute("SELECT stop_id FROM StopTimes WHERE trip_id = ? ORDER BY stop_sequence DESC LIMIT 1", (trip_id,)).fetchone()
+    stop_b, = conn.execute("SELECT stop_name FROM Stops WHERE stop_id = ?", (other,)).fetchone()
+    date, = conn.execute("SELECT Date FROM RouteStats WHERE route_id = ? LIMIT 1", (route_id,)).fetchone()
+    return {'trip_id': trip_id, 'stop_id': stop_id, 'route_id': route_id, 'date': date,
+            'stop_a': stop_a.replace("'", "''"), 'stop_b': stop_b.replace("'", "''")}
+
+
+def time_queries(db_path, values, repeat):
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    timings = {}
+    for name, query in QUERIES.items():
+        query = query.format(**values)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            rows = conn.execute(query).fetchall()
+        timings[name] = ((time.perf_counter() - start) / repeat * 1000, len(rows))
+    conn.close()
+    return timings
+
+
+def main(db_path='nyc_gtfs.db', repeat=5):
+    repeat = int(repeat)
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    values = sample_values(conn)
+    conn.close()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        unindexed = Path(tmp) / 'unindexed.db'
+        shutil.copyfile(db_path, unindexed)
+        conn = sqlite3.connect(unindexed)
+        for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'").fetchall():
+            conn.execute(f"DROP INDEX {name}")
+        conn.execute("DROP TABLE IF EXISTS sqlite_stat1")
+        conn.commit()
+        conn.close()
+
+        before = time_queries(unindexed, values, repeat)
+    after = time_queries(db_path, values, repeat)
+
+    print(f"{'question':<32}{'no indexes':>12}{'indexed':>12}{'speedup':>9}")
+    for name in QUERIES:
+        assert before[name][1] == after[name][1], name
+        print(f"{name:<32}{before[name][0]:>9.2f} ms{after[name][0]:>9.2f} ms{before[name][0] / after[name][0]:>8.0f}x")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,99 @@
+"""
+Latency of the /chat_query text-to-SQL path with a local stub LLM (no API key needed):
+the previous per-question path (chains rebuilt, db.get_table_info() run twice per
+question) against ai_func.SQLAssistant (chains built once, schema cached per database
+version, LRU cache of answers).
+
+    python benchmarks/bench_chat_query.py [nyc_gtfs.db] [llm_latency_ms]
+"""
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from langchain.prompts import ChatPromptTemplate
+from langchain_community.utilities import SQLDatabase
+from langchain_core.messages import AIMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough
+
+import ai_func
+
+
+QUESTIONS = {
+    "How many routes are there?": "SELECT COUNT(*) FROM Routes;",
+    "How many stops are there?": "SELECT COUNT(*) FROM Stops;",
+    "Which routes have the most trips?": "SELECT route_id, COUNT(*) AS trips FROM Trips GROUP BY route_id ORDER BY trips DESC LIMIT 5;",
+    "What is the name of stop 100014?": "SELECT stop_name FROM Stops WHERE stop_id = '100014';",
+    "List five routes": "SELECT route_short_name FROM Routes LIMIT 5;",
+}
+
+
+SQL = {ai_func.normalize_question(question): sql for question, sql in QUESTIONS.items()}
+
+
+def stub_llm(latency_s):
+    """Stands in for the Gemini chat model: canned SQL per question, a fixed answer otherwise."""
+    def respond(prompt):
+        time.sleep(latency_s)
+        text = prompt.to_string()
+        if "SQL Response:" in text:
+            return AIMessage(content="Here is what the database says.")
+        question = ai_func.normalize_question(text.rsplit("User Question:", 1)[1].split("SQL Query:")[0])
+        return AIMessage(content=f"```sql\n{SQL[question]}\n```")
+    return RunnableLambda(respond)
+
+
+# The per-question path before SQLAssistant
+def legacy_sql_response(user_query, db, chat_history, llm):
+    def get_db_schema(_):
+        return db.get_table_info()
+
+    sql_chain = (
+        RunnablePassthrough.assign(schema=get_db_schema)
+        | ChatPromptTemplate.from_template(template=ai_func.SQL_TEMPLATE)
+        | llm
+        | StrOutputParser()
+    )
+    chain = (
+        RunnablePassthrough.assign(query=sql_chain).assign(
+            schema=lambda _: db.get_table_info(),
+            response=lambda variables: db.run(ai_func.clean_query(variables["query"])),
+        )
+        | ChatPromptTemplate.from_template(template=ai_func.ANSWER_TEMPLATE)
+        | llm
+        | StrOutputParser()
+    )
+    return chain.invoke({"question": user_query, "chat_history": chat_history})
+
+
+def main(db_path="nyc_gtfs.db", llm_latency_ms=200):
+    llm = stub_llm(float(llm_latency_ms) / 1000)
+    db = SQLDatabase.from_uri(database_uri=f"sqlite:///{db_path}")
+    # Every question asked four times, as users repeat the suggested questions
+    questions = [question.lower() + " " if i % 2 else question for i in range(4) for question in QUESTIONS]
+
+    start = time.perf_counter()
+    legacy = [legacy_sql_response(question, db, [{"User": question}], llm) for question in questions]
+    legacy_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    assistant = ai_func.SQLAssistant(db, llm=llm, db_path=db_path)
+    cached = [assistant.ask(question, [{"User": question}])["answer"] for question in questions]
+    cached_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    db.get_table_info()
+    schema_ms = (time.perf_counter() - start) * 1000
+
+    assert legacy == cached
+    n = len(questions)
+    print(f"{n} questions ({len(QUESTIONS)} distinct), stub LLM latency {float(llm_latency_ms):.0f} ms, get_table_info {schema_ms:.0f} ms")
+    print(f"rebuilt chains, schema twice per question: {legacy_s / n * 1000:8.1f} ms/question")
+    print(f"SQLAssistant:                              {cached_s / n * 1000:8.1f} ms/question  {assistant.stats()}")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,92 @@
+"""
+Load time of the nyc_gtfs.db tables: pandas to_sql with default settings (the previous
+builder, followed by the same indexes), db_builder.build_db loading serially with executemany, and build_db loading
+the tables in parallel into attached databases. The loaded rows must be the same.
+Runs on the cleaned feed, its trip_stats and the route stats of one week.
+
+    python benchmarks/bench_db_load.py [workers] [repeat]
+"""
+import sys
+import time
+import sqlite3
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import pandas as pd
+
+import db_builder
+from feed_snapshot import expand_times, gtfs_kit_feed
+
+
+def load_to_sql(db_path, tables):
+    conn = sqlite3.connect(db_path)
+    for name, df in tables.items():
+        df.to_sql(name, conn, if_exists='replace', index=False)
+    conn.commit()
+    # The same indexes and statistics, so both end states can answer the same queries
+    db_builder.optimize_db(conn)
+    conn.commit()
+    conn.close()
+
+
+def table_rows(db_path, name, columns):
+    conn = sqlite3.connect(db_path)
+    rows = pd.read_sql(f'SELECT {", ".join(columns)} FROM "{name}" ORDER BY rowid', conn)
+    conn.close()
+    return rows
+
+
+def main(workers=4, repeat=3):
+    workers, repeat = int(workers), int(repeat)
+
+    feed = db_builder.load_feed()
+    trip_stats = gtfs_kit_feed(feed).compute_trip_stats()
+    route_stats = feed.compute_route_stats(trip_stats, dates=feed.get_dates()[:7])
+    route_stats['Date'] = pd.to_datetime(route_stats.pop('date'), format='%Y%m%d')
+    tables = {
+        'Routes': feed.routes,
+        'Stops': feed.stops,
+        'Trips': feed.trips,
+        'StopTimes': expand_times(feed.stop_times),
+        'TripStats': trip_stats,
+        'RouteStats': route_stats,
+    }
+    total_rows = sum(len(df) for df in tables.values())
+
+    variants = {
+        'to_sql (previous)': lambda path: load_to_sql(path, tables),
+        'build_db, serial': lambda path: db_builder.build_db(path, tables, workers=1),
+        f'build_db, {workers} workers': lambda path: db_builder.build_db(path, tables, workers=workers),
+    }
+
+    timings = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for i, (variant, load) in enumerate(variants.items()):
+            path = str(Path(tmp) / f'variant{i}.db')
+            runs = []
+            for _ in range(repeat):
+                Path(path).unlink(missing_ok=True)
+                start = time.perf_counter()
+                load(path)
+                runs.append(time.perf_counter() - start)
+            timings[variant] = sorted(runs)[len(runs) // 2]
+
+        # Same rows in every declared column
+        for name, df in tables.items():
+            columns = [column for column in df.columns if column in db_builder.CHAT_DB_SCHEMA[name]]
+            expected = table_rows(str(Path(tmp) / 'variant0.db'), name, columns)
+            for i in range(1, len(variants)):
+                pd.testing.assert_frame_equal(table_rows(str(Path(tmp) / f'variant{i}.db'), name, columns), expected, check_dtype=False)
+
+    print(f"{total_rows:,} rows in {len(tables)} tables, median of {repeat} runs")
+    baseline = timings['to_sql (previous)']
+    for variant, seconds in timings.items():
+        print(f"{variant:<24}{seconds:8.2f} s  {total_rows / seconds:>12,.0f} rows/s  {baseline / seconds:5.1f}x")
+    print("all variants include creating the indexes and ANALYZE")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,73 @@
+"""
+Feature building time with the incremental feature store: an empty store, a full
+store, and a store that misses only one newly added week of service dates. X and y
+must match building without the store.
+
+    python benchmarks/bench_feature_store.py [scale]
+
+scale > 1 repeats the calendar that many times (shifted by whole 52-week blocks).
+"""
+import sys
+import time
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import pandas as pd
+
+from demand_training import build_training_data
+from feature_store import FeatureStore
+from bench_training_features import repeat_calendar
+
+
+def timed_build(inputs, feature_store=None):
+    start = time.perf_counter()
+    X, y, _ = build_training_data(**inputs, feature_store=feature_store)
+    return X, y, time.perf_counter() - start
+
+
+def main(scale=1):
+    scale = int(scale)
+
+    import analysis_apis
+    analysis_apis.feed_loader.wait()
+    inputs = analysis_apis.training_inputs()
+
+    calendar_dates = repeat_calendar(inputs['calendar_dates'], scale)
+    dates = sorted(calendar_dates['date'].unique())
+    # The last week stands in for the week added to the feed since the previous training
+    previous = dict(inputs, calendar_dates=calendar_dates[calendar_dates['date'] < dates[-7]])
+    current = dict(inputs, calendar_dates=calendar_dates)
+
+    X, y, plain_s = timed_build(current)
+    timed_build(current)  # warm up imports and the sklearnex patch
+    X, y, plain_s = timed_build(current)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cold_store = FeatureStore(Path(tmp) / 'cold')
+        X_cold, y_cold, cold_s = timed_build(current, cold_store)
+
+        warm_store = FeatureStore(Path(tmp) / 'cold')
+        X_warm, y_warm, warm_s = timed_build(current, warm_store)
+
+        delta_store = FeatureStore(Path(tmp) / 'delta')
+        timed_build(previous, delta_store)
+        delta_store = FeatureStore(delta_store.directory)
+        X_delta, y_delta, delta_s = timed_build(current, delta_store)
+
+    for X_store, y_store in [(X_cold, y_cold), (X_warm, y_warm), (X_delta, y_delta)]:
+        pd.testing.assert_frame_equal(X_store, X, check_exact=True)
+        pd.testing.assert_series_equal(y_store, y, check_exact=True)
+
+    print(f"{len(dates)} service dates, {len(X):,} training rows")
+    print(f"no store:                   {plain_s:6.2f} s")
+    print(f"empty store:                {cold_s:6.2f} s  ({cold_store.misses} dates computed)")
+    print(f"full store:                 {warm_s:6.2f} s  ({warm_store.misses} dates computed)")
+    print(f"store missing the new week: {delta_s:6.2f} s  ({delta_store.misses} dates computed)")
+    print("X and y identical with and without the store")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,60 @@
+"""
+Compare the boolean-mask lookups the by-ID endpoints used to do with FeedIndex.
+
+    python benchmarks/bench_feed_index.py [path/to/gtfs.zip]
+"""
+import sys
+import time
+import random
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import gtfs_kit as gk
+
+from feed_index import FeedIndex
+
+
+def timed(fn, ids):
+    start = time.perf_counter()
+    for id_ in ids:
+        fn(id_)
+    return (time.perf_counter() - start) / len(ids) * 1e6
+
+
+def main(path=Path('data/gtfs-nyc-2023.zip'), n=500):
+    feed = gk.read_feed(path, dist_units='km')
+
+    start = time.perf_counter()
+    index = FeedIndex(feed)
+    print(f"index build: {(time.perf_counter() - start) * 1000:.1f} ms "
+          f"({len(feed.stop_times):,} stop_times, {len(feed.trips):,} trips)")
+
+    random.seed(42)
+    trip_ids = random.choices(feed.trips['trip_id'].tolist(), k=n)
+    stop_ids = random.choices(feed.stops['stop_id'].tolist(), k=n)
+    route_ids = random.choices(feed.routes['route_id'].tolist(), k=n)
+
+    cases = [
+        ('route by id', route_ids,
+         lambda i: feed.routes[feed.routes['route_id'] == i], index.route),
+        ('stop by id', stop_ids,
+         lambda i: feed.stops[feed.stops['stop_id'] == i], index.stop),
+        ('trip by id', trip_ids,
+         lambda i: feed.trips[feed.trips['trip_id'] == i], index.trip),
+        ('trips for route', route_ids,
+         lambda i: feed.trips[feed.trips['route_id'] == i], index.trips_for_route),
+        ('stop_times for trip', trip_ids,
+         lambda i: feed.stop_times[feed.stop_times['trip_id'] == i].sort_values(by=['stop_sequence']),
+         index.stop_times_for_trip),
+    ]
+
+    print(f"{'lookup':<22}{'mask (us)':>12}{'index (us)':>12}{'speedup':>10}")
+    for name, ids, scan, lookup in cases:
+        scan_us = timed(scan, ids)
+        index_us = timed(lookup, ids)
+        print(f"{name:<22}{scan_us:>12.1f}{index_us:>12.1f}{scan_us / index_us:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main(*[Path(arg) for arg in sys.argv[1:]])
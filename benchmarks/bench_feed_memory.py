@@ -0,0 +1,132 @@
+"""
+Memory of the feed tables before and after feed_compact.compact_feed, and whether the
+tables read from the feed snapshot are shared between processes.
+
+The snapshot check (Linux, /proc) verifies that every categorical code, time and
+numeric column of the mapped tables points into a memory-mapped snapshot file, then
+loads the feed in two worker processes at once and reports the resident, shared and
+proportional (Pss, the resident size split among the processes mapping it) memory
+of the snapshot files in each.
+
+    python benchmarks/bench_feed_memory.py [path/to/gtfs.zip]
+"""
+import sys
+import time
+import multiprocessing
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import numpy as np
+import pandas as pd
+import gtfs_kit as gk
+
+import db_builder
+from feed_compact import COMPACT_TABLES, compact_feed, memory_report
+from feed_snapshot import DEFAULT_SNAPSHOT_DIR
+
+WORKERS = 2
+
+
+def mapped_ranges():
+    """(start, end) addresses of the snapshot files mapped into this process."""
+    snapshot_dir = str(DEFAULT_SNAPSHOT_DIR.resolve())
+    ranges = []
+    with open('/proc/self/maps') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 6 and fields[5].startswith(snapshot_dir):
+                start, end = fields[0].split('-')
+                ranges.append((int(start, 16), int(end, 16)))
+    return ranges
+
+def column_values(column):
+    """The array holding a column's data: the codes of a categorical, else its values."""
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.cat.codes.to_numpy()
+    return column.to_numpy()
+
+def unmapped_columns(feed):
+    """table.column of the mapped tables whose data is not in a snapshot mapping."""
+    ranges = mapped_ranges()
+    unmapped = []
+    for name in COMPACT_TABLES:
+        df = getattr(feed, name, None)
+        for column in [] if df is None else df.columns:
+            values = column_values(df[column])
+            address = values.__array_interface__['data'][0]
+            if values.dtype != object and len(values) and not any(start <= address < end for start, end in ranges):
+                unmapped.append(f'{name}.{column}')
+    return unmapped
+
+def snapshot_smaps():
+    """Rss, Pss and Shared_Clean of the snapshot file mappings of this process, in kB."""
+    snapshot_dir = str(DEFAULT_SNAPSHOT_DIR.resolve())
+    totals = {'Rss': 0, 'Pss': 0, 'Shared_Clean': 0}
+    in_snapshot = False
+    with open('/proc/self/smaps') as f:
+        for line in f:
+            fields = line.split()
+            if '-' in fields[0] and not fields[0].endswith(':'):
+                in_snapshot = len(fields) >= 6 and fields[5].startswith(snapshot_dir)
+            elif in_snapshot and fields[0][:-1] in totals:
+                totals[fields[0][:-1]] += int(fields[1])
+    return totals
+
+def _snapshot_worker(path, barrier, results):
+    feed = db_builder.load_feed(path)
+    # Touch every mapped page, as serving requests over the whole feed would
+    for name in COMPACT_TABLES:
+        df = getattr(feed, name, None)
+        for column in [] if df is None else df.columns:
+            values = column_values(df[column])
+            if values.dtype != object:
+                values.view(np.uint8).sum()
+    barrier.wait()  # both processes have the pages resident
+    results.put(snapshot_smaps())
+    barrier.wait()
+
+
+def main(path=Path('data/gtfs-nyc-2023.zip')):
+    feed = gk.read_feed(path, dist_units='km')
+    before = memory_report(feed)
+
+    start = time.perf_counter()
+    compact_feed(feed)
+    compact_s = time.perf_counter() - start
+    after = memory_report(feed)
+
+    print(f"{'table':<16}{'before':>12}{'after':>12}{'ratio':>8}")
+    for name in before:
+        print(f"{name:<16}{before[name] / 2**20:>9.1f} MB{after[name] / 2**20:>9.1f} MB{before[name] / after[name]:>7.1f}x")
+    total_before, total_after = sum(before.values()), sum(after.values())
+    print(f"{'total':<16}{total_before / 2**20:>9.1f} MB{total_after / 2**20:>9.1f} MB{total_before / total_after:>7.1f}x")
+    print(f"compact_feed: {compact_s * 1000:.1f} ms")
+
+    if not Path('/proc/self/smaps').exists():
+        print("snapshot sharing: needs /proc (Linux), skipped")
+        return
+
+    snapshot = db_builder.load_feed(path)
+    unmapped = unmapped_columns(snapshot)
+    print(f"snapshot columns of {', '.join(COMPACT_TABLES)} outside the memory map: {', '.join(unmapped) or 'none'}")
+
+    context = multiprocessing.get_context('spawn')
+    barrier, results = context.Barrier(WORKERS), context.Queue()
+    workers = [context.Process(target=_snapshot_worker, args=(path, barrier, results)) for _ in range(WORKERS)]
+    for worker in workers:
+        worker.start()
+    stats = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    print(f"snapshot files mapped by {WORKERS} processes at once:")
+    for i, totals in enumerate(stats):
+        print(f"  worker {i}: Rss {totals['Rss'] / 1024:6.1f} MB  Shared_Clean {totals['Shared_Clean'] / 1024:6.1f} MB  "
+              f"Pss {totals['Pss'] / 1024:6.1f} MB")
+    rss, shared = sum(t['Rss'] for t in stats), sum(t['Shared_Clean'] for t in stats)
+    print(f"shared: {shared / max(rss, 1):.0%} of the resident snapshot pages")
+
+
+if __name__ == '__main__':
+    main(*[Path(arg) for arg in sys.argv[1:]])
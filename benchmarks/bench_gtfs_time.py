@@ -0,0 +1,94 @@
+"""
+Microbenchmark of the per-row time helpers gtfs_time replaced, on the full
+stop_times table.
+
+    python benchmarks/bench_gtfs_time.py [path/to/gtfs.zip]
+"""
+import sys
+import time
+import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import gtfs_kit as gk
+import pandas as pd
+
+import gtfs_time
+
+
+# The row-wise helpers previously duplicated in analysis_apis.py and db_builder.py
+def clean_time(x):
+    date = datetime.datetime.today()
+    hr, min, sec = x.split(':')
+    if x.startswith('24'):
+        date = date + datetime.timedelta(days=1)
+        hr = '00'
+    x = f"{date.strftime('%Y-%m-%d')} {hr}:{min}:{sec}"
+    return x
+
+def classify_time_of_day(start_time):
+    hour = int(start_time.split(":")[0])
+
+    if 4 <= hour < 8:
+        return 'Morning'
+    elif 8 <= hour < 12:
+        return "Peak Morning"
+    elif 12 <= hour < 16:
+        return 'Afternoon'
+    elif 16 <= hour < 20:
+        return 'Peak Evening'
+    elif 20 <=  hour < 24:
+        return 'Night'
+    else:
+        return 'Mid Night'
+
+def classify_time_period(start_time):
+    hour = int(start_time.split(":")[0])
+
+    for i in range(0, 23, 2):
+        if i <= hour < i + 2:
+            return f'{i}:00-{i+1}:59'
+
+
+def legacy(times):
+    hour = pd.to_datetime(times.apply(clean_time), format="mixed").dt.hour
+    return (hour,
+            times.apply(classify_time_of_day),
+            times.apply(classify_time_period),
+            hour.apply(lambda x: 1 if (8 <= x <= 12 or 16 <= x <= 20) else 0))
+
+def vectorized(times):
+    seconds = gtfs_time.to_seconds(times)
+    hour = gtfs_time.clock_hour(seconds)
+    return (hour,
+            gtfs_time.time_of_day(seconds),
+            gtfs_time.time_period(seconds),
+            gtfs_time.is_peak_hours(hour))
+
+
+def main(path=Path('data/gtfs-nyc-2023.zip')):
+    feed = gk.read_feed(path, dist_units='km')
+    times = feed.stop_times['arrival_time'].str.replace(' ', '')
+    # clean_time cannot parse hours past 24, keep the legacy run to the times it handles
+    legacy_times = times[times.str.split(':').str[0].astype(int) <= 24]
+
+    start = time.perf_counter()
+    expected = legacy(legacy_times)
+    legacy_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    got = vectorized(times)
+    vectorized_s = time.perf_counter() - start
+
+    positions = times.index.get_indexer(legacy_times.index)
+    for old, new in zip(expected, got):
+        assert (old.to_numpy() == new[positions]).all()
+
+    print(f"{len(times):,} stop_times arrival times")
+    print(f"apply + to_datetime: {legacy_s * 1000:9.1f} ms")
+    print(f"gtfs_time:           {vectorized_s * 1000:9.1f} ms  ({legacy_s / vectorized_s:.0f}x)")
+
+
+if __name__ == '__main__':
+    main(*[Path(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,98 @@
+"""
+Name search latency: the str.contains scans of /routes/search over every route and
+over the trigram candidates only (same results), and the exact stop_name mask of
+get_stop_id against NameIndex, for every prefix of random stop and
+route names as they would be typed into an autocomplete box. Also reports how often
+the full name is ranked first once typed, and the stop names shared by several stops.
+
+    python benchmarks/bench_name_search.py [names]
+"""
+import re
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import numpy as np
+import pandas as pd
+
+import db_builder
+from name_search import NameIndex
+
+
+REGEX_SPECIAL = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+
+def percentiles(samples):
+    ms = np.array(samples) * 1000
+    return f"p50 {np.percentile(ms, 50):6.3f} ms  p95 {np.percentile(ms, 95):6.3f} ms  max {ms.max():6.3f} ms"
+
+
+def timed(queries, run):
+    samples, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(run(query))
+        samples.append(time.perf_counter() - start)
+    return samples, results
+
+
+def main(names=100):
+    names = int(names)
+
+    feed = db_builder.load_feed()
+    stops, routes = feed.stops, feed.routes
+
+    start = time.perf_counter()
+    stop_search = NameIndex(stops['stop_name'], stops['stop_id'])
+    route_search = NameIndex(pd.concat([routes['route_short_name'], routes['route_long_name']]),
+                             pd.concat([routes['route_id'], routes['route_id']]))
+    print(f"build: {(time.perf_counter() - start) * 1000:.0f} ms "
+          f"({len(stop_search):,} stop names for {len(stops):,} stops, {len(route_search)} route names)")
+    shared = sum(1 for keys in stop_search.keys if len(keys) > 1)
+    print(f"{shared:,} stop names belong to several stops (get_stop_id returned only the first)")
+
+    rng = np.random.default_rng(0)
+    stop_names = rng.choice(stops['stop_name'].dropna().unique(), names, replace=False).tolist()
+    typed = [name[:length] for name in stop_names for length in range(1, len(name) + 1)]
+
+    samples, _ = timed(stop_names, lambda name: stops.loc[stops['stop_name'] == name, 'stop_id'].to_numpy()[:1])
+    print(f"exact stop_name mask (previous get_stop_id)  {percentiles(samples)}")
+    samples, _ = timed(stop_names, stop_search.lookup)
+    print(f"NameIndex.lookup                             {percentiles(samples)}")
+
+    samples, results = timed(typed, lambda query: stop_search.search(query, limit=10))
+    print(f"stop autocomplete, {len(typed):,} keystrokes   {percentiles(samples)}")
+    top = sum(1 for name, result in zip(stop_names, timed(stop_names, lambda q: stop_search.search(q, limit=1))[1])
+              if result and result[0]['name'] == name)
+    print(f"full stop name ranked first: {top} / {len(stop_names)}")
+
+    route_names = routes['route_long_name'].dropna().tolist()
+    # Typed prefixes without regex metacharacters, which /routes/search matches against every route
+    typed = [name[:length] for name in route_names for length in range(1, len(name) + 1) if not REGEX_SPECIAL.search(name[:length])]
+
+    def contains(query):
+        return routes[(routes['route_short_name'].str.contains(query, case=False, na=False) |
+                       routes['route_long_name'].str.contains(query, case=False, na=False))]
+
+    route_rows = routes.groupby('route_id', sort=False).indices
+    names = routes[['route_short_name', 'route_long_name']].to_numpy()
+
+    def candidates_contains(query):
+        pattern = re.compile(query, re.IGNORECASE)
+        rows = sorted({row for route_id in route_search.substring_candidates(query) for row in route_rows.get(route_id, [])})
+        return routes.iloc[[row for row in rows if any(isinstance(name, str) and pattern.search(name) for name in names[row])]]
+
+    samples, expected = timed(typed, contains)
+    print(f"route str.contains scans, {len(typed):,} keystrokes  {percentiles(samples)}")
+    samples, found = timed(typed, candidates_contains)
+    assert all(a['route_id'].tolist() == b['route_id'].tolist() for a, b in zip(found, expected))
+    print(f"route trigram candidates + regex (current) {percentiles(samples)}")
+    samples, _ = timed(typed, lambda query: route_search.search(query, limit=10))
+    print(f"route NameIndex.search                          {percentiles(samples)}")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
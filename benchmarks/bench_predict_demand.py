@@ -0,0 +1,101 @@
+"""
+Throughput of demand prediction: the previous per-request path (joblib.load of the
+model and both encoders on every call), /predict_demand backed by the model registry,
+and /predict_demand_batch.
+
+    python benchmarks/bench_predict_demand.py [rows]
+"""
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import os
+
+os.chdir(ROOT)
+
+import joblib
+import numpy as np
+import pandas as pd
+
+import analysis_apis
+import gtfs_time
+from demand_forecast import DEMAND_FEATURES, DEMAND_INPUT_FIELDS
+
+
+# The per-request path before the model registry
+def legacy_predict(route_id, date, time, total_stops, avg_speed, avg_distance, avg_duration):
+    model = joblib.load("trained_model.pkl")
+    onehot_encoder = joblib.load("onehot_encoder.pkl")
+    target_encoder = joblib.load("target_encoder.pkl")
+
+    hour = int(time.split(":")[0])
+    input_data = {
+        'route_id': route_id,
+        'Date': pd.to_datetime(date, format="%Y%m%d"),
+        'time_of_day': gtfs_time.time_of_day(hour * 3600),
+        'is_peak_hours': int(gtfs_time.is_peak_hours(hour)),
+        'month': pd.to_datetime(date).month,
+        'day': pd.to_datetime(date).day,
+        'weekday': pd.to_datetime(date).weekday(),
+        'is_weekend': 1 if pd.to_datetime(date).weekday() >= 5 else 0,
+        'TotalStops': total_stops,
+        'AvgSpeed': avg_speed,
+        'AvgDistance': avg_distance,
+        'AvgDuration': avg_duration,
+    }
+    input_df = pd.DataFrame([input_data])
+    time_of_day_encoded = onehot_encoder.transform(input_df[['time_of_day']])
+    time_of_day_encoded_df = pd.DataFrame(time_of_day_encoded, columns=onehot_encoder.get_feature_names_out(['time_of_day']))
+    input_df = pd.concat([input_df, time_of_day_encoded_df], axis=1)
+    input_df.drop(columns=['Date', 'time_of_day'], inplace=True)
+    input_df = target_encoder.transform(input_df)
+    return int(model.predict(input_df[DEMAND_FEATURES])[0])
+
+
+def sample_rows(n, route_ids, seed=0):
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('2023-09-01', '2023-12-31').strftime('%Y%m%d')
+    return [{
+        'route_id': str(rng.choice(route_ids)),
+        'date': str(rng.choice(dates)),
+        'time': f"{rng.integers(0, 24)}:{rng.integers(0, 60):02d}:00",
+        'total_stops': int(rng.integers(5, 80)),
+        'avg_speed': float(rng.uniform(8, 30)),
+        'avg_distance': float(rng.uniform(2, 25)),
+        'avg_duration': float(rng.uniform(0.2, 1.5)),
+    } for _ in range(n)]
+
+
+def main(n=2000):
+    n = int(n)
+    analysis_apis.feed_loader.wait()
+    client = analysis_apis.app.test_client()
+    rows = sample_rows(n, analysis_apis.feed.routes['route_id'].to_numpy())
+    fields = DEMAND_INPUT_FIELDS
+
+    legacy_n = min(n, 200)
+    start = time.perf_counter()
+    legacy = [legacy_predict(*[row[field] for field in fields]) for row in rows[:legacy_n]]
+    legacy_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    single = [client.post('/predict_demand', json=row).get_json()['predicted_demand'] for row in rows]
+    single_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch = client.post('/predict_demand_batch', json={'rows': rows}).get_json()['predicted_demand']
+    batch_s = time.perf_counter() - start
+
+    assert single == batch and legacy == batch[:legacy_n]
+
+    print(f"{n:,} predictions")
+    print(f"joblib.load per request ({legacy_n} rows): {legacy_n / legacy_s:10.0f} rows/s")
+    print(f"/predict_demand, registry:          {n / single_s:10.0f} rows/s")
+    print(f"/predict_demand_batch:              {n / batch_s:10.0f} rows/s  ({single_s / batch_s:.0f}x per-row endpoint)")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,57 @@
+"""
+Latency of RAPTOR earliest-arrival and profile queries between random stop pairs.
+
+    python benchmarks/bench_raptor.py [path/to/gtfs.zip] [YYYYMMDD]
+"""
+import sys
+import time
+import random
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import numpy as np
+import gtfs_kit as gk
+
+from feed_index import FeedIndex
+from raptor import RaptorRouter
+
+
+def percentiles(samples):
+    ms = np.array(samples) * 1000
+    return f"p50 {np.percentile(ms, 50):6.1f} ms  p95 {np.percentile(ms, 95):6.1f} ms  max {ms.max():6.1f} ms"
+
+
+def main(path=Path('data/gtfs-nyc-2023.zip'), date='20231010', n=200):
+    feed = gk.read_feed(path, dist_units='km')
+
+    start = time.perf_counter()
+    router = RaptorRouter(FeedIndex(feed))
+    print(f"build: {time.perf_counter() - start:.2f} s ({len(router.pattern_stops):,} patterns, "
+          f"{len(router.footpath_targets):,} footpaths)")
+
+    random.seed(42)
+    stops = feed.stop_times['stop_id'].unique().tolist()
+    pairs = [(random.choice(stops), random.choice(stops), random.randint(6, 20) * 3600) for _ in range(n)]
+
+    router.earliest_arrival([pairs[0][0]], [pairs[0][1]], date, pairs[0][2])  # warm the date view
+
+    samples, found = [], 0
+    for source, target, departure in pairs:
+        start = time.perf_counter()
+        journeys = router.earliest_arrival([source], [target], date, departure)
+        samples.append(time.perf_counter() - start)
+        found += bool(journeys)
+    print(f"earliest arrival ({found}/{n} reachable): {percentiles(samples)}")
+
+    samples = []
+    for source, target, departure in pairs[:n // 4]:
+        start = time.perf_counter()
+        router.profile([source], [target], date, departure, departure + 3600)
+        samples.append(time.perf_counter() - start)
+    print(f"profile, 1 h window: {percentiles(samples)}")
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(Path(args[0]) if args else Path('data/gtfs-nyc-2023.zip'), *args[1:2])
@@ -0,0 +1,70 @@
+"""
+Route stats for the dates create_db asks for (September to December 2023, day 1 to 31
+of every month, so with invalid dates such as 20230931): one feed.compute_route_stats
+call (the previous builder) against db_builder.iter_route_stats serially and on a
+process pool. The rows must be the same.
+
+    python benchmarks/bench_route_stats.py [workers]
+"""
+import sys
+import time
+import warnings
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import pandas as pd
+
+import db_builder
+from feed_snapshot import gtfs_kit_feed
+
+
+DATES = [f"2023{month:02d}{day:02d}" for month in range(9, 13) for day in range(1, 32)]
+KEY = ['Date', 'route_id']
+
+
+def previous(feed, trip_stats):
+    with warnings.catch_warnings():
+        # gtfs_kit's compute_trip_activity inserts one column per date
+        warnings.simplefilter('ignore', pd.errors.PerformanceWarning)
+        route_stats = feed.compute_route_stats(trip_stats, dates=DATES)
+    return db_builder.route_stats_columns(route_stats)
+
+
+def streamed(feed, trip_stats, workers):
+    return pd.concat(list(db_builder.iter_route_stats(feed, trip_stats, DATES, workers=workers)))
+
+
+def main(workers=4):
+    workers = int(workers)
+
+    feed = db_builder.load_feed()
+    trip_stats = gtfs_kit_feed(feed).compute_trip_stats()
+
+    variants = {
+        'compute_route_stats (previous)': lambda: previous(feed, trip_stats),
+        'iter_route_stats, serial': lambda: streamed(feed, trip_stats, 1),
+        f'iter_route_stats, {workers} workers': lambda: streamed(feed, trip_stats, workers),
+    }
+
+    timings, results = {}, {}
+    for variant, compute in variants.items():
+        start = time.perf_counter()
+        results[variant] = compute()
+        timings[variant] = time.perf_counter() - start
+
+    expected = results['compute_route_stats (previous)']
+    expected = expected.sort_values(KEY).reset_index(drop=True)
+    for variant, route_stats in results.items():
+        route_stats = route_stats[expected.columns].sort_values(KEY).reset_index(drop=True)
+        pd.testing.assert_frame_equal(route_stats, expected, check_dtype=False)
+
+    print(f"{len(DATES)} requested dates, {expected['Date'].nunique()} with service, {len(expected):,} rows")
+    baseline = timings['compute_route_stats (previous)']
+    for variant, seconds in timings.items():
+        print(f"{variant:<36}{seconds:8.2f} s  {baseline / seconds:6.1f}x")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
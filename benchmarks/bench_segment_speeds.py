@@ -0,0 +1,102 @@
+"""
+Segment speed table: SegmentSpeeds (np.bincount over the FeedIndex hop arrays)
+against the same table built with a pandas shift + groupby over stop_times and
+trips, with the same distance fallback and short / same-name segments left out.
+Both must agree on the trips, seconds and kilometers of every (segment, route,
+hour). Then times /api/segment_speeds style queries on the built table.
+
+    python benchmarks/bench_segment_speeds.py [queries]
+"""
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import numpy as np
+import pandas as pd
+
+import db_builder
+import gtfs_time
+from feed_compact import expand_categoricals
+from feed_index import FeedIndex
+from name_search import normalize_name
+from segment_speeds import MIN_HOP_KM, MIN_SEGMENT_KM, SegmentSpeeds
+from spatial_index import haversine_meters
+
+
+def groupby_table(feed):
+    # Object id columns, as gk.read_feed gives them (a categorical groupby would span every category pair)
+    stop_times = expand_categoricals(feed.stop_times[['trip_id', 'stop_sequence', 'stop_id', 'arrival_time', 'departure_time',
+                                                      'shape_dist_traveled']]).sort_values(['trip_id', 'stop_sequence'])
+    stop_times['arrival'] = gtfs_time.to_seconds(stop_times['arrival_time'])
+    stop_times['departure'] = gtfs_time.to_seconds(stop_times['departure_time'])
+    # A trip's first stop is at distance 0 when the feed leaves it blank
+    stop_times['shape_dist_traveled'] = stop_times['shape_dist_traveled'].mask(
+        stop_times['trip_id'] != stop_times['trip_id'].shift(), stop_times['shape_dist_traveled'].fillna(0))
+
+    previous = stop_times.groupby('trip_id').shift()
+    hops = stop_times.assign(from_stop_id=previous['stop_id'], seconds=stop_times['arrival'] - previous['departure'],
+                             km=stop_times['shape_dist_traveled'] - previous['shape_dist_traveled'],
+                             hour=(previous['departure'] // 3600) % 24).dropna(subset=['from_stop_id'])
+    hops = hops.merge(expand_categoricals(feed.trips[['trip_id', 'route_id']]), on='trip_id')
+
+    stops = feed.stops.set_index('stop_id')
+    straight = haversine_meters(stops.loc[hops['from_stop_id'], 'stop_lat'].to_numpy(), stops.loc[hops['from_stop_id'], 'stop_lon'].to_numpy(),
+                                stops.loc[hops['stop_id'], 'stop_lat'].to_numpy(), stops.loc[hops['stop_id'], 'stop_lon'].to_numpy()) / 1000
+    hops['km'] = np.where(hops['km'] >= MIN_HOP_KM, hops['km'], straight)
+    names = feed.stops.set_index('stop_id')['stop_name'].map(normalize_name)
+    hops = hops[(hops['km'] >= MIN_SEGMENT_KM) &
+                (names.reindex(hops['from_stop_id']).to_numpy() != names.reindex(hops['stop_id']).to_numpy())]
+    return (hops.groupby(['from_stop_id', 'stop_id', 'route_id', 'hour'])
+            .agg(trips=('seconds', 'size'), seconds=('seconds', 'sum'), km=('km', 'sum')).reset_index())
+
+
+def main(queries=200):
+    queries = int(queries)
+
+    feed = db_builder.load_feed()
+    index = FeedIndex(feed)
+
+    start = time.perf_counter()
+    expected = groupby_table(feed)
+    baseline = time.perf_counter() - start
+    print(f"pandas shift + groupby        {baseline:6.2f} s  {len(expected):,} (segment, route, hour) groups")
+
+    start = time.perf_counter()
+    segments = SegmentSpeeds(index)
+    seconds = time.perf_counter() - start
+    print(f"SegmentSpeeds                 {seconds:6.2f} s  {len(segments):,} segments, "
+          f"{len(segments.group_segments):,} groups  {baseline / seconds:5.1f}x")
+
+    found = pd.DataFrame({
+        'from_stop_id': segments.stop_ids[segments.from_stops[segments.group_segments]],
+        'stop_id': segments.stop_ids[segments.to_stops[segments.group_segments]],
+        'route_id': segments.route_ids[segments.group_routes],
+        'hour': segments.group_hours.astype(float),
+        'trips': segments.group_trips, 'seconds': segments.group_seconds, 'km': segments.group_km,
+    }).groupby(['from_stop_id', 'stop_id', 'route_id', 'hour']).sum().reset_index()
+    merged = expected.merge(found, on=['from_stop_id', 'stop_id', 'route_id', 'hour'], how='outer', indicator=True)
+    assert (merged['_merge'] == 'both').all(), merged['_merge'].value_counts()
+    for column in ('trips', 'seconds', 'km'):
+        np.testing.assert_allclose(merged[f'{column}_x'], merged[f'{column}_y'], rtol=1e-9)
+
+    rng = np.random.default_rng(0)
+    route_ids = segments.route_ids.to_numpy()
+    variants = {
+        'whole network': lambda: segments.query(),
+        'whole network, by hour': lambda: segments.query(by_hour=True),
+        'one route': lambda: segments.query(route_ids=[rng.choice(route_ids)]),
+        'one hour': lambda: segments.query(hours=[int(rng.integers(6, 22))]),
+        'bbox (2 x 2 km)': lambda: segments.query(bbox=(43.03, -76.17, 43.05, -76.14)),
+    }
+    for variant, run in variants.items():
+        start = time.perf_counter()
+        for _ in range(queries):
+            run()
+        print(f"query {variant:<26}{(time.perf_counter() - start) * 1000 / queries:8.2f} ms")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
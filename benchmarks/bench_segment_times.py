@@ -0,0 +1,74 @@
+"""
+In-between-stop timings of /api/routes_between_stops: the previous per-request path
+(copy the trip's stop_times, parse its times, diff and fillna, then mask by
+stop_sequence) against slices of the hop arrays FeedIndex precomputes, for random
+trips and stops a quarter and three quarters of the way along each. Durations and
+distances must agree.
+
+    python benchmarks/bench_segment_times.py [samples]
+"""
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import numpy as np
+
+import db_builder
+import gtfs_time
+from feed_index import FeedIndex
+
+
+def previous(index, trip_id, start_stop_id, end_stop_id):
+    trip_stop_times = index.stop_times_for_trip(trip_id).copy()
+    arrivals = gtfs_time.to_seconds(trip_stop_times['arrival_time'])
+    trip_stop_times['time_diff'] = np.diff(arrivals, prepend=arrivals[:1]) / 60
+    trip_stop_times['shape_dist_traveled'] = trip_stop_times['shape_dist_traveled'].fillna(0)
+
+    start_sequence = trip_stop_times[trip_stop_times['stop_id'] == start_stop_id]['stop_sequence'].values[0]
+    end_sequence = trip_stop_times[trip_stop_times['stop_id'] == end_stop_id]['stop_sequence'].values[0]
+    in_between = trip_stop_times[(trip_stop_times['stop_sequence'] >= start_sequence) &
+                                 (trip_stop_times['stop_sequence'] <= end_sequence)]
+    # Summed over the segment, as the endpoint meant to
+    return (in_between['time_diff'].iloc[1:].sum() * 60,
+            in_between['shape_dist_traveled'].iloc[-1] - in_between['shape_dist_traveled'].iloc[0])
+
+
+def sliced(index, trip_id, start_stop_id, end_stop_id):
+    return index.segment_summary(*index.segment_rows(trip_id, start_stop_id, end_stop_id))
+
+
+def main(samples=2000):
+    samples = int(samples)
+
+    feed = db_builder.load_feed()
+    start = time.perf_counter()
+    index = FeedIndex(feed)
+    print(f"FeedIndex with hop arrays over {len(index.hop_seconds):,} stop_times: {time.perf_counter() - start:.2f} s")
+
+    rng = np.random.default_rng(0)
+    cases = []
+    for trip_id in rng.choice(index.trip_ids, min(samples, len(index.trip_ids)), replace=False):
+        stop_ids = index.stop_times_for_trip(trip_id)['stop_id'].to_numpy()
+        start_stop_id, end_stop_id = stop_ids[len(stop_ids) // 4], stop_ids[3 * len(stop_ids) // 4]
+        # Loop trips visit some stops twice; the previous path took the first visit of each
+        if len(stop_ids) >= 4 and start_stop_id != end_stop_id and len(set(stop_ids)) == len(stop_ids):
+            cases.append((trip_id, start_stop_id, end_stop_id))
+
+    print(f"{len(cases)} requests")
+    baseline = None
+    for variant, run in (('per-request diff (previous)', previous), ('hop array slices', sliced)):
+        start = time.perf_counter()
+        results = [run(index, *case) for case in cases]
+        per_request_ms = (time.perf_counter() - start) * 1000 / len(cases)
+        if baseline is None:
+            baseline, expected = per_request_ms, results
+        else:
+            np.testing.assert_allclose(np.array(results), np.array(expected), atol=1e-6)
+        print(f"{variant:<30}{per_request_ms:8.3f} ms  {baseline / per_request_ms:7.1f}x")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,78 @@
+"""
+Shape geometry of /api/routes_between_stops: filtering and sorting feed.shapes on every
+request (the previous endpoint) against ShapeIndex lookups, with the JSON size of the
+returned geometry for the full shape, clipped to the stop segment, simplified and
+polyline-encoded. Uses random trips and a start / end stop a quarter and three
+quarters of the way along each.
+
+    python benchmarks/bench_shapes.py [samples]
+"""
+import sys
+import json
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import numpy as np
+
+import db_builder
+from feed_index import FeedIndex
+from shape_index import ShapeIndex, encode_polyline
+
+
+def previous(feed, shape_id):
+    route_shape = feed.shapes[feed.shapes['shape_id'] == shape_id].sort_values(
+        by=['shape_pt_sequence']
+    ).reset_index(drop=True)
+    return route_shape[['shape_pt_lat', 'shape_pt_lon']].values.tolist()
+
+
+def main(samples=200):
+    samples = int(samples)
+
+    feed = db_builder.load_feed()
+    index = FeedIndex(feed)
+    start = time.perf_counter()
+    shapes = ShapeIndex(feed)
+    print(f"ShapeIndex over {len(shapes.coords):,} points of {len(shapes.shape_ranges)} shapes: "
+          f"{time.perf_counter() - start:.2f} s")
+
+    stops = feed.stops.set_index('stop_id')[['stop_lat', 'stop_lon']]
+    trip_shapes = feed.trips.set_index('trip_id')['shape_id']
+    rng = np.random.default_rng(0)
+    cases = []
+    for trip_id in rng.choice(feed.trips['trip_id'].to_numpy(), samples, replace=False):
+        stop_times = index.stop_times_for_trip(trip_id)
+        if len(stop_times) < 4 or trip_shapes[trip_id] not in shapes:
+            continue
+        ends = stop_times.iloc[[len(stop_times) // 4, 3 * len(stop_times) // 4]]
+        clip = [(stops.at[row.stop_id, 'stop_lat'], stops.at[row.stop_id, 'stop_lon'], row.shape_dist_traveled)
+                for row in ends.itertuples()]
+        cases.append((trip_shapes[trip_id], clip))
+
+    variants = {
+        'filter + sort (previous)': lambda shape_id, clip: previous(feed, shape_id),
+        'ShapeIndex, full': lambda shape_id, clip: shapes.geometry(shape_id).tolist(),
+        'clipped': lambda shape_id, clip: shapes.geometry(shape_id, None, *clip).tolist(),
+        'clipped, medium (10 m)': lambda shape_id, clip: shapes.geometry(shape_id, 10.0, *clip).tolist(),
+        'clipped, medium, polyline': lambda shape_id, clip: encode_polyline(shapes.geometry(shape_id, 10.0, *clip)),
+    }
+
+    print(f"{len(cases)} requests")
+    baseline_ms = baseline_bytes = None
+    for variant, geometry in variants.items():
+        start = time.perf_counter()
+        results = [geometry(shape_id, clip) for shape_id, clip in cases]
+        per_request_ms = (time.perf_counter() - start) * 1000 / len(cases)
+        mean_bytes = sum(len(json.dumps(result)) for result in results) / len(cases)
+        if baseline_ms is None:
+            baseline_ms, baseline_bytes = per_request_ms, mean_bytes
+            np.testing.assert_array_equal(np.array(results[0]), shapes.geometry(cases[0][0]))
+        print(f"{variant:<28}{per_request_ms:8.3f} ms  {baseline_ms / per_request_ms:7.1f}x"
+              f"{mean_bytes:10,.0f} bytes  {baseline_bytes / mean_bytes:6.1f}x smaller")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,90 @@
+"""
+Nearby-stop and bbox queries around random points of the feed: SpatialIndex against a
+haversine scan of every stop (and per-pair geopy.geodesic calls when geopy is
+installed, on fewer queries). Results must match the scan. Also times the footpath
+pairs the journey planner builds at startup.
+
+    python benchmarks/bench_spatial_index.py [queries] [radius_m]
+"""
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import numpy as np
+
+import db_builder
+from spatial_index import SpatialIndex, haversine_meters
+
+
+def scan(lats, lons, lat, lon, radius):
+    meters = haversine_meters(lat, lon, lats, lons)
+    found = np.flatnonzero(meters <= radius)
+    return found[np.argsort(meters[found], kind='stable')]
+
+
+def geodesic_scan(lats, lons, lat, lon, radius):
+    from geopy.distance import geodesic
+
+    meters = np.array([geodesic((lat, lon), (stop_lat, stop_lon)).meters for stop_lat, stop_lon in zip(lats, lons)])
+    found = np.flatnonzero(meters <= radius)
+    return found[np.argsort(meters[found], kind='stable')]
+
+
+def rate(queries, run):
+    start = time.perf_counter()
+    results = [run(*query) for query in queries]
+    seconds = time.perf_counter() - start
+    return results, len(queries) / seconds, seconds * 1e6 / len(queries)
+
+
+def main(queries=2000, radius=500):
+    queries, radius = int(queries), float(radius)
+
+    feed = db_builder.load_feed()
+    lats, lons = feed.stops['stop_lat'].to_numpy(), feed.stops['stop_lon'].to_numpy()
+
+    start = time.perf_counter()
+    index = SpatialIndex(lats, lons)
+    print(f"SpatialIndex over {len(index):,} stops: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    start = time.perf_counter()
+    i, _, _ = index.pairs_within(400)
+    print(f"footpath pairs within 400 m: {len(i):,} in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    # Points scattered around random stops
+    rng = np.random.default_rng(0)
+    picks = rng.integers(len(lats), size=queries)
+    points = list(zip(lats[picks] + rng.normal(0, 0.005, queries), lons[picks] + rng.normal(0, 0.005, queries)))
+
+    print(f"{queries} nearby queries, radius {radius:g} m")
+    expected, baseline, _ = rate(points, lambda lat, lon: scan(lats, lons, lat, lon, radius))
+    found, per_second, micros = rate(points, lambda lat, lon: index.within(lat, lon, radius)[0])
+    for a, b in zip(found, expected):
+        np.testing.assert_array_equal(a, b)
+    print(f"  haversine scan   {baseline:10,.0f} queries/s")
+    print(f"  SpatialIndex     {per_second:10,.0f} queries/s  {micros:6.1f} us  {per_second / baseline:5.1f}x")
+
+    try:
+        import geopy  # noqa: F401
+    except ImportError:
+        print("  geopy.geodesic   (geopy not installed)")
+    else:
+        sample = points[:10]
+        geodesic_found, geodesic_rate, _ = rate(sample, lambda lat, lon: geodesic_scan(lats, lons, lat, lon, radius))
+        print(f"  geopy.geodesic   {geodesic_rate:10,.2f} queries/s  ({len(sample)} queries)")
+
+    boxes = [(lat - 0.01, lon - 0.015, lat + 0.01, lon + 0.015) for lat, lon in points]
+    print(f"{queries} bbox queries (about 2.2 x 2.4 km)")
+    expected, baseline, _ = rate(boxes, lambda a, b, c, d: np.flatnonzero((lats >= a) & (lats <= c) & (lons >= b) & (lons <= d)))
+    found, per_second, micros = rate(boxes, index.in_bbox)
+    for a, b in zip(found, expected):
+        np.testing.assert_array_equal(a, b)
+    print(f"  mask scan        {baseline:10,.0f} queries/s")
+    print(f"  SpatialIndex     {per_second:10,.0f} queries/s  {micros:6.1f} us  {per_second / baseline:5.1f}x")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,129 @@
+"""
+Peak memory and time of the demand feature builder: the previous one-shot
+trips x service dates merge and groupby, demand_training.build_training_data in
+date chunks, and the same with the chunks spilled to Parquet. Each variant runs in
+a fresh process; X and y must be identical to the one-shot result.
+
+scale > 1 repeats the calendar that many times (shifted by whole 52-week blocks) to
+stand in for a longer feed.
+
+    python benchmarks/bench_training_features.py [chunk_dates] [scale]
+"""
+import sys
+import time
+import pickle
+import tempfile
+import tracemalloc
+import multiprocessing
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import pandas as pd
+
+import gtfs_time
+from demand_training import FEATURE_CHUNK_DATES, build_training_data, peak_rss_mb, patch_sklearn
+
+
+# The feature builder before chunking (load_preprocess_data)
+def legacy_training_data(trip_stats, trips, calendar_dates, routes):
+    patch_sklearn()
+    from sklearn.preprocessing import OneHotEncoder
+
+    trips_stats = trip_stats.copy()
+
+    start_seconds = gtfs_time.to_seconds(trips_stats['start_time'])
+    trips_stats['time_of_day'] = gtfs_time.time_of_day(start_seconds)
+    trips_stats['start_hour'] = gtfs_time.clock_hour(start_seconds)
+    trips_stats['end_hour'] = gtfs_time.clock_hour(gtfs_time.to_seconds(trips_stats['end_time']))
+    trips_stats['is_peak_hours'] = gtfs_time.is_peak_hours(trips_stats['start_hour'])
+
+    trips_stats1 = trips_stats.merge(trips[['trip_id', 'route_id', 'service_id']], left_on=['trip_id', 'route_id'], right_on=['trip_id', 'route_id'], how='left')
+    trips_stats1 = trips_stats1.merge(calendar_dates[['service_id', 'date']], on='service_id', how='left')
+    trips_stats1.dropna(subset=['date'], inplace=True)
+
+    trips_stats1['Date'] = pd.to_datetime(trips_stats1['date'], format='%Y%m%d')
+    trips_stats1['day'] = trips_stats1['Date'].dt.day
+    trips_stats1['month'] = trips_stats1['Date'].dt.month
+    trips_stats1['weekday'] = trips_stats1['Date'].dt.weekday
+    trips_stats1['is_weekend'] = trips_stats1['weekday'].apply(lambda x: 1 if x >= 5 else 0)
+    trips_stats1 = trips_stats1.merge(routes[['route_id', 'route_long_name']], on='route_id', how='left')
+
+    trips_demand = trips_stats1.groupby(by=['route_id', 'Date', 'month', 'day', 'weekday', 'is_weekend', 'time_of_day', 'is_peak_hours']).agg(
+        TotalTrips=('trip_id', 'nunique'),
+        TotalStops=('num_stops', 'median'),
+        AvgDuration=('duration', 'mean'),
+        AvgDistance=('distance', 'mean'),
+        AvgSpeed=('speed', 'mean'),
+    ).reset_index()
+
+    encoder = OneHotEncoder(sparse_output=False, handle_unknown='ignore')
+    encoded_data = encoder.fit_transform(trips_demand.drop(['TotalTrips'], axis=1)[['time_of_day']])
+    timeofday_encoded_df = pd.DataFrame(encoded_data, columns=encoder.get_feature_names_out(['time_of_day']))
+    trips_demand = pd.concat([trips_demand, timeofday_encoded_df], axis=1)
+
+    X = trips_demand.drop(columns=['TotalTrips', 'Date', 'time_of_day'])
+    y = trips_demand['TotalTrips']
+    return X, y, encoder
+
+
+def run_variant(inputs_path, variant, chunk_dates, spill_dir):
+    with open(inputs_path, 'rb') as f:
+        inputs = pickle.load(f)
+    patch_sklearn()
+    baseline = peak_rss_mb()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    if variant == 'one-shot':
+        X, y, _ = legacy_training_data(**inputs)
+    else:
+        del inputs['routes']
+        X, y, _ = build_training_data(**inputs, chunk_dates=chunk_dates,
+                                      spill_dir=spill_dir if variant == 'chunked + parquet' else None)
+    seconds = time.perf_counter() - start
+    traced_peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return X, y, seconds, traced_peak, baseline, peak_rss_mb()
+
+
+def repeat_calendar(calendar_dates, scale):
+    dates = pd.to_datetime(calendar_dates['date'], format='%Y%m%d')
+    return pd.concat([calendar_dates.assign(date=(dates + pd.Timedelta(weeks=52 * i)).dt.strftime('%Y%m%d'))
+                      for i in range(scale)], ignore_index=True)
+
+
+def main(chunk_dates=FEATURE_CHUNK_DATES, scale=1):
+    chunk_dates, scale = int(chunk_dates), int(scale)
+
+    import analysis_apis
+    analysis_apis.feed_loader.wait()
+    inputs = analysis_apis.training_inputs()
+    inputs['routes'] = analysis_apis.feed.routes[['route_id', 'route_long_name']].copy()
+    inputs['calendar_dates'] = repeat_calendar(inputs['calendar_dates'], scale)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        inputs_path = Path(tmp) / 'inputs.pkl'
+        with open(inputs_path, 'wb') as f:
+            pickle.dump(inputs, f)
+
+        context = multiprocessing.get_context('spawn')
+        results = {}
+        for variant in ['one-shot', 'chunked', 'chunked + parquet']:
+            # A new process per variant, so ru_maxrss is the peak of that variant alone
+            with context.Pool(1) as pool:
+                results[variant] = pool.apply(run_variant, (inputs_path, variant, chunk_dates, Path(tmp) / 'spill'))
+
+    X, y = results['one-shot'][:2]
+    print(f"{len(X):,} training rows, {chunk_dates} service dates per chunk")
+    print(f"{'variant':<20}{'time':>10}{'traced peak':>14}{'peak RSS':>12}{'over inputs':>14}")
+    for variant, (X_variant, y_variant, seconds, traced_peak, baseline, peak) in results.items():
+        pd.testing.assert_frame_equal(X_variant, X, check_exact=True)
+        pd.testing.assert_series_equal(y_variant, y, check_exact=True)
+        print(f"{variant:<20}{seconds:>8.2f} s{traced_peak:>11.0f} MB{peak:>9.0f} MB{peak - baseline:>11.0f} MB")
+    print("X and y identical across variants")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -1,21 +1,31 @@
 import sqlite3
 import os
+import argparse
 import datetime
+import itertools
 import pandas as pd
-import modin.pandas as pd
 
 from os import path
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-import gtfs_kit as gk
+from gtfs_kit.routes import compute_route_stats_0
 
-def create_db():
-  conn = sqlite3.connect("nyc_gtfs.db")
-  c = conn.cursor()
+import feed_snapshot
+import gtfs_time
+from analytics import PAYLOAD_BUILDERS
+from demand_forecast import build_forecasts, DEFAULT_FORECAST_DB
+from feed_index import active_services
+from snapshot_store import SnapshotStore, DEFAULT_SNAPSHOT_DB
+from stats_cache import StatsCache
 
-  # Creating the Routes table
-  c.execute('''
-  CREATE TABLE IF NOT EXISTS Routes (
+CHAT_DB = "nyc_gtfs.db"
+CHAT_DB_IMMUTABLE = "nyc_gtfs.ro.db"
+
+# Declared tables of nyc_gtfs.db, in load order
+CHAT_DB_SCHEMA = {
+  'Routes': '''
+  CREATE TABLE Routes (
       route_id TEXT PRIMARY KEY,
       agency_id TEXT,
       route_short_name TEXT,
@@ -24,11 +34,9 @@ def create_db():
       route_type INTEGER,
       route_color TEXT
   )
-  ''')
-
-  # Creating the Stops table
-  c.execute('''
-  CREATE TABLE IF NOT EXISTS Stops (
+  ''',
+  'Stops': '''
+  CREATE TABLE Stops (
       stop_id TEXT PRIMARY KEY,
       stop_code TEXT,
       stop_name TEXT,
@@ -42,11 +50,9 @@ def create_db():
       stop_timezone TEXT,
       wheelchair_boarding INTEGER
   )
-  ''')
-
-  # Creating the Trips table
-  c.execute('''
-  CREATE TABLE IF NOT EXISTS Trips (
+  ''',
+  'Trips': '''
+  CREATE TABLE Trips (
       trip_id TEXT PRIMARY KEY,
       route_id TEXT,
       service_id TEXT,
@@ -59,11 +65,9 @@ def create_db():
       bikes_allowed INTEGER,
       FOREIGN KEY (route_id) REFERENCES Routes (route_id)
   )
-  ''')
-
-  # Creating the Stop Times table
-  c.execute('''
-  CREATE TABLE IF NOT EXISTS StopTimes (
+  ''',
+  'StopTimes': '''
+  CREATE TABLE StopTimes (
       trip_id TEXT,
       arrival_time TEXT,
       departure_time TEXT,
@@ -77,11 +81,9 @@ def create_db():
       FOREIGN KEY (trip_id) REFERENCES Trips (trip_id),
       FOREIGN KEY (stop_id) REFERENCES Stops (stop_id)
   )
-  ''')
-
-  # Creating the Trip Stats table
-  c.execute('''
-  CREATE TABLE IF NOT EXISTS TripStats (
+  ''',
+  'TripStats': '''
+  CREATE TABLE TripStats (
       trip_id TEXT PRIMARY KEY,
       route_id TEXT,
       route_short_name TEXT,
@@ -98,14 +100,16 @@ def create_db():
       duration REAL,
       distance REAL,
       speed REAL,
+      start_hour INTEGER,
+      end_hour INTEGER,
+      time_of_day TEXT,
+      is_peak_hours INTEGER,
       FOREIGN KEY (trip_id) REFERENCES Trips (trip_id),
       FOREIGN KEY (route_id) REFERENCES Routes (route_id)
   )
-  ''')
-
-  # Creating the Route Stats table
-  c.execute('''
-  CREATE TABLE IF NOT EXISTS RouteStats (
+  ''',
+  'RouteStats': '''
+  CREATE TABLE RouteStats (
       route_id TEXT,
       route_short_name TEXT,
       route_type INTEGER,
@@ -128,87 +132,340 @@ def create_db():
       service_speed REAL,
       mean_trip_distance REAL,
       mean_trip_duration REAL,
-      date TEXT,
+      Date TEXT,
+      day INTEGER,
+      month INTEGER,
+      weekday INTEGER,
+      is_weekend INTEGER,
       FOREIGN KEY (route_id) REFERENCES Routes (route_id)
   )
-  ''')
-
-  path = Path('.\data\gtfs-nyc-2023.zip')
-  feed = gk.read_feed(path, dist_units='km')
-
-  def clean_feed_data(feed):
-    # Removing the space from the Arrival and Departure Time
-    feed.stop_times['arrival_time'] = feed.stop_times['arrival_time'].str.replace(' ', '')
-    feed.stop_times['departure_time'] = feed.stop_times['departure_time'].str.replace(' ', '')
-
-    routes_with_no_trips = []
-    for idx, row in feed.routes.iterrows():
-      if len(feed.trips[feed.trips['route_id'] == row['route_id']]) == 0:
-        routes_with_no_trips.append(row['route_id'])
-    # Removing all the routes with no trips i.e. routes_with_no_trips
-    feed.routes = feed.routes[~feed.routes['route_id'].isin(routes_with_no_trips)]
-
-    return feed
-
-  def clean_time(x):
-      date = datetime.datetime.today()
-      hr, min, sec = x.split(':')
-      if x.startswith('24'):
-          date = date + datetime.timedelta(days=1)
-          hr = '00'
-      x = f"{date.strftime('%Y-%m-%d')} {hr}:{min}:{sec}"
-      return x
-
-  feed = clean_feed_data(feed=feed)
-
-  # Write data to SQLite tables
-  def get_dates(start_month, end_month, start_date=1, end_date=30):
+  ''',
+}
+
+# Rows per executemany call of the bulk loader
+BULK_BATCH_ROWS = 50_000
+
+# Covering indexes for the lookups and joins the chat queries make
+CHAT_DB_INDEXES = {
+  'idx_stop_times_trip': 'StopTimes (trip_id, stop_sequence)',
+  'idx_stop_times_stop': 'StopTimes (stop_id, trip_id)',
+  'idx_trips_route': 'Trips (route_id, trip_id)',
+  'idx_stops_name': 'Stops (stop_name)',
+  'idx_trip_stats_route': 'TripStats (route_id)',
+  'idx_route_stats_route_date': 'RouteStats (route_id, Date)',
+}
+
+def clean_feed_data(feed):
+  # Removing the space from the Arrival and Departure Time
+  feed.stop_times['arrival_time'] = feed.stop_times['arrival_time'].str.replace(' ', '')
+  feed.stop_times['departure_time'] = feed.stop_times['departure_time'].str.replace(' ', '')
+
+  routes_with_no_trips = []
+  for idx, row in feed.routes.iterrows():
+    if len(feed.trips[feed.trips['route_id'] == row['route_id']]) == 0:
+      routes_with_no_trips.append(row['route_id'])
+  # Removing all the routes with no trips i.e. routes_with_no_trips
+  feed.routes = feed.routes[~feed.routes['route_id'].isin(routes_with_no_trips)]
+
+  return feed
+
+FEED_PATH = Path('data/gtfs-nyc-2023.zip')
+
+def load_feed(path=FEED_PATH):
+  # Cleaned feed, from its binary snapshot when the zip has not changed
+  return feed_snapshot.load_feed(path, clean=clean_feed_data)
+
+def feed_key(path=FEED_PATH):
+  # Key of the cleaned feed of path, the one its snapshot is stored under
+  return feed_snapshot.zip_digest(path, clean_feed_data)
+
+def optimize_db(conn):
+  """Indexes for the chat / join access paths, planner statistics and WAL mode."""
+  for name, target in CHAT_DB_INDEXES.items():
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {target}')
+  conn.execute('ANALYZE')
+  conn.execute('PRAGMA journal_mode=WAL')
+
+def immutable_copy(db_path=CHAT_DB, copy_path=CHAT_DB_IMMUTABLE):
+  """
+  Compacted read-only copy of the database (VACUUM INTO) in rollback journal mode, to
+  be opened with ?immutable=1: readers then take no locks and never check for writers.
+  """
+  if os.path.exists(copy_path):
+    os.chmod(copy_path, 0o644)
+    os.remove(copy_path)
+  conn = sqlite3.connect(db_path)
+  conn.execute('VACUUM INTO ?', (str(copy_path),))
+  conn.close()
+
+  conn = sqlite3.connect(copy_path)
+  conn.execute('PRAGMA journal_mode=DELETE')
+  conn.close()
+  os.chmod(copy_path, 0o444)
+  return copy_path
+
+def _sql_values(series):
+  """A column as a list of values sqlite3 binds directly (Python scalars; NaN binds as NULL)."""
+  if pd.api.types.is_datetime64_any_dtype(series):
+    # The text to_sql wrote for timestamps
+    series = series.dt.strftime('%Y-%m-%d %H:%M:%S')
+  if isinstance(series.dtype, pd.api.extensions.ExtensionDtype):
+    # Categoricals and nullable dtypes (pd.NA is not bindable)
+    series = series.astype(object).where(series.notna(), None)
+  return series.tolist()
+
+def bulk_insert(conn, name, df, batch_rows=BULK_BATCH_ROWS):
+  """Insert df into the declared table with executemany, batch_rows rows at a time, in the current transaction."""
+  columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{name}")')]
+  df = df.reindex(columns=columns)
+  rows = zip(*[_sql_values(df[column]) for column in columns])
+
+  sql = f'INSERT INTO "{name}" ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})'
+  while True:
+    batch = list(itertools.islice(rows, batch_rows))
+    if not batch:
+      break
+    conn.executemany(sql, batch)
+
+def _build_connection(db_path):
+  # No rollback journal and no fsync while building: the file is only renamed into place once complete
+  conn = sqlite3.connect(db_path, isolation_level=None)
+  conn.execute('PRAGMA journal_mode=OFF')
+  conn.execute('PRAGMA synchronous=OFF')
+  conn.execute('PRAGMA cache_size=-262144')
+  return conn
+
+def _load_part(part_path, name, df):
+  """Worker: load one table into its own database file."""
+  conn = _build_connection(part_path)
+  conn.execute(CHAT_DB_SCHEMA[name])
+  conn.execute('BEGIN')
+  bulk_insert(conn, name, df)
+  conn.execute('COMMIT')
+  conn.close()
+  return part_path
+
+def build_db(db_path, tables, workers=None, streams=None):
+  """
+  Write the tables ({name: DataFrame}) to a new nyc_gtfs.db at db_path, then index it.
+  With several workers each table is loaded into its own database file in parallel,
+  and the parts are merged into the main file through ATTACH.
+  streams ({name: iterable of DataFrames}) are appended chunk by chunk as they arrive.
+  """
+  build_path = f'{db_path}.build'
+  if os.path.exists(build_path):
+    os.remove(build_path)
+  workers = min(workers or os.cpu_count() or 1, len(tables))
+
+  conn = _build_connection(build_path)
+  for name in CHAT_DB_SCHEMA:
+    conn.execute(CHAT_DB_SCHEMA[name])
+
+  if workers == 1:
+    conn.execute('BEGIN')
+    for name, df in tables.items():
+      bulk_insert(conn, name, df)
+    conn.execute('COMMIT')
+  else:
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+      # Largest tables first, so they do not end up last on a busy worker
+      order = sorted(tables, key=lambda name: len(tables[name]), reverse=True)
+      parts = {name: pool.submit(_load_part, f'{build_path}.{name}', name, tables[name]) for name in order}
+      for name in tables:
+        part_path = parts[name].result()
+        conn.execute('ATTACH DATABASE ? AS part', (part_path,))
+        conn.execute(f'INSERT INTO main."{name}" SELECT * FROM part."{name}"')
+        conn.execute('DETACH DATABASE part')
+        os.remove(part_path)
+
+  for name, chunks in (streams or {}).items():
+    for df in chunks:
+      conn.execute('BEGIN')
+      bulk_insert(conn, name, df)
+      conn.execute('COMMIT')
+
+  # Indexes after the load: one sorted build per index instead of per-row updates
+  optimize_db(conn)
+  conn.close()
+  os.replace(build_path, db_path)
+  return db_path
+
+def service_groups(feed, dates):
+  """
+  The dates worth computing route stats for, grouped by the trips running on them:
+  [(trip_ids, dates)]. Invalid dates (20230931) and dates without service are left out.
+  """
+  groups = {}
+  for date in dates:
+    try:
+      datetime.datetime.strptime(date, '%Y%m%d')
+    except ValueError:
+      continue
+    services = frozenset(active_services(feed, date))
+    if services:
+      groups.setdefault(services, []).append(date)
+
+  result = []
+  for services, group_dates in groups.items():
+    trip_ids = feed.trips.loc[feed.trips['service_id'].isin(services), 'trip_id'].to_numpy()
+    if len(trip_ids):
+      result.append((trip_ids, group_dates))
+  return result
+
+def route_stats_columns(route_stats):
+  # Date parts of the RouteStats table, in place of gtfs_kit's YYYYMMDD date
+  route_stats['Date'] = pd.to_datetime(route_stats['date'], format='%Y%m%d')
+  route_stats['day'] = route_stats['Date'].dt.day
+  route_stats['month'] = route_stats['Date'].dt.month
+  route_stats['weekday'] = route_stats['Date'].dt.weekday
+  route_stats['is_weekend'] = (route_stats['weekday'] >= 5).astype(int)
+  return route_stats.drop(['date'], axis=1)
+
+# Per worker process: the trip stats the route stats are computed from
+_worker = {}
+
+def _init_route_stats_worker(trip_stats):
+  _worker['trip_stats'] = trip_stats
+
+def _route_stats_for_trips(trip_ids):
+  trip_stats = _worker['trip_stats']
+  return compute_route_stats_0(trip_stats[trip_stats['trip_id'].isin(trip_ids)])
+
+def iter_route_stats(feed, trip_stats, dates, workers=None):
+  """
+  RouteStats rows for each date the calendar serves, one DataFrame per date as soon
+  as it is computed (the same rows as feed.compute_route_stats(trip_stats, dates)).
+  Dates running the same trips share one computation; the distinct trip sets are
+  computed on a process pool that gets trip_stats once per worker. The pool starts
+  right away, so the dates are computed while the caller does other work.
+  """
+  groups = service_groups(feed, dates)
+  workers = min(workers or os.cpu_count() or 1, max(len(groups), 1))
+
+  def per_date(stats, group_dates):
+    print(f"Computed route stats for {len(group_dates)} dates ({group_dates[0]}..{group_dates[-1]})")
+    for date in group_dates:
+      yield route_stats_columns(stats.assign(date=date))
+
+  if workers == 1:
+    _init_route_stats_worker(trip_stats)
+    return (df for trip_ids, group_dates in groups for df in per_date(_route_stats_for_trips(trip_ids), group_dates))
+
+  pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_route_stats_worker, initargs=(trip_stats,))
+  futures = {pool.submit(_route_stats_for_trips, trip_ids): group_dates for trip_ids, group_dates in groups}
+
+  def results():
+    try:
+      for future in as_completed(futures):
+        yield from per_date(future.result(), futures[future])
+    finally:
+      pool.shutdown(cancel_futures=True)
+  return results()
+
+def create_db(db_path=CHAT_DB, workers=None):
+  feed = load_feed()
+
+  def get_dates(start_month, end_month, start_date=1, end_date=31):
     dates = []
     for month in range(start_month, end_month + 1):
         for day in range(start_date, end_date + 1):
             dates.append(f"2023{month:02d}{day:02d}")
     return dates
 
-  def classify_time_of_day(start_time):
-      hour = int(start_time.split(":")[0])
+  trip_stats = feed_snapshot.gtfs_kit_feed(feed).compute_trip_stats()
 
-      if 4 <= hour < 8:
-          return 'Morning'
-      elif 8 <= hour < 12:
-          return "Peak Morning"
-      elif 12 <= hour < 16:
-          return 'Afternoon'
-      elif 16 <= hour < 20:
-          return 'Peak Evening'
-      elif 20 <=  hour < 24:
-          return 'Night'
-      else:
-          return 'Mid Night'
+  route_stats = iter_route_stats(feed, trip_stats.copy(), get_dates(9, 12), workers=workers)
 
-  trip_stats = feed.compute_trip_stats()
+  start_seconds = gtfs_time.to_seconds(trip_stats['start_time'])
+  trip_stats['start_hour'] = gtfs_time.clock_hour(start_seconds)
+  trip_stats['end_hour'] = gtfs_time.clock_hour(gtfs_time.to_seconds(trip_stats['end_time']))
 
-  route_stats = feed.compute_route_stats(trip_stats, dates=get_dates(9, 12))
+  trip_stats['time_of_day'] = gtfs_time.time_of_day(start_seconds)
+  trip_stats['is_peak_hours'] = gtfs_time.is_peak_hours(trip_stats['start_hour'])
 
-  trip_stats['start_hour'] = pd.to_datetime(trip_stats['start_time'].apply(clean_time), format="mixed").dt.hour
-  trip_stats['end_hour'] = pd.to_datetime(trip_stats['end_time'].apply(clean_time), format="mixed").dt.hour
+  build_db(db_path, {
+    'Routes': feed.routes,
+    'Stops': feed.stops,
+    'Trips': feed.trips,
+    'StopTimes': feed_snapshot.expand_times(feed.stop_times),
+    'TripStats': trip_stats,
+  }, workers=workers, streams={'RouteStats': route_stats})
 
-  trip_stats['time_of_day'] = trip_stats['start_time'].apply(classify_time_of_day)
-  trip_stats['is_peak_hours'] = trip_stats['start_hour'].apply(lambda x: 1 if (8 <= x <= 12 or 16 <= x <= 20) else 0)
 
-  route_stats['Date'] = pd.to_datetime(route_stats['date'], format='%Y%m%d')
-  route_stats['day'] = route_stats['Date'].dt.day
-  route_stats['month'] = route_stats['Date'].dt.month
-  route_stats['weekday'] = route_stats['Date'].dt.weekday
-  route_stats['is_weekend'] = route_stats['weekday'].apply(lambda x: 1 if x >= 5 else 0)
-  route_stats = route_stats.drop(['date'], axis=1)
+def materialize_snapshots(feed=None, dates=None, db_path=DEFAULT_SNAPSHOT_DB, feed_path=FEED_PATH):
+  """
+  Precompute every per-date /api/* analytics payload into the snapshot store, so the
+  API serves them with a primary-key lookup instead of recomputing with gtfs_kit.
+  Dates default to every date the feed serves; dates without service are skipped
+  and keep falling back to live computation. The rows are keyed by the feed of
+  feed_path (feed, when given, must be its cleaned feed), so the API ignores them
+  once it loads another zip.
+  """
+  if feed is None:
+    feed = load_feed(feed_path)
+  key = feed_key(feed_path)
+  if dates is None:
+    dates = feed.get_dates()
+
+  stats = StatsCache(feed)
+  store = SnapshotStore(db_path)
+  conn = store.connect()
 
-  feed.routes[['route_id', 'agency_id', 'route_short_name', 'route_long_name', 'route_desc', 'route_type', 'route_color']].to_sql('Routes', conn, if_exists='replace', index=False)
-  feed.stops.to_sql('Stops', conn, if_exists='replace', index=False)
-  feed.trips.to_sql('Trips', conn, if_exists='replace', index=False)
-  feed.stop_times.to_sql('StopTimes', conn, if_exists='replace', index=False)
-  trip_stats.to_sql('TripStats', conn, if_exists='replace', index=False)
-  route_stats.to_sql('RouteStats', conn, if_exists='replace', index=False)
+  materialized = []
+  for date in dates:
+    if stats.route_stats(date).empty:
+      print(f"Skipping {date}: no service")
+      continue
 
+    rows = [(endpoint, date, build(feed, stats, date)) for endpoint, build in PAYLOAD_BUILDERS.items()]
+    store.put_many(conn, rows, key)
+    materialized.append(date)
+    print(f"Materialized {len(rows)} payloads for {date}")
 
-  conn.commit()
   conn.close()
+  return materialized
+
+def build_demand_forecasts(feed=None, dates=None, db_path=DEFAULT_FORECAST_DB, workers=None, rebuild=False):
+  """
+  Score the demand forecast grid (every route x date x time_of_day) with the trained
+  model. Only dates that are new or were scored by another model are rescored.
+  """
+  if feed is None:
+    feed = load_feed()
+  if dates is None:
+    dates = feed.get_dates()
+
+  stats = StatsCache(feed)
+  scored = build_forecasts(stats.trip_stats(), dates, db_path=db_path, workers=workers, rebuild=rebuild)
+  print(f"Scored {len(scored)} of {len(dates)} dates")
+  return scored
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Build nyc_gtfs.db, the precomputed analytics snapshots and the demand forecast grid.")
+  parser.add_argument('--materialize', action='store_true',
+                      help="precompute the per-date /api/* payloads instead of rebuilding nyc_gtfs.db")
+  parser.add_argument('--dates', nargs='+', metavar='YYYYMMDD',
+                      help="dates to materialize / forecast (default: every date the feed serves)")
+  parser.add_argument('--snapshot-db', default=DEFAULT_SNAPSHOT_DB,
+                      help="snapshot store to write to")
+  parser.add_argument('--forecast', action='store_true',
+                      help="score the demand forecast grid for the dates missing or scored by an older model")
+  parser.add_argument('--rebuild', action='store_true',
+                      help="with --forecast, rescore every date")
+  parser.add_argument('--workers', type=int, default=None,
+                      help="processes loading the nyc_gtfs.db tables and computing route stats, or with --forecast scoring dates (default: one per CPU)")
+  parser.add_argument('--forecast-db', default=DEFAULT_FORECAST_DB,
+                      help="forecast store to write to")
+  parser.add_argument('--immutable-copy', nargs='?', const=CHAT_DB_IMMUTABLE, default=None, metavar='PATH',
+                      help=f"also write a read-only compacted copy of nyc_gtfs.db (default {CHAT_DB_IMMUTABLE})")
+  args = parser.parse_args()
+
+  if args.materialize:
+    materialize_snapshots(dates=args.dates, db_path=args.snapshot_db)
+  elif args.forecast:
+    build_demand_forecasts(dates=args.dates, db_path=args.forecast_db, workers=args.workers, rebuild=args.rebuild)
+  else:
+    create_db(workers=args.workers)
+    if args.immutable_copy:
+      immutable_copy(CHAT_DB, args.immutable_copy)
@@ -0,0 +1,263 @@
+"""
+Demand forecasts for the whole route x date x time_of_day grid, precomputed with the
+trained model and served from an indexed SQLite table.
+
+The grid rows use the feature layout of demand_training.build_training_data: one row per route, date,
+time_of_day and is_peak_hours slice the route runs in, with the route's median stop
+count and mean duration / distance / speed over the trips of that slice. Dates are
+scored in chunks on a process pool; each date records the version of the model and
+inputs it was scored with, so a rebuild only rescores dates that are missing or were
+scored by an older model.
+"""
+import os
+import sqlite3
+import hashlib
+import datetime
+import functools
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+import gtfs_time
+from model_registry import current_artifacts
+
+
+DEFAULT_FORECAST_DB = os.getenv("DEMAND_FORECAST_DB", "demand_forecast.db")
+
+# Request fields of a demand prediction and the feature columns the model was trained on
+DEMAND_INPUT_FIELDS = ['route_id', 'date', 'time', 'total_stops', 'avg_speed', 'avg_distance', 'avg_duration']
+DEMAND_FEATURES = ['route_id', 'month', 'day', 'weekday', 'is_weekend', 'is_peak_hours',
+                   'TotalStops', 'AvgDuration', 'AvgDistance', 'AvgSpeed',
+                   'time_of_day_Afternoon', 'time_of_day_Mid Night', 'time_of_day_Morning',
+                   'time_of_day_Night', 'time_of_day_Peak Evening', 'time_of_day_Peak Morning']
+PROFILE_COLUMNS = ['route_id', 'time_of_day', 'is_peak_hours', 'total_stops', 'avg_duration', 'avg_distance', 'avg_speed']
+
+
+def encode_features(rows, onehot_encoder, target_encoder):
+    """
+    Model features for a DataFrame with route_id, date (YYYYMMDD), time_of_day,
+    is_peak_hours, total_stops, avg_duration, avg_distance and avg_speed columns.
+    """
+    dates = pd.to_datetime(rows['date'].astype(str), format="%Y%m%d")
+
+    input_df = pd.DataFrame({
+        'route_id': rows['route_id'].to_numpy(),
+        'month': dates.dt.month.to_numpy(),
+        'day': dates.dt.day.to_numpy(),
+        'weekday': dates.dt.weekday.to_numpy(),
+        'is_weekend': (dates.dt.weekday >= 5).astype(int).to_numpy(),
+        'is_peak_hours': rows['is_peak_hours'].to_numpy(),
+        'TotalStops': rows['total_stops'].to_numpy(),
+        'AvgDuration': rows['avg_duration'].to_numpy(),
+        'AvgDistance': rows['avg_distance'].to_numpy(),
+        'AvgSpeed': rows['avg_speed'].to_numpy(),
+    })
+
+    # Encode time_of_day using the saved onehot encoder
+    time_of_day_encoded_df = pd.DataFrame(onehot_encoder.transform(rows[['time_of_day']]),
+                                          columns=onehot_encoder.get_feature_names_out(['time_of_day']))
+    input_df = pd.concat([input_df, time_of_day_encoded_df], axis=1)
+
+    # Encode route_id using the saved target encoder
+    input_df = target_encoder.transform(input_df[DEMAND_FEATURES])
+
+    return input_df[DEMAND_FEATURES]
+
+def demand_profiles(trip_stats):
+    """Per route, time_of_day and is_peak_hours slice: the trip features the model takes."""
+    start_seconds = gtfs_time.to_seconds(trip_stats['start_time'])
+    trips = pd.DataFrame({
+        'route_id': trip_stats['route_id'].to_numpy(),
+        'time_of_day': gtfs_time.time_of_day(start_seconds),
+        'is_peak_hours': gtfs_time.is_peak_hours(gtfs_time.clock_hour(start_seconds)),
+        'num_stops': trip_stats['num_stops'].to_numpy(),
+        'duration': trip_stats['duration'].to_numpy(),
+        'distance': trip_stats['distance'].to_numpy(),
+        'speed': trip_stats['speed'].to_numpy(),
+    })
+    profiles = trips.groupby(['route_id', 'time_of_day', 'is_peak_hours']).agg(
+        total_stops=('num_stops', 'median'),
+        avg_duration=('duration', 'mean'),
+        avg_distance=('distance', 'mean'),
+        avg_speed=('speed', 'mean'),
+    ).reset_index()
+    return profiles[PROFILE_COLUMNS]
+
+def forecast_grid(profiles, dates):
+    """Every profile row crossed with every date."""
+    grid = profiles.iloc[np.tile(np.arange(len(profiles)), len(dates))].reset_index(drop=True)
+    grid.insert(1, 'date', np.repeat(np.asarray(dates, dtype=object), len(profiles)))
+    return grid
+
+@functools.lru_cache(maxsize=8)
+def _file_digest(path, mtime_ns, size):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def model_version(paths=None):
+    """Short hash of the model and encoder files (re-hashed only when one of them changes)."""
+    if paths is None:
+        paths = current_artifacts()
+    digest = hashlib.sha256()
+    for name in sorted(paths):
+        stat = os.stat(paths[name])
+        digest.update(_file_digest(paths[name], stat.st_mtime_ns, stat.st_size).encode())
+    return digest.hexdigest()[:16]
+
+def profiles_version(profiles):
+    """Short hash of the grid inputs, so a changed feed also triggers rescoring."""
+    return hashlib.sha256(pd.util.hash_pandas_object(profiles, index=False).to_numpy().tobytes()).hexdigest()[:16]
+
+
+class ForecastStore:
+    """
+    Scored grid rows, keyed by (route_id, date, time_of_day, is_peak_hours), with a
+    (date, route_id) index for date range queries across routes. DemandForecastDates
+    records which model / input version each date was scored with.
+    """
+
+    def __init__(self, db_path=DEFAULT_FORECAST_DB):
+        self.db_path = db_path
+        self._local = threading.local()
+
+    def _reader(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def connect(self):
+        """Writable connection with the forecast schema in place."""
+        conn = sqlite3.connect(self.db_path)
+        conn.executescript('''
+        CREATE TABLE IF NOT EXISTS DemandForecast (
+            route_id TEXT NOT NULL,
+            date TEXT NOT NULL,
+            time_of_day TEXT NOT NULL,
+            is_peak_hours INTEGER NOT NULL,
+            predicted_demand INTEGER NOT NULL,
+            total_stops REAL,
+            avg_duration REAL,
+            avg_distance REAL,
+            avg_speed REAL,
+            PRIMARY KEY (route_id, date, time_of_day, is_peak_hours)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_demand_forecast_date ON DemandForecast (date, route_id);
+        CREATE TABLE IF NOT EXISTS DemandForecastDates (
+            date TEXT PRIMARY KEY,
+            model_version TEXT NOT NULL,
+            inputs_version TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        ) WITHOUT ROWID;
+        ''')
+        return conn
+
+    def date_versions(self, conn):
+        """date -> (model_version, inputs_version) of the scored dates."""
+        rows = conn.execute("SELECT date, model_version, inputs_version FROM DemandForecastDates").fetchall()
+        return {date: (model, inputs) for date, model, inputs in rows}
+
+    def put_dates(self, conn, forecasts, versions):
+        """Replace the rows of the dates in forecasts and record their versions, in one transaction."""
+        dates = sorted(set(forecasts['date']))
+        created_at = datetime.datetime.now().isoformat(timespec='seconds')
+        columns = ['route_id', 'date', 'time_of_day', 'is_peak_hours', 'predicted_demand',
+                   'total_stops', 'avg_duration', 'avg_distance', 'avg_speed']
+        with conn:
+            conn.executemany("DELETE FROM DemandForecast WHERE date = ?", [(date,) for date in dates])
+            conn.executemany(
+                f"INSERT INTO DemandForecast ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                forecasts[columns].itertuples(index=False, name=None),
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO DemandForecastDates (date, model_version, inputs_version, created_at) VALUES (?, ?, ?, ?)",
+                [(date, *versions, created_at) for date in dates],
+            )
+
+    def query(self, start_date, end_date, route_id=None):
+        """Forecast rows for start_date..end_date (inclusive), optionally for one route."""
+        if not os.path.exists(self.db_path):
+            return []
+        sql = "SELECT * FROM DemandForecast WHERE date BETWEEN ? AND ?"
+        params = [start_date, end_date]
+        if route_id is not None:
+            sql += " AND route_id = ?"
+            params.append(route_id)
+        sql += " ORDER BY date, route_id, time_of_day, is_peak_hours"
+        try:
+            return [dict(row) for row in self._reader().execute(sql, params)]
+        except sqlite3.Error:
+            return []
+
+    def scored_versions(self, start_date, end_date):
+        """Distinct model versions the dates in the range were scored with."""
+        if not os.path.exists(self.db_path):
+            return []
+        try:
+            rows = self._reader().execute(
+                "SELECT DISTINCT model_version FROM DemandForecastDates WHERE date BETWEEN ? AND ?",
+                (start_date, end_date),
+            ).fetchall()
+        except sqlite3.Error:
+            return []
+        return [row[0] for row in rows]
+
+
+# Per worker process: the model and encoders, and the grid profiles
+_worker = {}
+
+def _init_worker(paths, profiles):
+    import joblib
+
+    _worker.update({name: joblib.load(path) for name, path in paths.items()})
+    _worker['profiles'] = profiles
+
+def _score_dates(dates):
+    grid = forecast_grid(_worker['profiles'], dates)
+    features = encode_features(grid, _worker['onehot_encoder'], _worker['target_encoder'])
+    grid['predicted_demand'] = np.asarray(_worker['model'].predict(features)).astype(int)
+    return grid
+
+def build_forecasts(trip_stats, dates, db_path=DEFAULT_FORECAST_DB, workers=None, chunk_dates=28,
+                    paths=None, rebuild=False):
+    """
+    Score the grid for the dates that are missing from the store or were scored with
+    another model / other inputs (all of them with rebuild). Returns the dates scored.
+    """
+    paths = paths or current_artifacts()
+    profiles = demand_profiles(trip_stats)
+    versions = (model_version(paths), profiles_version(profiles))
+
+    store = ForecastStore(db_path)
+    conn = store.connect()
+    scored = store.date_versions(conn)
+    pending = sorted(date for date in dates if rebuild or scored.get(date) != versions)
+    chunks = [pending[i:i + chunk_dates] for i in range(0, len(pending), chunk_dates)]
+    if not chunks:
+        conn.close()
+        return pending
+
+    # Each worker pays for importing daal4py and unpickling the model, only worth it for several chunks
+    workers = min(workers or os.cpu_count() or 1, len(chunks))
+    if workers == 1:
+        _init_worker(paths, profiles)
+        for chunk in chunks:
+            store.put_dates(conn, _score_dates(chunk), versions)
+            print(f"Scored {len(chunk)} dates ({chunk[0]}..{chunk[-1]})")
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(paths, profiles)) as pool:
+            futures = {pool.submit(_score_dates, chunk): chunk for chunk in chunks}
+            for future in as_completed(futures):
+                chunk = futures[future]
+                store.put_dates(conn, future.result(), versions)
+                print(f"Scored {len(chunk)} dates ({chunk[0]}..{chunk[-1]})")
+
+    conn.close()
+    return pending
@@ -0,0 +1,427 @@
+"""
+Demand model training, run as background jobs so /train_model never blocks serving.
+
+TrainingJobs runs each job in a worker process. The job builds the training data
+from the trip stats, fits the XGBoost model and writes the model and both encoders
+to a fresh models/<version>/ directory. Once the job succeeds, the version is made
+live with one atomic rename of models/current.json (see model_registry), so
+/predict_demand never sees a half-written or mixed set of artifacts.
+
+Progress is written to the job directory. Cancellation is cooperative: the worker
+checks for a `cancel` file between stages and after every boosting round.
+"""
+import os
+import sys
+import json
+import uuid
+import hashlib
+import shutil
+import datetime
+import functools
+import collections
+import threading
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import gtfs_time
+from feature_store import FeatureStore
+from model_registry import DEMAND_ARTIFACTS, MODELS_DIR, CURRENT_MODEL_FILE, current_artifacts, publish_artifacts
+
+
+N_ESTIMATORS = 200
+
+# Training rows are one per route, service date, time_of_day and peak flag
+DEMAND_KEYS = ['route_id', 'Date', 'month', 'day', 'weekday', 'is_weekend', 'time_of_day', 'is_peak_hours']
+
+# Service dates expanded per batch by the feature builder, and whether jobs spill the batches to Parquet
+FEATURE_CHUNK_DATES = int(os.getenv('TRAINING_CHUNK_DATES', '28'))
+FEATURE_SPILL = os.getenv('TRAINING_SPILL_PARQUET') == '1'
+FEATURE_STORE = os.getenv('TRAINING_FEATURE_STORE', '1') == '1'
+
+# Finished model versions kept under models/ besides the live one
+KEEP_MODEL_VERSIONS = int(os.getenv('TRAINING_KEEP_VERSIONS', '3'))
+
+# Part of every feature store key: bump when demand_aggregates changes what it computes
+FEATURES_VERSION = 1
+
+
+class TrainingCancelled(Exception):
+    pass
+
+
+@functools.cache
+def patch_sklearn():
+    """Apply the scikit-learn-intelex patches once, before sklearn is first used."""
+    from sklearnex import patch_sklearn as sklearnex_patch
+    sklearnex_patch()
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB (None where resource is unavailable)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return round(peak / 2**20 if sys.platform == 'darwin' else peak / 2**10, 1)
+
+def trip_features(trip_stats, trips):
+    """Per trip: route, service, time of day, peak flag and the stats the demand groups aggregate."""
+    start_seconds = gtfs_time.to_seconds(trip_stats['start_time'])
+    features = trip_stats[['trip_id', 'route_id', 'num_stops', 'duration', 'distance', 'speed']].copy()
+    features['time_of_day'] = gtfs_time.time_of_day(start_seconds)
+    features['is_peak_hours'] = gtfs_time.is_peak_hours(gtfs_time.clock_hour(start_seconds))
+
+    return features.merge(trips[['trip_id', 'route_id', 'service_id']], on=['trip_id', 'route_id'], how='left')
+
+def demand_aggregates(features, calendar_dates):
+    """
+    TotalTrips and the trip stats per DEMAND_KEYS group for the service dates in
+    calendar_dates. Groups are per date, so batches of dates aggregate independently.
+    """
+    trips_dates = features.merge(calendar_dates[['service_id', 'date']], on='service_id', how='inner')
+
+    trips_dates['Date'] = pd.to_datetime(trips_dates['date'], format='%Y%m%d')
+    trips_dates['day'] = trips_dates['Date'].dt.day
+    trips_dates['month'] = trips_dates['Date'].dt.month
+    trips_dates['weekday'] = trips_dates['Date'].dt.weekday
+    trips_dates['is_weekend'] = (trips_dates['weekday'] >= 5).astype(int)
+
+    return trips_dates.groupby(by=DEMAND_KEYS).agg(
+        TotalTrips=('trip_id', 'nunique'),
+        TotalStops=('num_stops', 'median'),
+        AvgDuration=('duration', 'mean'),
+        AvgDistance=('distance', 'mean'),
+        AvgSpeed=('speed', 'mean'),
+    ).reset_index()
+
+def store_keys(features, calendar_dates):
+    """
+    (partition, date -> key) for the feature store: the partition hashes the trip
+    feature rows once, and the key of a date the services running on it, so a date's
+    aggregates are reused until the trips or its services change.
+    """
+    digest = hashlib.blake2b(f'v{FEATURES_VERSION}'.encode(), digest_size=8)
+    digest.update(pd.util.hash_pandas_object(features, index=False).to_numpy().tobytes())
+    partition = digest.hexdigest()
+
+    keys = {}
+    for date, services in calendar_dates.groupby('date', sort=False)['service_id']:
+        services = sorted(services.astype(str))
+        keys[date] = hashlib.blake2b('\0'.join(services).encode(), digest_size=8).hexdigest()
+    return partition, keys
+
+def iter_demand_chunks(features, calendar_dates, dates, chunk_dates=FEATURE_CHUNK_DATES):
+    """(dates, demand_aggregates) for chunk_dates of the given service dates at a time."""
+    for i in range(0, len(dates), chunk_dates):
+        batch = dates[i:i + chunk_dates]
+        yield batch, demand_aggregates(features, calendar_dates[calendar_dates['date'].isin(batch)])
+
+def build_training_data(trip_stats, trips, calendar_dates, chunk_dates=FEATURE_CHUNK_DATES, spill_dir=None,
+                        feature_store=None):
+    """
+    Daily demand per route, time of day and peak flag (TotalTrips) with the trip
+    features the model takes. Returns X, y and the fitted time_of_day onehot encoder.
+
+    Service dates are expanded and aggregated chunk_dates at a time, so only one batch
+    of the trips x dates rows is in memory. With spill_dir the aggregated chunks are
+    written there as Parquet and read back at the end. With a feature_store only the
+    dates it does not have yet are aggregated and added to it, and the rest is read
+    back from it (spill_dir is not needed then).
+    """
+    patch_sklearn()
+    from sklearn.preprocessing import OneHotEncoder
+
+    features = trip_features(trip_stats, trips)
+    calendar_dates = calendar_dates[['service_id', 'date']].dropna(subset=['date'])
+    dates = sorted(calendar_dates['date'].unique())
+
+    if feature_store is not None:
+        partition, keys = store_keys(features, calendar_dates)
+        stored, missing = feature_store.load(partition, keys)
+        chunks = [chunk for _, chunk in iter_demand_chunks(features, calendar_dates, sorted(missing), chunk_dates)]
+        if missing:
+            feature_store.add(partition, {date: keys[date] for date in missing},
+                              pd.concat(chunks, ignore_index=True))
+        if stored is not None:
+            chunks.append(stored)
+    else:
+        chunks = (chunk for _, chunk in iter_demand_chunks(features, calendar_dates, dates, chunk_dates))
+        if spill_dir is not None:
+            spill_dir = Path(spill_dir)
+            spill_dir.mkdir(parents=True, exist_ok=True)
+            spilled = []
+            for i, chunk in enumerate(chunks):
+                spilled.append(spill_dir / f'demand-{i:05d}.parquet')
+                chunk.to_parquet(spilled[-1], index=False)
+            chunks = (pd.read_parquet(path) for path in spilled)
+
+    # Same row order as one groupby over all dates
+    trips_demand = pd.concat([chunk for chunk in chunks if len(chunk)], ignore_index=True)
+    trips_demand = trips_demand.sort_values(DEMAND_KEYS).reset_index(drop=True)
+
+    encoder = OneHotEncoder(sparse_output=False, handle_unknown='ignore')
+    encoded_data = encoder.fit_transform(trips_demand[['time_of_day']])
+
+    timeofday_encoded_df = pd.DataFrame(encoded_data, columns=encoder.get_feature_names_out(['time_of_day']))
+    trips_demand = pd.concat([trips_demand, timeofday_encoded_df], axis=1)
+
+    X = trips_demand.drop(columns=['TotalTrips', 'Date', 'time_of_day'])
+    y = trips_demand['TotalTrips']
+
+    return X, y, encoder
+
+def fit_model(X, y, on_round=None):
+    """
+    Fit the target encoder and XGBoost on a train split and convert the model to
+    daal4py. on_round(round, total) is called after every boosting round.
+    Returns (d4p_model, target_encoder, mse, mae, feature_importances_df).
+    """
+    patch_sklearn()
+    from sklearn.model_selection import train_test_split
+    from sklearn.metrics import mean_absolute_error, mean_squared_error
+    import category_encoders as ce
+    from xgboost import XGBRegressor
+    from xgboost.callback import TrainingCallback
+    import daal4py as d4p
+
+    class RoundCallback(TrainingCallback):
+        def after_iteration(self, model, epoch, evals_log):
+            if on_round is not None:
+                on_round(epoch + 1, N_ESTIMATORS)
+            return False
+
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+
+    target_encoder = ce.TargetEncoder(cols=['route_id'])
+
+    X_train = target_encoder.fit_transform(X_train, y_train)
+    X_test = target_encoder.transform(X_test)
+
+    xgb_model = XGBRegressor(n_estimators=N_ESTIMATORS, random_state=42, callbacks=[RoundCallback()])
+    xgb_model.fit(X_train, y_train)
+
+    d4p_model = d4p.mb.convert_model(xgb_model)
+
+    y_pred_d4p = d4p_model.predict(X_test)
+
+    mse_d4p = mean_squared_error(y_test, y_pred_d4p)
+    mae_d4p = mean_absolute_error(y_test, y_pred_d4p)
+
+    feature_importances = xgb_model.feature_importances_
+    feature_importances_df = pd.DataFrame({'Feature': X_train.columns, 'Importance': feature_importances.round(4)})
+    feature_importances_df.sort_values(by=['Importance'], ascending=False, inplace=True)
+
+    return d4p_model, target_encoder, mse_d4p, mae_d4p, feature_importances_df
+
+
+def _write_json(path, payload):
+    tmp = Path(f'{path}.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(payload, f)
+    os.replace(tmp, path)
+
+def run_training_job(job_dir, inputs):
+    """
+    Worker process entry point: train on inputs (trip_stats, trips and calendar_dates
+    frames) and write the artifacts, progress.json and metrics.json to job_dir.
+    """
+    import joblib
+
+    job_dir = Path(job_dir)
+
+    def report(stage, progress):
+        if (job_dir / 'cancel').exists():
+            raise TrainingCancelled()
+        _write_json(job_dir / 'progress.json', {'stage': stage, 'progress': round(progress, 3)})
+
+    report('building training data', 0.0)
+    feature_store = FeatureStore() if FEATURE_STORE else None
+    X, y, onehot_encoder = build_training_data(**inputs, spill_dir=job_dir / 'features' if FEATURE_SPILL else None,
+                                               feature_store=feature_store)
+    shutil.rmtree(job_dir / 'features', ignore_errors=True)
+
+    report('fitting', 0.2)
+    model, target_encoder, mse, mae, feature_importances = fit_model(
+        X, y, on_round=lambda done, total: report('fitting', 0.2 + 0.7 * done / total))
+
+    report('writing artifacts', 0.95)
+    for name, artifact in [('model', model), ('onehot_encoder', onehot_encoder), ('target_encoder', target_encoder)]:
+        joblib.dump(artifact, job_dir / DEMAND_ARTIFACTS[name])
+
+    result = {
+        'mse': float(mse),
+        'mae': float(mae),
+        'feature_importance': feature_importances.to_dict(orient='records'),
+        'rows': len(X),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    if feature_store is not None:
+        result['feature_dates'] = {'reused': feature_store.hits, 'computed': feature_store.misses}
+    _write_json(job_dir / 'metrics.json', result)
+    report('done', 1.0)
+    return result
+
+
+class TrainingJobs:
+    """
+    Training jobs by id. Jobs run one at a time in a separate (spawned) process;
+    status() reports queued / running / cancelling / succeeded / failed / cancelled.
+    Queued jobs wait here and are handed to the pool only when a worker is free, so
+    cancelling one never races the pool starting it. After a job succeeds, the
+    version directories of failed runs and all but the last KEEP_MODEL_VERSIONS
+    finished ones (besides the live one) are removed.
+    """
+
+    def __init__(self, models_dir=MODELS_DIR, max_workers=1, on_success=None, keep_versions=KEEP_MODEL_VERSIONS):
+        self.models_dir = Path(models_dir)
+        self.max_workers = max_workers
+        self.on_success = on_success
+        self.keep_versions = keep_versions
+        self._jobs = {}
+        self._queue = collections.deque()  # (job, inputs) not handed to the pool yet
+        self._running = 0
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        if self._pool is None:
+            # spawn: the server process has threads (feed loader, request handlers) that fork would copy mid-flight
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    def submit(self, inputs):
+        """Queue a training job on inputs (see run_training_job); returns its id."""
+        job_id = uuid.uuid4().hex[:12]
+        version = f"{datetime.datetime.now().strftime('%Y%m%dT%H%M%S')}-{job_id}"
+        job_dir = self.models_dir / version
+
+        job = {
+            'job_id': job_id,
+            'version': version,
+            'dir': job_dir,
+            'status': 'queued',
+            'submitted_at': datetime.datetime.now().isoformat(timespec='seconds'),
+            'finished_at': None,
+            'result': None,
+            'error': None,
+            'future': None,
+        }
+        with self._lock:
+            job_dir.mkdir(parents=True)
+            self._jobs[job_id] = job
+            self._queue.append((job, inputs))
+        self._start_queued()
+        return job_id
+
+    def _start_queued(self):
+        """Hand queued jobs to the pool while it has a free worker."""
+        started = []
+        with self._lock:
+            while self._queue and self._running < self.max_workers:
+                job, inputs = self._queue.popleft()
+                job['future'] = self._executor().submit(run_training_job, str(job['dir']), inputs)
+                self._running += 1
+                started.append(job)
+        for job in started:
+            job['future'].add_done_callback(lambda future, job=job: self._finish(job, future))
+
+    def _finish(self, job, future):
+        with self._lock:
+            self._running -= 1
+        try:
+            self._record(job, future)
+        finally:
+            self._start_queued()
+
+    def _record(self, job, future):
+        finished_at = datetime.datetime.now().isoformat(timespec='seconds')
+        if future.cancelled():
+            job.update(status='cancelled', finished_at=finished_at)
+        else:
+            error = future.exception()
+            if error is None:
+                # Swap the new version in for /predict_demand
+                publish_artifacts(job['version'], self.models_dir / CURRENT_MODEL_FILE.name)
+                job.update(status='succeeded', result=future.result(), finished_at=finished_at)
+                self.prune()
+                if self.on_success is not None:
+                    self.on_success(job)
+                return
+            if isinstance(error, TrainingCancelled):
+                job.update(status='cancelled', finished_at=finished_at)
+            else:
+                job.update(status='failed', error=f'{type(error).__name__}: {error}', finished_at=finished_at)
+        shutil.rmtree(job['dir'], ignore_errors=True)
+
+    def cancel(self, job_id):
+        """Cancel a queued job, or ask a running one to stop at its next check. False if unknown or finished."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job['status'] != 'queued':
+                return False
+            queued = [entry for entry in self._queue if entry[0] is job]
+            if queued:
+                self._queue.remove(queued[0])
+                job.update(status='cancelled', finished_at=datetime.datetime.now().isoformat(timespec='seconds'))
+        if queued:
+            shutil.rmtree(job['dir'], ignore_errors=True)
+        elif not job['future'].cancel():
+            (job['dir'] / 'cancel').touch()
+        return True
+
+    def prune(self):
+        """
+        Remove the version directories under models_dir that are neither the live
+        version, one of the last keep_versions finished ones, nor an unfinished job's.
+        """
+        current = Path(current_artifacts(self.models_dir / CURRENT_MODEL_FILE.name)['model']).parent.name
+        with self._lock:
+            unfinished = {job['version'] for job in self._jobs.values() if job['status'] == 'queued'}
+            finished = []
+            for directory in sorted(path for path in self.models_dir.iterdir() if path.is_dir()):
+                if directory.name == current or directory.name in unfinished:
+                    continue
+                if (directory / 'metrics.json').exists():
+                    finished.append(directory)
+                else:  # failed, or left behind by a stopped server
+                    shutil.rmtree(directory, ignore_errors=True)
+            for directory in finished[:max(len(finished) - self.keep_versions, 0)]:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    def status(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+
+        # 'queued' until the job finishes; the worker's progress file tells whether it started
+        status = job['status']
+        progress = None
+        if status in ('queued', 'succeeded'):
+            try:
+                with open(job['dir'] / 'progress.json') as f:
+                    progress = json.load(f)
+            except (FileNotFoundError, ValueError):
+                pass
+        if status == 'queued' and (job['dir'] / 'cancel').exists():
+            status = 'cancelling'
+        elif status == 'queued' and progress is not None:
+            status = 'running'
+
+        return {
+            'job_id': job['job_id'],
+            'version': job['version'],
+            'status': status,
+            'progress': progress,
+            'submitted_at': job['submitted_at'],
+            'finished_at': job['finished_at'],
+            'result': job['result'],
+            'error': job['error'],
+        }
+
+    def list(self):
+        return [self.status(job_id) for job_id in list(self._jobs)]
@@ -0,0 +1,108 @@
+"""
+Persistent store of the per-date demand aggregates the training features are built from.
+
+The store is partitioned by a hash of the trip features (see demand_training.store_keys):
+one directory per partition, holding the aggregates of all its dates in a few Parquet
+part files and an index of those parts and of the key each date was aggregated under
+(a hash of the services running on it); replacing the index is what commits a write.
+A retraining job only aggregates the dates whose key is not in the index, e.g. a week
+newly added to calendar_dates, appends them as one more part, and reads every other
+date back with a single Parquet read.
+"""
+import os
+import json
+import shutil
+import uuid
+from pathlib import Path
+
+
+DEFAULT_FEATURE_STORE_DIR = os.getenv("DEMAND_FEATURE_STORE", "data/feature_store")
+
+# Parts a partition may grow to before they are rewritten as one
+MAX_PARTS = 16
+
+INDEX_FILE = 'dates.json'
+
+
+class FeatureStore:
+
+    def __init__(self, directory=DEFAULT_FEATURE_STORE_DIR):
+        self.directory = Path(directory)
+        self.hits = 0
+        self.misses = 0
+
+    def _index(self, partition):
+        """{'parts': part file names, 'dates': date -> key} of a partition."""
+        try:
+            with open(self.directory / partition / INDEX_FILE) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'parts': [], 'dates': {}}
+
+    def _read(self, partition, parts):
+        import pyarrow.parquet as pq
+
+        paths = [str(self.directory / partition / part) for part in parts]
+        return pq.ParquetDataset(paths).read(use_pandas_metadata=True).to_pandas()
+
+    def load(self, partition, keys):
+        """
+        (stored, missing): the stored aggregates of the dates of keys (date -> key)
+        whose key matches, as one DataFrame (None when there are none), and the
+        other dates, counted as hits and misses.
+        """
+        index = self._index(partition)
+        missing = [date for date, key in keys.items() if index['dates'].get(date) != key]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if len(missing) == len(keys) or not index['parts']:
+            return None, missing
+
+        stored = self._read(partition, index['parts'])
+        dates = stored.pop('service_date')
+        current = dates.map({date: key for date, key in keys.items() if date not in missing}) == stored.pop('date_key')
+        return stored[current.to_numpy()].reset_index(drop=True), missing
+
+    def add(self, partition, keys, aggregates):
+        """
+        Store the aggregates of the dates of keys (date -> key) in partition, and
+        drop every other partition. Rows stored for those dates under older keys, or
+        too many parts, make the partition be rewritten as one part.
+        """
+        import pandas as pd
+
+        directory = self.directory / partition
+        directory.mkdir(parents=True, exist_ok=True)
+        for stale in self.directory.iterdir():
+            if stale.is_dir() and stale != directory:
+                shutil.rmtree(stale, ignore_errors=True)
+            elif stale.suffix == '.parquet':  # per-date files of the earlier layout
+                stale.unlink(missing_ok=True)
+
+        index = self._index(partition)
+        aggregates = aggregates.assign(service_date=aggregates['Date'].dt.strftime('%Y%m%d'))
+        aggregates['date_key'] = aggregates['service_date'].map(keys)
+        parts = index['parts']
+        if parts and (any(date in index['dates'] for date in keys) or len(parts) >= MAX_PARTS):
+            stored = self._read(partition, parts)
+            stored = stored[~stored['service_date'].isin(list(keys))]
+            aggregates = pd.concat([stored, aggregates], ignore_index=True)
+            parts = []
+
+        part = f'part-{uuid.uuid4().hex}.parquet'
+        tmp = directory / f'{part}.tmp-{os.getpid()}'
+        aggregates.to_parquet(tmp, index=False)
+        os.replace(tmp, directory / part)
+
+        index = {'parts': parts + [part], 'dates': {**index['dates'], **keys}}
+        tmp = directory / f'{INDEX_FILE}.tmp-{os.getpid()}'
+        with open(tmp, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp, directory / INDEX_FILE)
+
+        for stale in directory.glob('part-*.parquet'):
+            if stale.name not in index['parts']:
+                stale.unlink(missing_ok=True)
+
+    def stats(self):
+        return {'directory': str(self.directory), 'hits': self.hits, 'misses': self.misses}
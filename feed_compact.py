@@ -0,0 +1,82 @@
+"""
+Compact in-memory dtypes for the large feed tables, and a per-table memory report.
+
+compact_feed turns the string columns of stop_times, trips and shapes into categoricals
+(int codes + one shared dictionary per id column, e.g. trip_id in stop_times and trips),
+and integer columns into int32. Float columns are only narrowed to float32 when every
+value survives the round trip, so coordinates and distances come out of the API with
+the same digits. Categorical values serialise to the same strings, so the API output
+is unchanged; expand_categoricals turns a (small) result frame back into object
+columns where pandas needs them, e.g. before fillna with a placeholder.
+
+A feed read from a snapshot (feed_snapshot) already has categorical ids and int32
+times in these tables. Its numeric columns are read-only views of the memory map and
+are left as they are: a narrowed copy would be private to the process, while the
+mapped pages are shared with the other workers.
+"""
+import numpy as np
+import pandas as pd
+
+
+COMPACT_TABLES = ['stop_times', 'trips', 'shapes']
+
+
+def frame_memory(df):
+    """Deep memory usage of a DataFrame in bytes (0 for a missing table)."""
+    if df is None:
+        return 0
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+def memory_report(feed, tables=None):
+    """{table: bytes} for the feed tables."""
+    from feed_snapshot import FEED_TABLES
+
+    return {name: frame_memory(getattr(feed, name, None)) for name in tables or FEED_TABLES
+            if getattr(feed, name, None) is not None}
+
+def shared_categories(feed, tables):
+    """One sorted category dictionary per string column name across the tables."""
+    values = {}
+    for name in tables:
+        df = getattr(feed, name, None)
+        if df is None:
+            continue
+        for column in df.columns:
+            if df[column].dtype == object:
+                values.setdefault(column, []).append(df[column].dropna().unique())
+    return {column: pd.CategoricalDtype(np.unique(np.concatenate(uniques)))
+            for column, uniques in values.items()}
+
+def _compact_column(column, categories):
+    if column.dtype == object:
+        return column.astype(categories[column.name])
+    if isinstance(column.dtype, np.dtype) and not column.to_numpy().flags.writeable:
+        return column
+    if pd.api.types.is_integer_dtype(column.dtype) and column.dtype.itemsize > 4:
+        info = np.iinfo(np.int32)
+        if column.empty or (column.min() >= info.min and column.max() <= info.max):
+            return column.astype(np.int32)
+    if column.dtype == np.float64:
+        narrow = column.astype(np.float32)
+        if np.array_equal(narrow.astype(np.float64).to_numpy(), column.to_numpy(), equal_nan=True):
+            return narrow
+    return column
+
+def compact_feed(feed, tables=COMPACT_TABLES):
+    """Replace the given feed tables by compact copies (in place) and return the feed."""
+    categories = shared_categories(feed, tables)
+    for name in tables:
+        df = getattr(feed, name, None)
+        if df is None:
+            continue
+        compact = pd.DataFrame({column: _compact_column(df[column], categories) for column in df.columns}, index=df.index)
+        compact.attrs.update(df.attrs)  # the time formats of a snapshot table
+        setattr(feed, name, compact)
+    return feed
+
+def expand_categoricals(df):
+    """df with categorical columns turned back into object columns (a copy when any are)."""
+    categorical = [column for column in df.columns if isinstance(df[column].dtype, pd.CategoricalDtype)]
+    if not categorical:
+        return df
+    return df.astype({column: object for column in categorical})
@@ -0,0 +1,251 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from feed_snapshot import expand_times
+from gtfs_time import MISSING, to_seconds
+
+
+_NO_ROWS = np.empty(0, dtype=np.intp)
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+
+def _row_positions(df, column):
+    """Map each value of `column` to the positional rows holding it."""
+    return df.groupby(column, sort=False).indices
+
+
+def _sort_keys(column):
+    """Values that order like the column: the codes of a categorical with sorted categories (a mapped snapshot column)."""
+    if isinstance(column.dtype, pd.CategoricalDtype) and column.cat.categories.is_monotonic_increasing:
+        return column.cat.codes.to_numpy()
+    return column.to_numpy()
+
+
+def _is_trip_ordered(stop_times):
+    """Whether stop_times is already sorted by (trip_id, stop_sequence) with a RangeIndex (e.g. a feed snapshot)."""
+    if not isinstance(stop_times.index, pd.RangeIndex) or stop_times.index.start != 0 or stop_times.index.step != 1:
+        return False
+    trip_ids = _sort_keys(stop_times['trip_id'])
+    sequences = stop_times['stop_sequence'].to_numpy()
+    same_trip = trip_ids[1:] == trip_ids[:-1]
+    return bool(((trip_ids[1:] > trip_ids[:-1]) | (same_trip & (sequences[1:] >= sequences[:-1]))).all())
+
+
+def active_services(feed, date):
+    """service_ids running on a YYYYMMDD date, from calendar and calendar_dates."""
+    active = set()
+
+    calendar = feed.calendar
+    if calendar is not None:
+        weekday = WEEKDAYS[datetime.datetime.strptime(date, '%Y%m%d').weekday()]
+        running = (calendar['start_date'] <= date) & (calendar['end_date'] >= date) & (calendar[weekday] == 1)
+        active.update(calendar.loc[running, 'service_id'])
+
+    calendar_dates = feed.calendar_dates
+    if calendar_dates is not None:
+        exceptions = calendar_dates[calendar_dates['date'] == date]
+        active.update(exceptions.loc[exceptions['exception_type'] == 1, 'service_id'])
+        active.difference_update(exceptions.loc[exceptions['exception_type'] == 2, 'service_id'])
+
+    return active
+
+
+class FeedIndex:
+    """
+    Id lookups over the GTFS feed tables, built once at startup.
+
+    stop_times is sorted by (trip_id, stop_sequence) in place so the stop times of a
+    trip are one contiguous slice; every other table gets a hash map from id to row
+    positions. Lookups are a dict hit plus an iloc, instead of a boolean mask over
+    the whole table.
+
+    It also holds a stop -> (trip, stop_sequence) inverted index: the stop_times rows
+    re-ordered by (stop, trip, stop_sequence) as parallel int32 arrays, with a map
+    from stop_id to its slice. Trips are identified by their position in trip_ids.
+
+    The columns of a mapped feed snapshot are used as they are: categorical ids (by
+    their codes where only the order matters) and int32 second times.
+
+    Per-hop timings are precomputed as float arrays aligned with the sorted stop_times:
+    seconds travelled from the previous stop of the trip (its departure to this
+    arrival), seconds dwelling at the stop and distance from the previous stop (0 at a
+    trip's first stop, NaN where a time or distance is missing). Questions about the
+    stops between two stops of a trip are slices of these arrays.
+    """
+
+    def __init__(self, feed):
+        self.feed = feed
+
+        if not _is_trip_ordered(feed.stop_times):
+            feed.stop_times = feed.stop_times.sort_values(['trip_id', 'stop_sequence'], kind='stable').reset_index(drop=True)
+
+        trip_keys = _sort_keys(feed.stop_times['trip_id'])
+        starts = np.flatnonzero(np.r_[True, trip_keys[1:] != trip_keys[:-1]]) if len(trip_keys) else _NO_ROWS
+        ends = np.r_[starts[1:], len(trip_keys)]
+        trip_ids = feed.stop_times['trip_id'].to_numpy()[starts] if len(starts) else np.empty(0, dtype=object)
+        self.stop_time_ranges = dict(zip(trip_ids, zip(starts.tolist(), ends.tolist())))
+
+        self.route_rows = _row_positions(feed.routes, 'route_id')
+        self.stop_rows = _row_positions(feed.stops, 'stop_id')
+        self.trip_rows = _row_positions(feed.trips, 'trip_id')
+        self.route_trip_rows = _row_positions(feed.trips, 'route_id')
+
+        self._build_hops(starts)
+        self._build_stop_trip_index(starts, ends)
+
+    def _build_hops(self, starts):
+        stop_times = self.feed.stop_times
+        self.arrival_seconds = to_seconds(stop_times['arrival_time'])
+        self.departure_seconds = to_seconds(stop_times['departure_time'])
+
+        arrivals = np.where(self.arrival_seconds == MISSING, np.nan, self.arrival_seconds)
+        departures = np.where(self.departure_seconds == MISSING, np.nan, self.departure_seconds)
+        distances = stop_times['shape_dist_traveled'].to_numpy(dtype=float) if 'shape_dist_traveled' in stop_times \
+            else np.full(len(stop_times), np.nan)
+
+        first = np.zeros(len(stop_times), dtype=bool)
+        first[starts] = True
+        # A trip's first stop is at distance 0 when the feed leaves it blank
+        distances = np.where(first & np.isnan(distances), 0.0, distances)
+
+        self.hop_seconds = np.where(first, 0.0, arrivals - np.r_[np.nan, departures[:-1]])
+        self.dwell_seconds = departures - arrivals
+        self.hop_distances = np.where(first, 0.0, distances - np.r_[np.nan, distances[:-1]])
+        self.distances = distances
+
+    def _build_stop_trip_index(self, starts, ends):
+        stop_times = self.feed.stop_times
+
+        self.trip_ids = stop_times['trip_id'].to_numpy()[starts]
+        self.trip_starts, self.trip_ends = starts, ends
+        trip_codes = np.repeat(np.arange(len(starts), dtype=np.int32), ends - starts)
+
+        # Stable sort by stop keeps the (trip, stop_sequence) order inside each stop
+        stop_codes, stop_ids = pd.factorize(stop_times['stop_id'])
+        order = np.argsort(stop_codes, kind='stable')
+        bounds = np.searchsorted(stop_codes[order], np.arange(len(stop_ids) + 1))
+        self.stop_postings = dict(zip(stop_ids, zip(bounds[:-1].tolist(), bounds[1:].tolist())))
+
+        self.posting_rows = order.astype(np.int32)
+        self.posting_trips = trip_codes[order]
+        self.posting_sequences = stop_times['stop_sequence'].to_numpy().astype(np.int32)[order]
+        self.posting_departures = self.departure_seconds[order]
+
+        services = self.feed.trips.drop_duplicates('trip_id').set_index('trip_id')['service_id']
+        self.trip_services = services.reindex(self.trip_ids).to_numpy()
+        self._active_trips = {}
+
+    def route(self, route_id):
+        return self.feed.routes.iloc[self.route_rows.get(route_id, _NO_ROWS)]
+
+    def stop(self, stop_id):
+        return self.feed.stops.iloc[self.stop_rows.get(stop_id, _NO_ROWS)]
+
+    def trip(self, trip_id):
+        return self.feed.trips.iloc[self.trip_rows.get(trip_id, _NO_ROWS)]
+
+    def trips_for_route(self, route_id):
+        return self.feed.trips.iloc[self.route_trip_rows.get(route_id, _NO_ROWS)]
+
+    def stop_time_range(self, trip_id):
+        """(start, end) row offsets of a trip in the sorted stop_times, (0, 0) if unknown."""
+        return self.stop_time_ranges.get(trip_id, (0, 0))
+
+    def stop_times_for_trip(self, trip_id):
+        """Stop times of a trip ordered by stop_sequence."""
+        start, end = self.stop_time_range(trip_id)
+        return self.feed.stop_times.iloc[start:end]
+
+    def segment_rows(self, trip_id, start_stop_id, end_stop_id):
+        """
+        (first, last) rows of the sorted stop_times from start_stop_id to the next visit
+        of end_stop_id on a trip, None when the trip does not go from one to the other.
+        """
+        start, end = self.stop_time_range(trip_id)
+        stop_ids = self.feed.stop_times['stop_id'].to_numpy()[start:end]
+        starts = np.flatnonzero(stop_ids == start_stop_id)
+        if not len(starts):
+            return None
+        ends = np.flatnonzero(stop_ids[starts[0] + 1:] == end_stop_id)
+        if not len(ends):
+            return None
+        return start + starts[0], start + starts[0] + 1 + ends[0]
+
+    def segment_summary(self, first, last):
+        """
+        (seconds, distance) from the departure at row first to the arrival at row last:
+        travel plus the dwells in between. Taken from the two end rows when both are
+        known, otherwise summed over the hops that are.
+        """
+        departure = self.departure_seconds[first] if self.departure_seconds[first] != MISSING else self.arrival_seconds[first]
+        if departure != MISSING and self.arrival_seconds[last] != MISSING:
+            duration = self.arrival_seconds[last] - departure
+        else:
+            duration = np.nansum(self.hop_seconds[first + 1:last + 1]) + np.nansum(self.dwell_seconds[first + 1:last])
+
+        distance = self.distances[last] - self.distances[first]
+        if np.isnan(distance):
+            distance = np.nansum(self.hop_distances[first + 1:last + 1])
+        return float(duration), float(distance)
+
+    def active_services(self, date):
+        """service_ids running on a YYYYMMDD date."""
+        return active_services(self.feed, date)
+
+    def active_trips(self, date):
+        """Boolean mask over trip_ids of the trips running on date (cached per date)."""
+        mask = self._active_trips.get(date)
+        if mask is None:
+            mask = np.isin(self.trip_services, list(self.active_services(date)))
+            self._active_trips[date] = mask
+        return mask
+
+    def _postings(self, stop_id):
+        start, end = self.stop_postings.get(stop_id, (0, 0))
+        return (self.posting_trips[start:end], self.posting_sequences[start:end],
+                self.posting_rows[start:end], self.posting_departures[start:end])
+
+    def trips_between(self, start_stop_id, end_stop_id, date=None, depart_after=None, depart_before=None):
+        """
+        Trips that stop at start_stop_id and afterwards at end_stop_id.
+
+        Optionally restricted to trips running on a YYYYMMDD date and to departures from
+        the start stop within [depart_after, depart_before] (seconds since midnight).
+        Returns a DataFrame with one row per trip, ordered by departure.
+        """
+        start_trips, start_seqs, start_rows, start_deps = self._postings(start_stop_id)
+        end_trips, end_seqs, end_rows, _ = self._postings(end_stop_id)
+
+        keep = np.ones(len(start_trips), dtype=bool)
+        if depart_after is not None:
+            keep &= start_deps >= depart_after
+        if depart_before is not None:
+            keep &= start_deps <= depart_before
+        if date is not None:
+            keep &= self.active_trips(date)[start_trips]
+        start_trips, start_seqs, start_rows, start_deps = start_trips[keep], start_seqs[keep], start_rows[keep], start_deps[keep]
+
+        # Earliest boarding at the start stop and latest alighting at the end stop per trip
+        first = np.r_[True, start_trips[1:] != start_trips[:-1]] if len(start_trips) else np.empty(0, dtype=bool)
+        last = np.r_[end_trips[1:] != end_trips[:-1], True] if len(end_trips) else np.empty(0, dtype=bool)
+        start_trips, start_seqs, start_rows, start_deps = start_trips[first], start_seqs[first], start_rows[first], start_deps[first]
+        end_trips, end_seqs, end_rows = end_trips[last], end_seqs[last], end_rows[last]
+
+        _, i_start, i_end = np.intersect1d(start_trips, end_trips, assume_unique=True, return_indices=True)
+        forward = start_seqs[i_start] < end_seqs[i_end]
+        i_start, i_end = i_start[forward], i_end[forward]
+
+        by_departure = np.argsort(start_deps[i_start], kind='stable')
+        i_start, i_end = i_start[by_departure], i_end[by_departure]
+
+        stop_times = self.feed.stop_times
+        matches = pd.DataFrame({
+            'trip_id': self.trip_ids[start_trips[i_start]],
+            'start_stop_sequence': start_seqs[i_start],
+            'end_stop_sequence': end_seqs[i_end],
+            'departure_time': stop_times['departure_time'].to_numpy()[start_rows[i_start]],
+            'arrival_time': stop_times['arrival_time'].to_numpy()[end_rows[i_end]],
+        })
+        return expand_times(matches, stop_times.attrs.get('time_formats'))
@@ -0,0 +1,266 @@
+"""
+Binary snapshot of the cleaned GTFS feed, so a process start does not re-parse the CSVs
+inside the zip.
+
+Each table is an uncompressed Arrow IPC file under <snapshot dir>/<key>/, the key
+hashing the zip, SNAPSHOT_VERSION and the code of the cleaning function. The files
+are memory-mapped on load. String columns are stored dictionary-encoded (one copy of
+each distinct id / name) and HH:MM:SS columns as int32 seconds.
+
+The large tables (feed_compact.COMPACT_TABLES) are used in place: their string columns
+become pd.Categorical.from_codes over the mapped dictionary indices (one dictionary
+per column name across the tables, as compact_feed builds), their time columns stay
+int32 seconds (MISSING where empty) and their numeric columns without nulls are views
+of the map, so the pages are shared between the workers on a machine. Only the
+dictionaries themselves are per process. expand_times turns the time columns back
+into the feed's strings for output, and gtfs_kit_feed gives gtfs_kit the object
+columns it expects. The small tables are decoded into the object columns gk.read_feed
+produces.
+"""
+import hashlib
+import inspect
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+import gtfs_time
+from feed_compact import COMPACT_TABLES, shared_categories
+
+
+# Bump when the layout changes (changes to the cleaning function change the key by themselves)
+SNAPSHOT_VERSION = 2
+DEFAULT_SNAPSHOT_DIR = Path(os.getenv('FEED_SNAPSHOT_DIR', 'data/feed_snapshots'))
+
+FEED_TABLES = ['agency', 'attributions', 'calendar', 'calendar_dates', 'fare_attributes', 'fare_rules', 'feed_info',
+               'frequencies', 'routes', 'shapes', 'stops', 'stop_times', 'trips', 'transfers']
+TIME_COLUMNS = {'arrival_time', 'departure_time', 'start_time', 'end_time'}
+
+# Whether the hours of a time column are zero-padded (07:05:00) or not (7:05:00)
+TIME_FORMATS = {'unpadded': False, 'padded': True}
+
+
+def _code_digest(code, digest):
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            _code_digest(const, digest)
+        else:
+            digest.update(repr(const).encode())
+
+def clean_version(clean):
+    """
+    Hash of what the cleaning function does: its bytecode, names and constants, so
+    edits to its comments or position in the file keep the snapshot.
+    """
+    digest = hashlib.sha256()
+    code = getattr(clean, '__code__', None)
+    if code is None:
+        digest.update(getattr(clean, '__qualname__', repr(clean)).encode())
+    else:
+        _code_digest(code, digest)
+    return digest.hexdigest()
+
+def zip_digest(zip_path, clean=None):
+    """Short sha256 of the feed zip, the snapshot version and the cleaning function, used as the snapshot key."""
+    digest = hashlib.sha256(f'v{SNAPSHOT_VERSION}'.encode())
+    if clean is not None:
+        digest.update(clean_version(clean).encode())
+    with open(zip_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+def _format_times(seconds, fmt):
+    return gtfs_time.to_timestrs(seconds, pad_hours=TIME_FORMATS[fmt])
+
+def _time_format(column):
+    """Name of the TIME_FORMATS entry that reproduces the column exactly, None if neither does."""
+    seconds = gtfs_time.to_seconds(column)
+    original = column.to_numpy(dtype=object)
+    missing = pd.isna(original)
+    if (seconds[~missing] == gtfs_time.MISSING).any():
+        return None, seconds
+    for fmt in TIME_FORMATS:
+        if (_format_times(seconds, fmt)[~missing] == original[~missing]).all():
+            return fmt, seconds
+    return None, seconds
+
+def _values_array(values, mask):
+    """Arrow array over values, null where mask; the buffer keeps what values hold there (-1 / MISSING)."""
+    return pa.array(values, mask=mask)
+
+def _encode_table(df, categories=None):
+    """
+    pyarrow Table with dictionary-encoded strings and int32 second time columns. With
+    categories (column name -> CategoricalDtype, for the mapped tables) the strings
+    are encoded against those dictionaries with the index width pandas uses for them.
+    """
+    arrays, names, time_formats = [], [], {}
+    for name in df.columns:
+        column = df[name]
+        array = None
+        if column.dtype == object:
+            if name in TIME_COLUMNS:
+                fmt, seconds = _time_format(column)
+                if fmt is not None:
+                    array = _values_array(seconds, seconds == gtfs_time.MISSING)
+                    time_formats[name] = fmt
+            if array is None and categories is not None and name in categories:
+                codes = column.astype(categories[name]).cat.codes.to_numpy()
+                dictionary = pa.array(categories[name].categories.to_numpy(dtype=object), type=pa.string())
+                array = pa.DictionaryArray.from_arrays(_values_array(codes, codes < 0), dictionary)
+            if array is None:
+                try:
+                    array = pa.array(column, from_pandas=True).dictionary_encode()
+                except (pa.ArrowInvalid, pa.ArrowTypeError):
+                    # mixed python types, keep them as strings
+                    array = pa.array(column.map(lambda v: v if pd.isna(v) else str(v)), from_pandas=True)
+        else:
+            array = pa.array(column.to_numpy())
+        arrays.append(array)
+        names.append(str(name))
+
+    metadata = {'time_formats': json.dumps(time_formats), 'index': json.dumps(_encode_index(df.index)),
+                'mapped': json.dumps(categories is not None)}
+    return pa.Table.from_arrays(arrays, names=names, metadata=metadata)
+
+def _encode_index(index):
+    if isinstance(index, pd.RangeIndex):
+        return {'start': index.start, 'stop': index.stop, 'step': index.step}
+    return {'values': index.tolist()}
+
+def _decode_index(spec):
+    if 'values' in spec:
+        return pd.Index(spec['values'])
+    return pd.RangeIndex(spec['start'], spec['stop'], spec['step'])
+
+def _buffer_view(array):
+    """The values buffer of a primitive Arrow array as a numpy view of the map, null slots included."""
+    dtype = array.type.to_pandas_dtype()
+    return np.frombuffer(array.buffers()[1], dtype=dtype, count=len(array), offset=array.offset * np.dtype(dtype).itemsize)
+
+def _decode_column(array, time_format, mapped):
+    if pa.types.is_dictionary(array.type):
+        values = array.dictionary.to_numpy(zero_copy_only=False).astype(object)
+        if mapped:
+            return pd.Categorical.from_codes(_buffer_view(array.indices), categories=values, validate=False)
+        indices = array.indices.fill_null(-1).to_numpy(zero_copy_only=False)
+        return np.append(values, np.nan)[indices]
+    if time_format is not None:
+        if mapped:
+            return _buffer_view(array)
+        return _format_times(array.fill_null(gtfs_time.MISSING).to_numpy(zero_copy_only=False), time_format)
+    if pa.types.is_string(array.type) or pa.types.is_large_string(array.type):
+        return array.to_numpy(zero_copy_only=False).astype(object)
+    # Numeric columns without nulls are a view of the memory map
+    return array.to_numpy(zero_copy_only=False)
+
+def _read_table(path):
+    with pa.memory_map(str(path), 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+
+    metadata = table.schema.metadata or {}
+    time_formats = json.loads(metadata.get(b'time_formats', b'{}'))
+    mapped = json.loads(metadata.get(b'mapped', b'false'))
+    index = _decode_index(json.loads(metadata[b'index']))
+
+    columns = {}
+    for name in table.column_names:
+        chunked = table.column(name)
+        array = chunked.chunk(0) if chunked.num_chunks == 1 else chunked.combine_chunks()
+        columns[name] = _decode_column(array, time_formats.get(name), mapped)
+    df = pd.DataFrame(columns, index=index, copy=False)
+    if mapped:
+        df.attrs['time_formats'] = time_formats
+    return df
+
+def expand_times(df, time_formats=None):
+    """
+    df with its int32 second time columns (those of the mapped tables) formatted back
+    into the feed's H:MM:SS strings, a copy when it has any. time_formats (column ->
+    TIME_FORMATS name) defaults to df.attrs['time_formats'], which row selections of a
+    mapped table keep; hours are zero-padded for columns it does not name.
+    """
+    if time_formats is None:
+        time_formats = df.attrs.get('time_formats', {})
+    times = [name for name in df.columns if name in TIME_COLUMNS and pd.api.types.is_integer_dtype(df[name].dtype)]
+    if not times:
+        return df
+    return df.assign(**{name: _format_times(df[name].to_numpy(), time_formats.get(name, 'padded')) for name in times})
+
+def gtfs_kit_feed(feed):
+    """
+    gk.Feed sharing the tables of feed, with those of the mapped tables turned back into
+    the object string columns gtfs_kit works on (a per-call copy of those tables).
+    """
+    import gtfs_kit as gk
+    from feed_compact import expand_categoricals
+
+    tables = {name: getattr(feed, name, None) for name in FEED_TABLES}
+    for name in COMPACT_TABLES:
+        if tables[name] is not None:
+            tables[name] = expand_categoricals(expand_times(tables[name]))
+    return gk.Feed(dist_units=feed.dist_units, **tables)
+
+def write_snapshot(feed, directory):
+    """Write the feed tables under directory; the directory appears atomically once complete."""
+    directory = Path(directory)
+    tmp = directory.with_name(f'{directory.name}.tmp-{os.getpid()}')
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+
+    categories = shared_categories(feed, COMPACT_TABLES)
+    tables = []
+    for name in FEED_TABLES:
+        df = getattr(feed, name, None)
+        if df is None:
+            continue
+        if name == 'stop_times':
+            # FeedIndex wants (trip_id, stop_sequence) order; storing it that way lets it keep the mapped columns
+            df = df.sort_values(['trip_id', 'stop_sequence'], kind='stable').reset_index(drop=True)
+        table = _encode_table(df, categories if name in COMPACT_TABLES else None)
+        with pa.OSFile(str(tmp / f'{name}.arrow'), 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        tables.append(name)
+
+    with open(tmp / 'feed.json', 'w') as f:
+        json.dump({'version': SNAPSHOT_VERSION, 'dist_units': feed.dist_units, 'tables': tables}, f)
+
+    try:
+        os.rename(tmp, directory)
+    except OSError:
+        # Another process finished the same snapshot first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def read_snapshot(directory):
+    """gk.Feed backed by the memory-mapped tables of a snapshot directory."""
+    import gtfs_kit as gk
+
+    directory = Path(directory)
+    with open(directory / 'feed.json') as f:
+        meta = json.load(f)
+    tables = {name: _read_table(directory / f'{name}.arrow') for name in meta['tables']}
+    return gk.Feed(dist_units=meta['dist_units'], **tables)
+
+def load_feed(zip_path, clean, snapshot_dir=DEFAULT_SNAPSHOT_DIR, dist_units='km'):
+    """
+    The cleaned feed of zip_path: read from its snapshot when one exists, otherwise
+    parsed with gk.read_feed, passed through clean(feed) and snapshotted. Editing
+    clean changes the key, so the next start re-parses the zip.
+    """
+    directory = Path(snapshot_dir) / zip_digest(zip_path, clean)
+    if (directory / 'feed.json').exists():
+        return read_snapshot(directory)
+
+    import gtfs_kit as gk
+
+    feed = clean(gk.read_feed(zip_path, dist_units=dist_units))
+    write_snapshot(feed, directory)
+    return read_snapshot(directory)
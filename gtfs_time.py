@@ -0,0 +1,116 @@
+"""
+Vectorized parsing and bucketing of GTFS HH:MM:SS times.
+
+GTFS times count from the start of the service day, so hours may go past 24
+(25:10:00 is 1:10 am the next calendar day). Everything here works on int32
+seconds since the start of the service day.
+"""
+import numpy as np
+import pandas as pd
+
+
+MISSING = -1
+
+# Upper hour bounds of the time of day buckets; service hours >= 24 stay 'Mid Night'
+TIME_OF_DAY_BOUNDS = np.array([4, 8, 12, 16, 20, 24])
+TIME_OF_DAY_LABELS = np.array(['Mid Night', 'Morning', 'Peak Morning', 'Afternoon', 'Peak Evening', 'Night', 'Mid Night'],
+                              dtype=object)
+
+TIME_PERIOD_LABELS = np.array([f'{i}:00-{i+1}:59' for i in range(0, 23, 2)] + [None], dtype=object)
+
+
+def to_seconds(times):
+    """
+    HH:MM:SS strings to int32 seconds since the start of the service day, MISSING
+    where empty or malformed (including minutes or seconds of 60 and more). Leading
+    spaces and unpadded hours (7:05:00) are accepted.
+
+    Only the distinct values are parsed (a feed has at most a few tens of thousands):
+    they are right-aligned in a fixed-width code point matrix and the digits read
+    column-wise, then broadcast back with their factorize codes. Integer input is
+    already seconds (the time columns of a mapped feed snapshot) and is returned as
+    int32, without a copy when it is int32.
+    """
+    if pd.api.types.is_integer_dtype(getattr(times, 'dtype', None)):
+        return np.asarray(times, dtype=np.int32)
+    codes, uniques = pd.factorize(pd.Series(times, copy=False), use_na_sentinel=True)
+    if not len(uniques):
+        return np.full(len(codes), MISSING, dtype=np.int32)
+
+    text = np.asarray(uniques, dtype=str)
+    width = max(text.dtype.itemsize // 4, 8)
+    chars = text.astype(f'U{width}').view(np.uint32).reshape(-1, width).astype(np.int32)
+
+    # Right-align every value so seconds, minutes and the colons sit in fixed columns
+    lengths = (chars != 0).sum(axis=1)
+    source = np.arange(width)[None, :] - (width - lengths)[:, None]
+    chars = np.where(source >= 0, np.take_along_axis(chars, np.clip(source, 0, None), axis=1), 0)
+
+    digits = chars - ord('0')
+    is_digit = (digits >= 0) & (digits <= 9)
+    hour_chars = chars[:, :-6]
+    valid = (is_digit[:, [-7, -5, -4, -2, -1]].all(axis=1) &
+             (chars[:, -6] == ord(':')) & (chars[:, -3] == ord(':')) &
+             (digits[:, -5] <= 5) & (digits[:, -2] <= 5) &
+             (is_digit[:, :-6] | (hour_chars == 0) | (hour_chars == ord(' '))).all(axis=1))
+
+    hours = (np.where(is_digit[:, :-6], digits[:, :-6], 0) * 10 ** np.arange(width - 7, -1, -1)).sum(axis=1)
+    seconds = hours * 3600 + (digits[:, -5] * 10 + digits[:, -4]) * 60 + digits[:, -2] * 10 + digits[:, -1]
+    seconds = np.where(valid, seconds, MISSING).astype(np.int32)
+
+    return np.where(codes >= 0, seconds[codes], MISSING).astype(np.int32)
+
+def to_timestr(seconds):
+    """Seconds since the start of the service day to HH:MM:SS (hours may exceed 24)."""
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+def to_timestrs(seconds, pad_hours=True):
+    """
+    Array version of to_timestr: object array of H:MM:SS strings (HH:MM:SS with
+    pad_hours), NaN where MISSING. Each distinct value is formatted once, digit by
+    digit into a fixed-width byte matrix.
+    """
+    uniques, inverse = np.unique(np.asarray(seconds), return_inverse=True)
+    valid = uniques >= 0
+    hours, minutes, secs = uniques // 3600, uniques % 3600 // 60, uniques % 60
+
+    if not len(uniques) or hours.max() >= 100:
+        labels = np.array([to_timestr(s) if s >= 0 else np.nan for s in uniques], dtype=object)
+    else:
+        chars = np.full((len(uniques), 9), ord(':'), dtype=np.uint8)
+        for column, digit in zip([0, 1, 3, 4, 6, 7], [hours // 10, hours % 10, minutes // 10, minutes % 10, secs // 10, secs % 10]):
+            chars[:, column] = digit + ord('0')
+        chars[:, 8] = 0
+        if not pad_hours:
+            short = hours < 10
+            chars[short, :-1] = chars[short, 1:]
+        labels = chars.view('S9').ravel().astype('U9').astype(object)
+    labels[~valid] = np.nan
+
+    return labels[inverse]
+
+def service_hour(seconds):
+    """Hour since the start of the service day (25 for 25:10:00)."""
+    return np.asarray(seconds) // 3600
+
+def clock_hour(seconds):
+    """Wall clock hour (1 for 25:10:00), -1 where MISSING."""
+    seconds = np.asarray(seconds)
+    return np.where(seconds == MISSING, -1, service_hour(seconds) % 24)
+
+def time_of_day(seconds):
+    """Morning / Peak Morning / Afternoon / Peak Evening / Night / Mid Night buckets, None where MISSING."""
+    seconds = np.asarray(seconds)
+    labels = TIME_OF_DAY_LABELS[np.searchsorted(TIME_OF_DAY_BOUNDS, service_hour(seconds), side='right')]
+    return np.where(seconds == MISSING, None, labels)[()]
+
+def time_period(seconds):
+    """Two-hour 'H:00-H+1:59' buckets, None past the end of the day and where MISSING."""
+    seconds = np.asarray(seconds)
+    return np.where(seconds == MISSING, None, TIME_PERIOD_LABELS[np.minimum(np.maximum(service_hour(seconds), 0) // 2, 12)])[()]
+
+def is_peak_hours(hours):
+    """1 for clock hours in 8-12 or 16-20 (inclusive), else 0."""
+    hours = np.asarray(hours)
+    return np.select([(hours >= 8) & (hours <= 12), (hours >= 16) & (hours <= 20)], [1, 1], default=0)
@@ -0,0 +1,101 @@
+"""
+Process-wide cache of the joblib artifacts the demand endpoints use (model and encoders).
+
+Training jobs write each model version to its own directory under models/ and then
+atomically replace models/current.json, which names the live version. Without that
+pointer the artifacts shipped in the repository root are used.
+
+Each artifact is unpickled on first use and kept in memory; a request only stats the
+pointer and the files, and reloads when they changed.
+"""
+import os
+import json
+import threading
+from pathlib import Path
+
+
+DEMAND_ARTIFACTS = {
+    'model': 'trained_model.pkl',
+    'onehot_encoder': 'onehot_encoder.pkl',
+    'target_encoder': 'target_encoder.pkl',
+}
+
+MODELS_DIR = Path(os.getenv('DEMAND_MODELS_DIR', 'models'))
+CURRENT_MODEL_FILE = MODELS_DIR / 'current.json'
+
+
+def current_artifacts(pointer=CURRENT_MODEL_FILE):
+    """Paths of the live model version: the one models/current.json names, else the repository root files."""
+    try:
+        with open(pointer) as f:
+            current = json.load(f)
+    except FileNotFoundError:
+        return dict(DEMAND_ARTIFACTS)
+    return {name: str(Path(pointer).parent / current['version'] / filename) for name, filename in DEMAND_ARTIFACTS.items()}
+
+def publish_artifacts(version, pointer=CURRENT_MODEL_FILE):
+    """Make models/<version>/ the live model: one atomic rename of the pointer file."""
+    pointer = Path(pointer)
+    tmp = pointer.with_name(f'{pointer.name}.tmp-{os.getpid()}-{threading.get_ident()}')
+    with open(tmp, 'w') as f:
+        json.dump({'version': version}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, pointer)
+
+
+class ModelRegistry:
+    """
+    The unpickled artifacts of the live model version, shared by the request threads.
+    Each request stats the pointer and the files and gets one consistent version; a
+    file is loaded again only when its mtime changes, and the artifacts of swapped-out
+    versions are dropped.
+    """
+
+    def __init__(self, paths=None, pointer=CURRENT_MODEL_FILE):
+        # Fixed paths, or None to follow the live version named by the pointer file
+        self.paths = dict(paths) if paths is not None else None
+        self.pointer = pointer
+        self._entries = {}  # path -> (mtime_ns, object)
+        self._loads = {}
+        self._lock = threading.Lock()
+
+    def _paths(self):
+        return self.paths if self.paths is not None else current_artifacts(self.pointer)
+
+    def _load(self, path):
+        mtime = os.stat(path).st_mtime_ns
+
+        entry = self._entries.get(path)
+        if entry is None or entry[0] != mtime:
+            with self._lock:
+                entry = self._entries.get(path)
+                if entry is None or entry[0] != mtime:
+                    import joblib
+
+                    entry = (mtime, joblib.load(path))
+                    self._entries[path] = entry
+                    self._loads[path] = self._loads.get(path, 0) + 1
+        return entry[1]
+
+    def artifacts(self):
+        """{name: object} of one model version, unpickled again only if a file changed."""
+        paths = self._paths()
+        artifacts = {name: self._load(path) for name, path in paths.items()}
+
+        # Drop the artifacts of versions that were swapped out
+        if len(self._entries) > len(paths):
+            with self._lock:
+                for path in set(self._entries) - set(paths.values()):
+                    del self._entries[path]
+        return artifacts
+
+    def get(self, name):
+        return self._load(self._paths()[name])
+
+    def stats(self):
+        """Per artifact of the live version: path, mtime of the loaded copy and how often it was loaded."""
+        return {name: {'path': path,
+                       'loaded_mtime_ns': self._entries[path][0] if path in self._entries else None,
+                       'loads': self._loads.get(path, 0)}
+                for name, path in self._paths().items()}
@@ -0,0 +1,165 @@
+"""
+In-memory fuzzy and prefix search over names (stop names, route short / long names).
+
+Names are normalized (case, accents and punctuation folded) and grouped, so one entry
+holds every key (stop_id, route_id) sharing a name. Two indexes are built once:
+
+- a trigram inverted index in CSR form. Each word is padded like PostgreSQL's pg_trgm
+  does ("  main "), and the similarity of a query to a name is the Jaccard index of
+  their trigram sets, counted for every candidate at once with np.bincount over the
+  posting lists of the query's trigrams;
+- a sorted array of every (word, entry) pair, so the entries having a word that starts
+  with a query token are one searchsorted range. This makes the word being typed
+  match by prefix before it is long enough to share trigrams.
+
+Results rank exact matches, then names starting with the query, then names where
+every query token starts a word, each by trigram similarity. The trigram index also
+narrows substring searches down to the names that can contain the query.
+"""
+import re
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+
+# Minimum trigram similarity for a name that does not match by prefix: short queries
+# share a few trigrams with many names, so the bar is higher for them
+MIN_SIMILARITY = 0.3
+SHORT_QUERY_SIMILARITY = 0.6
+SHORT_QUERY_LENGTH = 4
+LONG_QUERY_LENGTH = 12
+
+_NON_ALNUM = re.compile(r'[^0-9a-z]+')
+
+
+def normalize_name(name):
+    """Lower-case ASCII words of a name separated by single spaces."""
+    name = unicodedata.normalize('NFKD', str(name)).encode('ascii', 'ignore').decode()
+    return _NON_ALNUM.sub(' ', name.lower()).strip()
+
+def min_similarity_for(normalized):
+    """Similarity threshold for a normalized query, from SHORT_QUERY_SIMILARITY down to MIN_SIMILARITY with its length."""
+    extra = (LONG_QUERY_LENGTH - len(normalized)) / (LONG_QUERY_LENGTH - SHORT_QUERY_LENGTH)
+    return MIN_SIMILARITY + (SHORT_QUERY_SIMILARITY - MIN_SIMILARITY) * min(max(extra, 0.0), 1.0)
+
+def trigrams(normalized):
+    """Set of the pg_trgm style trigrams of a normalized name."""
+    grams = set()
+    for word in normalized.split():
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class NameIndex:
+
+    def __init__(self, names, keys):
+        """Index names[i] as a name of keys[i]; rows with a missing or empty name are left out."""
+        rows = pd.DataFrame({'name': pd.Series(names, dtype=object).to_numpy(),
+                             'key': pd.Series(keys, dtype=object).to_numpy()}).dropna()
+        rows['normalized'] = [normalize_name(name) for name in rows['name']]
+        rows = rows[rows['normalized'] != '']
+
+        groups = rows.groupby('normalized', sort=True)
+        self.normalized = np.array(list(groups.groups), dtype=object)
+        # Display name: the first spelling seen; keys in input order without repeats
+        self.names = groups['name'].first().to_numpy()
+        self.keys = [list(dict.fromkeys(keys)) for keys in groups['key'].agg(list)]
+        self.entry_of = {normalized: entry for entry, normalized in enumerate(self.normalized)}
+
+        self._build_trigrams()
+        self._build_words()
+
+    def _build_trigrams(self):
+        entry_grams = [trigrams(normalized) for normalized in self.normalized]
+        self.trigram_counts = np.array([len(grams) for grams in entry_grams], dtype=np.int32)
+
+        gram_entries = {}
+        for entry, grams in enumerate(entry_grams):
+            for gram in grams:
+                gram_entries.setdefault(gram, []).append(entry)
+        self.trigram_ids = {gram: code for code, gram in enumerate(gram_entries)}
+        lengths = np.array([len(entries) for entries in gram_entries.values()], dtype=np.int64)
+        self.trigram_offsets = np.r_[0, np.cumsum(lengths)]
+        self.trigram_entries = (np.fromiter((entry for entries in gram_entries.values() for entry in entries),
+                                            dtype=np.int32, count=int(lengths.sum())))
+
+    def _build_words(self):
+        pairs = sorted((word, entry) for entry, normalized in enumerate(self.normalized)
+                       for word in set(normalized.split()))
+        self.words = np.array([word for word, _ in pairs], dtype=object)
+        self.word_entries = np.array([entry for _, entry in pairs], dtype=np.int32)
+
+    def __len__(self):
+        return len(self.normalized)
+
+    def lookup(self, name):
+        """Keys of the entry whose normalized name equals that of name ([] if none)."""
+        entry = self.entry_of.get(normalize_name(name))
+        return list(self.keys[entry]) if entry is not None else []
+
+    def _prefix_entries(self, token):
+        """Entries having a word that starts with token."""
+        start = np.searchsorted(self.words, token, side='left')
+        end = np.searchsorted(self.words, token + '\uffff', side='left')
+        return np.unique(self.word_entries[start:end])
+
+    def substring_candidates(self, query):
+        """
+        Keys of the entries whose name may contain query as a substring: those having
+        every trigram that lies inside a word of the normalized query. A superset, to be
+        checked against the names themselves.
+        """
+        grams = {word[i:i + 3] for word in normalize_name(query).split() for i in range(len(word) - 2)}
+        entries = np.arange(len(self))
+        for gram in grams:
+            code = self.trigram_ids.get(gram)
+            if code is None:
+                return []
+            entries = np.intersect1d(entries, self.trigram_entries[self.trigram_offsets[code]:self.trigram_offsets[code + 1]],
+                                     assume_unique=True)
+        return list(dict.fromkeys(key for entry in entries.tolist() for key in self.keys[entry]))
+
+    def search(self, query, limit=10, min_similarity=None):
+        """
+        Up to limit matches of query, best first: dicts with the display name, the keys
+        sharing it and a score (the trigram similarity, plus 1 when every token starts a
+        word of the name, 2 when the name starts with the query, 3 for an exact match).
+        min_similarity defaults to min_similarity_for the query.
+        """
+        normalized = normalize_name(query)
+        if not normalized or not len(self):
+            return []
+        if min_similarity is None:
+            min_similarity = min_similarity_for(normalized)
+
+        grams = trigrams(normalized)
+        codes = [self.trigram_ids[gram] for gram in grams if gram in self.trigram_ids]
+        if codes:
+            postings = np.concatenate([self.trigram_entries[self.trigram_offsets[code]:self.trigram_offsets[code + 1]]
+                                       for code in codes])
+            shared = np.bincount(postings, minlength=len(self))
+        else:
+            shared = np.zeros(len(self), dtype=np.int64)
+        similarity = shared / np.maximum(len(grams) + self.trigram_counts - shared, 1)
+
+        tokens = normalized.split()
+        prefixed = self._prefix_entries(tokens[0])
+        for token in tokens[1:]:
+            prefixed = np.intersect1d(prefixed, self._prefix_entries(token), assume_unique=True)
+
+        score = similarity.copy()
+        score[prefixed] += 1
+        candidates = np.union1d(np.flatnonzero(similarity >= min_similarity), prefixed)
+        starts = np.array([self.normalized[entry].startswith(normalized) for entry in candidates.tolist()], dtype=bool)
+        score[candidates[starts]] += 1
+        exact = self.entry_of.get(normalized)
+        if exact is not None:
+            score[exact] += 1
+
+        # Best score first, then shorter names
+        lengths = np.array([len(self.normalized[entry]) for entry in candidates.tolist()])
+        order = np.lexsort((lengths, -score[candidates]))[:limit]
+        return [{'name': self.names[entry], 'keys': list(self.keys[entry]), 'score': round(float(score[entry]), 3)}
+                for entry in candidates[order].tolist()]
@@ -0,0 +1,428 @@
+"""
+Round-based public transit routing (RAPTOR) over the loaded GTFS feed.
+
+Delling, Pajor and Werneck, "Round-Based Public Transit Routing" (2012).
+Round k finds the earliest arrival at every stop using at most k vehicles, so the
+journeys for k = 1..max_transfers + 1 form the arrival time / transfers Pareto set.
+Profile queries run the rRAPTOR variant: one round-based search per departure in
+the window, latest first, re-using the labels of the previous (later) search.
+"""
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from gtfs_time import to_seconds, to_timestr
+from spatial_index import SpatialIndex
+
+
+INF = np.iinfo(np.int32).max
+
+# Largest max_transfers the journey endpoint accepts: every round adds label arrays over all the stops
+MAX_TRANSFERS = 5
+
+# No transit leg: the label was copied from the previous round
+NONE, TRANSIT, WALK = 0, 1, 2
+
+
+def csr_entries(offsets, rows):
+    """Positions of every entry of the given rows of a CSR offsets array."""
+    counts = offsets[rows + 1] - offsets[rows]
+    total = int(counts.sum())
+    starts = np.repeat(offsets[rows] - (np.cumsum(counts) - counts), counts)
+    return starts + np.arange(total), counts
+
+
+class RaptorRouter:
+    """
+    Compact RAPTOR timetable built once from a FeedIndex.
+
+    Trips are grouped into patterns (trips that visit exactly the same stop sequence).
+    Each pattern holds a (trips x stops) int32 arrival and departure matrix ordered by
+    first departure; positions where boarding (pickup_type 1) or alighting
+    (drop_off_type 1) is not allowed are masked out. Footpaths connect every pair of
+    stops within max_walk_meters, found with the stops' SpatialIndex (built here unless
+    one over feed.stops is passed in). Trips with missing times are left out.
+    """
+
+    def __init__(self, feed_index, max_walk_meters=400, walk_speed=1.25, max_cached_dates=8, spatial_index=None):
+        self.feed_index = feed_index
+        self.feed = feed = feed_index.feed
+        self.walk_speed = walk_speed
+        self.max_cached_dates = max_cached_dates
+        self._date_views = OrderedDict()
+
+        stops = feed.stops
+        self.stop_ids = stops['stop_id'].to_numpy()
+        self.stop_names = stops['stop_name'].to_numpy()
+        self.stop_codes = {stop_id: code for code, stop_id in enumerate(self.stop_ids)}
+
+        self._build_patterns()
+        if spatial_index is None:
+            spatial_index = SpatialIndex(stops['stop_lat'].to_numpy(), stops['stop_lon'].to_numpy())
+        self._build_footpaths(spatial_index, max_walk_meters)
+
+        trip_routes = feed.trips.drop_duplicates('trip_id').set_index('trip_id')['route_id']
+        self.trip_routes = trip_routes.reindex(feed_index.trip_ids).to_numpy()
+        self.routes = feed.routes.drop_duplicates('route_id').set_index('route_id')[
+            ['route_short_name', 'route_long_name', 'route_color']].fillna('NA').to_dict(orient='index')
+
+    def _build_patterns(self):
+        index = self.feed_index
+        stop_times = self.feed.stop_times
+
+        stop_codes = pd.Index(self.stop_ids).get_indexer(stop_times['stop_id'])
+        arrivals = to_seconds(stop_times['arrival_time'])
+        departures = to_seconds(stop_times['departure_time'])
+        no_pickup = stop_times['pickup_type'].fillna(0).to_numpy() == 1 if 'pickup_type' in stop_times else None
+        no_drop_off = stop_times['drop_off_type'].fillna(0).to_numpy() == 1 if 'drop_off_type' in stop_times else None
+
+        patterns = {}
+        for trip, (start, end) in enumerate(zip(index.trip_starts.tolist(), index.trip_ends.tolist())):
+            codes = stop_codes[start:end]
+            if end - start < 2 or (codes < 0).any() or (arrivals[start:end] < 0).any() or (departures[start:end] < 0).any():
+                continue
+            patterns.setdefault(codes.tobytes(), []).append(trip)
+
+        self.pattern_stops, self.pattern_trips, self.pattern_arrivals, self.pattern_departures = [], [], [], []
+        for trips in patterns.values():
+            trips = np.array(trips)
+            start = index.trip_starts[trips[0]]
+            length = index.trip_ends[trips[0]] - start
+
+            rows = index.trip_starts[trips][:, None] + np.arange(length)[None, :]
+            arr = arrivals[rows]
+            dep = departures[rows].copy()
+            if no_pickup is not None:
+                dep[no_pickup[rows]] = -1
+            if no_drop_off is not None:
+                arr[no_drop_off[rows]] = INF
+
+            order = np.argsort(departures[rows[:, 0]], kind='stable')
+            self.pattern_stops.append(stop_codes[start:start + length].astype(np.int32))
+            self.pattern_trips.append(trips[order].astype(np.int32))
+            self.pattern_arrivals.append(arr[order])
+            self.pattern_departures.append(dep[order])
+
+        # stop -> (pattern, position) lookup in CSR form
+        entry_stops = np.concatenate(self.pattern_stops) if self.pattern_stops else np.empty(0, np.int32)
+        entry_patterns = np.repeat(np.arange(len(self.pattern_stops)), [len(p) for p in self.pattern_stops])
+        entry_positions = np.concatenate([np.arange(len(p)) for p in self.pattern_stops]) if self.pattern_stops else np.empty(0, np.int64)
+        order = np.argsort(entry_stops, kind='stable')
+        self.stop_pattern_offsets = np.searchsorted(entry_stops[order], np.arange(len(self.stop_ids) + 1))
+        self.stop_pattern_ids = entry_patterns[order]
+        self.stop_pattern_positions = entry_positions[order]
+
+    def _build_footpaths(self, spatial_index, max_walk_meters):
+        i, j, meters = spatial_index.pairs_within(max_walk_meters)
+        order = np.lexsort((j, i))
+        self.footpath_offsets = np.searchsorted(i[order], np.arange(len(self.stop_ids) + 1))
+        self.footpath_targets = j[order]
+        self.footpath_seconds = np.ceil(meters[order] / self.walk_speed).astype(np.int32)
+
+    def _date_view(self, date):
+        """Per-pattern (trip rows, arrivals, departures) restricted to trips running on date."""
+        view = self._date_views.get(date)
+        if view is not None:
+            self._date_views.move_to_end(date)
+            return view
+
+        active = self.feed_index.active_trips(date)
+        view = []
+        for trips, arr, dep in zip(self.pattern_trips, self.pattern_arrivals, self.pattern_departures):
+            running = active[trips]
+            view.append((trips[running], arr[running], dep[running]) if running.any() else None)
+
+        self._date_views[date] = view
+        if len(self._date_views) > self.max_cached_dates:
+            self._date_views.popitem(last=False)
+        return view
+
+    def _new_labels(self, rounds):
+        n_stops = len(self.stop_ids)
+        return {
+            'tau': np.full((rounds + 1, n_stops), INF, dtype=np.int32),
+            'best': np.full(n_stops, INF, dtype=np.int32),
+            'kind': np.zeros((rounds + 1, n_stops), dtype=np.int8),
+            'from': np.zeros((rounds + 1, n_stops), dtype=np.int32),
+            'trip': np.zeros((rounds + 1, n_stops), dtype=np.int32),
+            'board': np.zeros((rounds + 1, n_stops), dtype=np.int32),
+            'alight': np.zeros((rounds + 1, n_stops), dtype=np.int32),
+        }
+
+    def _walk(self, labels, k, stops, source_times):
+        """Relax footpaths out of stops (reached at source_times) into round k."""
+        edges, counts = csr_entries(self.footpath_offsets, stops)
+        if not len(edges):
+            return np.empty(0, dtype=np.int64)
+
+        origins = np.repeat(stops, counts)
+        targets = self.footpath_targets[edges]
+        arrivals = np.repeat(source_times, counts).astype(np.int64) + self.footpath_seconds[edges]
+
+        # Best footpath per target stop
+        order = np.lexsort((arrivals, targets))
+        targets, origins, arrivals = targets[order], origins[order], arrivals[order]
+        first = np.r_[True, targets[1:] != targets[:-1]]
+        targets, origins, arrivals = targets[first], origins[first], arrivals[first]
+
+        improved = arrivals < np.minimum(labels['tau'][k, targets], labels['best'][targets])
+        targets, origins, arrivals = targets[improved], origins[improved], arrivals[improved]
+
+        labels['tau'][k, targets] = arrivals
+        labels['best'][targets] = np.minimum(labels['best'][targets], arrivals)
+        labels['kind'][k, targets] = WALK
+        labels['from'][k, targets] = origins
+        return targets
+
+    def _scan(self, labels, view, k, marked, target_best, change_seconds):
+        """Round k: scan every pattern serving a stop improved in round k - 1."""
+        tau, best = labels['tau'], labels['best']
+
+        # tau_k starts from tau_(k-1); labels kept from a later departure (profile
+        # queries) stay when they are still better
+        copied = tau[k - 1] < tau[k]
+        tau[k, copied] = tau[k - 1, copied]
+        labels['kind'][k, copied] = NONE
+
+        # Earliest marked position of every pattern serving a marked stop
+        entries, _ = csr_entries(self.stop_pattern_offsets, marked)
+        earliest = np.full(len(self.pattern_stops), INF, dtype=np.int64)
+        np.minimum.at(earliest, self.stop_pattern_ids[entries], self.stop_pattern_positions[entries])
+        patterns = np.flatnonzero(earliest < INF)
+
+        boarding_times = tau[k - 1].astype(np.int64)
+        if k > 1:
+            boarding_times = boarding_times + change_seconds
+
+        improved_stops = []
+        for pattern, first in zip(patterns.tolist(), earliest[patterns].tolist()):
+            if view[pattern] is None:
+                continue
+            _, arr, dep = view[pattern]
+            stops = self.pattern_stops[pattern][first:]
+            n_trips, length = arr.shape[0], len(stops)
+
+            # First catchable trip at each position; the trip ridden at position j is the
+            # earliest one caught at any position before j
+            positions = np.arange(length)
+            catchable = dep[:, first:] >= boarding_times[stops]
+            trip_at = catchable.argmax(axis=0)
+            trip_at[~catchable[trip_at, positions]] = n_trips
+            ridden = np.minimum.accumulate(trip_at.astype(np.int64) * (length + 1) + positions)[:-1]
+            trips, boards = ridden // (length + 1), ridden % (length + 1)
+
+            on_board = np.flatnonzero(trips < n_trips)
+            if not len(on_board):
+                continue
+            arrivals = arr[trips[on_board], first + 1 + on_board]
+            better = arrivals < np.minimum(best[stops[on_board + 1]], target_best())
+            for ride, arrival in zip(on_board[better].tolist(), arrivals[better].tolist()):
+                stop = stops[ride + 1]
+                if arrival < tau[k, stop] and arrival < best[stop]:
+                    tau[k, stop] = arrival
+                    best[stop] = arrival
+                    labels['kind'][k, stop] = TRANSIT
+                    labels['from'][k, stop] = pattern
+                    labels['trip'][k, stop] = trips[ride]
+                    labels['board'][k, stop] = first + boards[ride]
+                    labels['alight'][k, stop] = first + 1 + ride
+                    improved_stops.append(stop)
+
+        improved_stops = np.unique(np.array(improved_stops, dtype=np.int64))
+        walked = self._walk(labels, k, improved_stops, tau[k, improved_stops]) if len(improved_stops) else improved_stops
+        return np.union1d(improved_stops, walked)
+
+    def _search(self, labels, view, sources, departure, targets, rounds, change_seconds):
+        """One round-based search from sources at departure; labels are updated in place."""
+        tau = labels['tau']
+
+        improved = sources[departure < np.minimum(tau[0, sources], labels['best'][sources])]
+        tau[0, improved] = departure
+        labels['best'][improved] = departure
+        labels['kind'][0, improved] = NONE
+        marked = np.union1d(improved, self._walk(labels, 0, improved, np.full(len(improved), departure)))
+
+        target_best = lambda: labels['best'][targets].min()
+        for k in range(1, rounds + 1):
+            if not len(marked):
+                break
+            marked = self._scan(labels, view, k, marked, target_best, change_seconds)
+
+    def _journey(self, labels, view, k, stop, sources):
+        """Backtrack the legs of the round k label of stop."""
+        legs = []
+        while True:
+            kind = labels['kind'][k, stop]
+            if kind == WALK:
+                origin = labels['from'][k, stop]
+                legs.append(self._walk_leg(origin, stop))
+                stop = origin
+                if k == 0:
+                    break
+                continue
+            if kind == TRANSIT:
+                pattern = labels['from'][k, stop]
+                trips, arr, dep = view[pattern]
+                row, board, alight = labels['trip'][k, stop], labels['board'][k, stop], labels['alight'][k, stop]
+                legs.append(self._transit_leg(pattern, trips[row], dep[row, board], arr[row, alight], board, alight))
+                stop = self.pattern_stops[pattern][board]
+                k -= 1
+                continue
+            if k == 0 or stop in sources:
+                break
+            k -= 1
+
+        legs.reverse()
+        return legs
+
+    def _walk_leg(self, origin, stop):
+        start, end = self.footpath_offsets[origin], self.footpath_offsets[origin + 1]
+        walk_seconds = int(self.footpath_seconds[start:end][self.footpath_targets[start:end] == stop][0])
+        return {
+            'mode': 'walk',
+            'from_stop_id': self.stop_ids[origin],
+            'from_stop_name': self.stop_names[origin],
+            'to_stop_id': self.stop_ids[stop],
+            'to_stop_name': self.stop_names[stop],
+            'duration_seconds': walk_seconds,
+        }
+
+    def _transit_leg(self, pattern, trip, departure, arrival, board, alight):
+        route_id = self.trip_routes[trip]
+        route = self.routes.get(route_id, {})
+        from_stop, to_stop = self.pattern_stops[pattern][board], self.pattern_stops[pattern][alight]
+        return {
+            'mode': 'transit',
+            'trip_id': self.feed_index.trip_ids[trip],
+            'route_id': route_id,
+            'route_short_name': route.get('route_short_name'),
+            'route_long_name': route.get('route_long_name'),
+            'route_color': route.get('route_color'),
+            'from_stop_id': self.stop_ids[from_stop],
+            'from_stop_name': self.stop_names[from_stop],
+            'to_stop_id': self.stop_ids[to_stop],
+            'to_stop_name': self.stop_names[to_stop],
+            'departure_seconds': int(departure),
+            'arrival_seconds': int(arrival),
+            'num_stops': int(alight - board),
+        }
+
+    def _format(self, legs, arrival):
+        """Journey dict with HH:MM:SS times from backtracked legs."""
+        transit = [leg for leg in legs if leg['mode'] == 'transit']
+        departure = transit[0]['departure_seconds'] if transit else arrival
+        # Walking to the first boarding stop shifts the departure from the origin
+        for leg in legs:
+            if leg['mode'] == 'transit':
+                break
+            departure -= leg['duration_seconds']
+
+        for leg in transit:
+            leg['departure_time'] = to_timestr(leg.pop('departure_seconds'))
+            leg['arrival_time'] = to_timestr(leg.pop('arrival_seconds'))
+
+        return {
+            'departure_time': to_timestr(departure),
+            'arrival_time': to_timestr(arrival),
+            'duration_minutes': round((arrival - departure) / 60, 2),
+            'transfers': max(len(transit) - 1, 0),
+            'departure_seconds': int(departure),
+            'arrival_seconds': int(arrival),
+            'legs': legs,
+        }
+
+    def _stop_codes(self, stop_ids):
+        codes = [self.stop_codes[stop_id] for stop_id in stop_ids if stop_id in self.stop_codes]
+        return np.unique(np.array(codes, dtype=np.int64))
+
+    def _collect(self, labels, view, sources, targets, rounds, seen):
+        """
+        New Pareto journeys, one per round that improved the arrival at a target
+        (round 0 being a walk from the source).
+        """
+        journeys = []
+        best_arrival = INF
+        for k in range(rounds + 1):
+            arrivals = labels['tau'][k, targets]
+            target = targets[arrivals.argmin()]
+            arrival = int(arrivals.min())
+            if arrival >= best_arrival or labels['kind'][k, target] == NONE:
+                best_arrival = min(best_arrival, arrival)
+                continue
+            best_arrival = arrival
+
+            legs = self._journey(labels, view, k, target, set(sources.tolist()))
+            journey = self._format(legs, arrival)
+            key = (journey['departure_seconds'], journey['arrival_seconds'], journey['transfers'])
+            if key not in seen:
+                seen.add(key)
+                journeys.append(journey)
+        return journeys
+
+    def earliest_arrival(self, source_stop_ids, target_stop_ids, date, departure, max_transfers=3, change_seconds=60):
+        """
+        Journeys leaving any source stop at or after departure (seconds) on a YYYYMMDD
+        date, one per number of transfers that improves the arrival time at a target.
+        """
+        sources, targets = self._stop_codes(source_stop_ids), self._stop_codes(target_stop_ids)
+        if not len(sources) or not len(targets):
+            return []
+
+        rounds = max_transfers + 1
+        view = self._date_view(date)
+        labels = self._new_labels(rounds)
+        self._search(labels, view, sources, departure, targets, rounds, change_seconds)
+        return self._collect(labels, view, sources, targets, rounds, set())
+
+    def profile(self, source_stop_ids, target_stop_ids, date, window_start, window_end, max_transfers=3, change_seconds=60):
+        """
+        Pareto-optimal journeys (later departure, earlier arrival, fewer transfers) for
+        every departure from the sources between window_start and window_end (seconds).
+        """
+        sources, targets = self._stop_codes(source_stop_ids), self._stop_codes(target_stop_ids)
+        if not len(sources) or not len(targets):
+            return []
+
+        rounds = max_transfers + 1
+        view = self._date_view(date)
+        departures = self._departures(view, sources, window_start, window_end)
+
+        labels = self._new_labels(rounds)
+        journeys, seen = [], set()
+        for departure in departures[::-1]:
+            self._search(labels, view, sources, int(departure), targets, rounds, change_seconds)
+            journeys.extend(self._collect(labels, view, sources, targets, rounds, seen))
+
+        pareto = [
+            journey for journey in journeys
+            if not any(other is not journey
+                       and other['departure_seconds'] >= journey['departure_seconds']
+                       and other['arrival_seconds'] <= journey['arrival_seconds']
+                       and other['transfers'] <= journey['transfers']
+                       and (other['departure_seconds'], other['arrival_seconds'], other['transfers']) !=
+                           (journey['departure_seconds'], journey['arrival_seconds'], journey['transfers'])
+                       for other in journeys)
+        ]
+        return sorted(pareto, key=lambda journey: (journey['departure_seconds'], journey['transfers']))
+
+    def _departures(self, view, sources, window_start, window_end):
+        """Distinct times at which a vehicle can be caught from a source (directly or on foot)."""
+        times = []
+        origins = [(source, 0) for source in sources.tolist()]
+        for source in sources.tolist():
+            start, end = self.footpath_offsets[source], self.footpath_offsets[source + 1]
+            origins.extend(zip(self.footpath_targets[start:end].tolist(), self.footpath_seconds[start:end].tolist()))
+
+        for stop, walk_seconds in origins:
+            for entry in range(self.stop_pattern_offsets[stop], self.stop_pattern_offsets[stop + 1]):
+                pattern_view = view[self.stop_pattern_ids[entry]]
+                if pattern_view is None:
+                    continue
+                dep = pattern_view[2][:, self.stop_pattern_positions[entry]]
+                times.append(dep[dep >= 0] - walk_seconds)
+
+        if not times:
+            return np.empty(0, dtype=np.int64)
+        times = np.unique(np.concatenate(times))
+        return times[(times >= window_start) & (times <= window_end)]
@@ -0,0 +1,168 @@
+"""
+Scheduled speeds of the stop-to-stop segments of the network, by hour of day.
+
+Every hop of every trip (a stop_times row and the one before it) is a traversal of
+the segment (from stop, to stop), taking the seconds from the departure at the first
+stop to the arrival at the second over the shape_dist_traveled between them (the
+straight-line distance between the stops where the feed has none, or less than
+MIN_HOP_KM). Segments shorter than MIN_SEGMENT_KM, and those between two stops of
+the same name (the two bays of a school or terminal a trip lays over between), are
+left out: their scheduled "speed" is a wait, not traffic. The hops come from the
+per-hop arrays of FeedIndex and are summed once, with np.bincount, into a table of
+(segment, route, service_id, hour of departure) groups holding the number of
+traversals, their seconds and their kilometers.
+
+A query masks the groups of the requested routes / hours / services / bbox and sums
+what is left per segment (or per segment and hour) the same way, so the speed of a
+segment is the kilometers of all its traversals over their hours.
+"""
+import numpy as np
+import pandas as pd
+
+from name_search import normalize_name
+from spatial_index import haversine_meters
+
+
+HOURS = 24
+
+# Shape distances below this fall back to the straight line between the stops (km)
+MIN_HOP_KM = 0.01
+
+# Segments shorter than this are not in the table (km)
+MIN_SEGMENT_KM = 0.05
+
+
+class SegmentSpeeds:
+
+    def __init__(self, feed_index):
+        feed = feed_index.feed
+        stop_times = feed.stop_times
+
+        first = np.zeros(len(stop_times), dtype=bool)
+        first[feed_index.trip_starts] = True
+        rows = np.flatnonzero(~first & np.isfinite(feed_index.hop_seconds))
+
+        stop_ids = pd.Index(feed.stops['stop_id'])
+        stop_codes = stop_ids.get_indexer(stop_times['stop_id'].to_numpy())
+        from_stops, to_stops = stop_codes[rows - 1], stop_codes[rows]
+
+        # Trip, route and service of every hop
+        trip_codes = np.searchsorted(feed_index.trip_starts, rows, side='right') - 1
+        trips = feed.trips.drop_duplicates('trip_id').set_index('trip_id').reindex(feed_index.trip_ids)
+        route_codes, route_ids = pd.factorize(trips['route_id'].to_numpy()[trip_codes], sort=True)
+        service_codes, service_ids = pd.factorize(trips['service_id'].to_numpy()[trip_codes], sort=True)
+        self.route_ids, self.service_ids = pd.Index(route_ids), pd.Index(service_ids)
+
+        known = (from_stops >= 0) & (to_stops >= 0) & (route_codes >= 0) & (service_codes >= 0)
+        rows, trip_codes, from_stops, to_stops = rows[known], trip_codes[known], from_stops[known], to_stops[known]
+        route_codes, service_codes = route_codes[known], service_codes[known]
+        hours = (feed_index.departure_seconds[rows - 1] // 3600) % HOURS
+
+        lats = feed.stops['stop_lat'].to_numpy(dtype=float)
+        lons = feed.stops['stop_lon'].to_numpy(dtype=float)
+        km = feed_index.hop_distances[rows]
+        straight = haversine_meters(lats[from_stops], lons[from_stops], lats[to_stops], lons[to_stops]) / 1000
+        km = np.where(km >= MIN_HOP_KM, km, straight)
+
+        names = np.array([normalize_name(name) if isinstance(name, str) else None for name in feed.stops['stop_name']], dtype=object) \
+            if 'stop_name' in feed.stops else np.full(len(stop_ids), None)
+        same_name = pd.notna(names[from_stops]) & (names[from_stops] == names[to_stops])
+        keep = (km >= MIN_SEGMENT_KM) & ~same_name
+        rows, trip_codes, from_stops, to_stops = rows[keep], trip_codes[keep], from_stops[keep], to_stops[keep]
+        route_codes, service_codes, hours, km = route_codes[keep], service_codes[keep], hours[keep], km[keep]
+
+        # Segments: distinct (from stop, to stop) pairs, with the first hop of each as its sample trip
+        segment_keys = from_stops.astype(np.int64) * len(stop_ids) + to_stops
+        _, sample_hops, segment_codes = np.unique(segment_keys, return_index=True, return_inverse=True)
+        sample_rows = rows[sample_hops]
+        self.stop_ids = stop_ids.to_numpy()
+        self.stop_names = feed.stops['stop_name'].to_numpy() if 'stop_name' in feed.stops else np.full(len(stop_ids), None)
+        self.from_stops, self.to_stops = from_stops[sample_hops], to_stops[sample_hops]
+        self.from_lats, self.from_lons = lats[self.from_stops], lons[self.from_stops]
+        self.to_lats, self.to_lons = lats[self.to_stops], lons[self.to_stops]
+        self.shape_ids = trips['shape_id'].to_numpy()[trip_codes[sample_hops]] if 'shape_id' in trips \
+            else np.full(len(sample_rows), None)
+        self.from_distances, self.to_distances = feed_index.distances[sample_rows - 1], feed_index.distances[sample_rows]
+
+        # (segment, route, service, hour) groups
+        group_keys = ((segment_codes.astype(np.int64) * len(self.route_ids) + route_codes)
+                      * len(self.service_ids) + service_codes) * HOURS + hours
+        group_keys, groups = np.unique(group_keys, return_inverse=True)
+        self.group_hours = (group_keys % HOURS).astype(np.int8)
+        group_keys //= HOURS
+        self.group_services = (group_keys % len(self.service_ids)).astype(np.int32)
+        group_keys //= len(self.service_ids)
+        self.group_routes = (group_keys % len(self.route_ids)).astype(np.int32)
+        self.group_segments = (group_keys // len(self.route_ids)).astype(np.int32)
+        self.group_trips = np.bincount(groups, minlength=len(group_keys))
+        self.group_seconds = np.bincount(groups, weights=feed_index.hop_seconds[rows], minlength=len(group_keys))
+        self.group_km = np.bincount(groups, weights=km, minlength=len(group_keys))
+
+    def __len__(self):
+        return len(self.from_stops)
+
+    def query(self, route_ids=None, hours=None, services=None, bbox=None, by_hour=False):
+        """
+        Segments traversed by the matching groups, as a DataFrame with the segment code,
+        the hour (by_hour only), trips, mean seconds, km and speed_kmph (None when the
+        schedule gives the segment no time), and the route_ids using it.
+          route_ids / hours / services: iterables to keep (None: all)
+          bbox: (min_lat, min_lon, max_lat, max_lon); a segment with either stop inside
+        """
+        keep = np.ones(len(self.group_segments), dtype=bool)
+        if route_ids is not None:
+            keep &= np.isin(self.group_routes, self.route_ids.get_indexer(list(route_ids)))
+        if hours is not None:
+            keep &= np.isin(self.group_hours, list(hours))
+        if services is not None:
+            keep &= np.isin(self.group_services, self.service_ids.get_indexer(list(services)))
+        if bbox is not None:
+            min_lat, min_lon, max_lat, max_lon = bbox
+            inside = (((self.from_lats >= min_lat) & (self.from_lats <= max_lat) &
+                       (self.from_lons >= min_lon) & (self.from_lons <= max_lon)) |
+                      ((self.to_lats >= min_lat) & (self.to_lats <= max_lat) &
+                       (self.to_lons >= min_lon) & (self.to_lons <= max_lon)))
+            keep &= inside[self.group_segments]
+        groups = np.flatnonzero(keep)
+
+        keys = self.group_segments[groups].astype(np.int64)
+        if by_hour:
+            keys = keys * HOURS + self.group_hours[groups]
+        keys, rows = np.unique(keys, return_inverse=True)
+        trips = np.bincount(rows, weights=self.group_trips[groups], minlength=len(keys))
+        seconds = np.bincount(rows, weights=self.group_seconds[groups], minlength=len(keys))
+        km = np.bincount(rows, weights=self.group_km[groups], minlength=len(keys))
+
+        # Routes per output row: the distinct (row, route) pairs, split by row
+        pairs = np.unique(rows.astype(np.int64) * len(self.route_ids) + self.group_routes[groups])
+        route_codes = np.split(pairs % len(self.route_ids), np.searchsorted(pairs // len(self.route_ids), np.arange(1, len(keys)))) \
+            if len(keys) else []
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            speeds = np.where(seconds > 0, km / (seconds / 3600), np.nan)
+        table = pd.DataFrame({
+            'segment': keys // HOURS if by_hour else keys,
+            'trips': trips.astype(np.int64),
+            'mean_seconds': seconds / trips,
+            'km': km / trips,
+            'speed_kmph': speeds,
+        })
+        if by_hour:
+            table.insert(1, 'hour', keys % HOURS)
+        route_ids = self.route_ids.to_numpy()
+        table['route_ids'] = [route_ids[codes].tolist() for codes in route_codes]
+        return table
+
+    def segment_record(self, segment):
+        """Stops of a segment as a dict."""
+        return {
+            'from_stop_id': self.stop_ids[self.from_stops[segment]],
+            'from_stop_name': self.stop_names[self.from_stops[segment]],
+            'to_stop_id': self.stop_ids[self.to_stops[segment]],
+            'to_stop_name': self.stop_names[self.to_stops[segment]],
+        }
+
+    def ends(self, segment):
+        """(lat, lon, shape_dist_traveled) of the two stops of a segment, to clip its sample shape with."""
+        return ((self.from_lats[segment], self.from_lons[segment], self.from_distances[segment]),
+                (self.to_lats[segment], self.to_lons[segment], self.to_distances[segment]))
@@ -0,0 +1,199 @@
+"""
+Route geometries of the GTFS feed, grouped once at load time.
+
+shapes is sorted by (shape_id, shape_pt_sequence) into parallel coordinate and
+distance arrays, so the points of a shape are one contiguous slice. Every point also
+gets a Douglas-Peucker rank: the largest tolerance (in meters) at which the
+simplification still keeps it. Simplifying a shape to any tolerance is then a mask
+over its slice, and the zoom levels of SIMPLIFY_TOLERANCES are views of the same
+arrays rather than separate copies.
+
+A geometry can be clipped to the part between two stops of a trip and returned as
+[lat, lon] pairs or as an encoded polyline (Google's algorithm, 5 decimals), which is
+what Leaflet plugins and most map SDKs decode.
+"""
+import math
+
+import numpy as np
+import pandas as pd
+
+
+EARTH_RADIUS_M = 6371000.0
+
+# Named zoom levels -> Douglas-Peucker tolerance in meters (None: every point)
+SIMPLIFY_TOLERANCES = {'full': None, 'high': 2.0, 'medium': 10.0, 'low': 50.0}
+
+# Points closer than this to the simplified line are dropped at every tolerance
+MIN_TOLERANCE_M = 0.5
+
+_NO_POINTS = np.empty((0, 2))
+
+
+def parse_tolerance(value):
+    """Tolerance in meters for a zoom level name or a number of meters (None or 'full': no simplification)."""
+    if value is None or value == '':
+        return None
+    if value in SIMPLIFY_TOLERANCES:
+        return SIMPLIFY_TOLERANCES[value]
+    tolerance = float(value)
+    if not math.isfinite(tolerance) or tolerance < 0:
+        raise ValueError(f"Invalid tolerance {value!r}")
+    return tolerance or None
+
+def segment_distances(x, y, x0, y0, x1, y1):
+    """Distance of the points (x, y) to the segments (x0, y0) - (x1, y1), element-wise."""
+    dx, dy = x1 - x0, y1 - y0
+    length2 = dx * dx + dy * dy
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Degenerate segments (closed loops) measure the distance to their one point
+        t = np.clip(np.where(length2 > 0, ((x - x0) * dx + (y - y0) * dy) / length2, 0.0), 0.0, 1.0)
+    return np.hypot(x - (x0 + t * dx), y - (y0 + t * dy))
+
+def douglas_peucker_ranks(x, y, bounds, min_tolerance=MIN_TOLERANCE_M):
+    """
+    Per point of the lines bounds[i]:bounds[i + 1], the largest tolerance at which
+    Douglas-Peucker keeps it (inf for the end points, 0 for points within
+    min_tolerance of the line). The split points do not depend on the tolerance, so a
+    point is kept at tolerance t exactly when its own split distance and those of all
+    the splits above it exceed t. All lines are split together, one level of the
+    recursion per step.
+    """
+    ranks = np.zeros(len(x))
+    bounds = np.asarray(bounds)
+    lines = bounds[1:] > bounds[:-1]
+    first, last = bounds[:-1][lines], bounds[1:][lines] - 1
+    ranks[first] = ranks[last] = np.inf
+    parent = np.full(len(first), np.inf)
+
+    while True:
+        active = last - first >= 2
+        first, last, parent = first[active], last[active], parent[active]
+        if not len(first):
+            break
+
+        # The interior points of every open segment, segment after segment
+        counts = last - first - 1
+        offsets = np.cumsum(counts) - counts
+        segment = np.repeat(np.arange(len(first)), counts)
+        points = first[segment] + 1 + np.arange(counts.sum()) - offsets[segment]
+
+        dist = segment_distances(x[points], y[points], x[first][segment], y[first][segment],
+                                 x[last][segment], y[last][segment])
+        farthest = np.maximum.reduceat(dist, offsets)
+        # First point at the maximum of each segment, as np.argmax would pick
+        at_max = np.flatnonzero(dist == farthest[segment])
+        at_max = at_max[np.r_[True, segment[at_max][1:] != segment[at_max][:-1]]]
+        split = points[at_max]
+
+        splits = farthest >= min_tolerance
+        rank = np.minimum(farthest, parent)[splits]
+        split = split[splits]
+        ranks[split] = rank
+        first, last = np.r_[first[splits], split], np.r_[split, last[splits]]
+        parent = np.r_[rank, rank]
+    return ranks
+
+def encode_polyline(coords, precision=5):
+    """Encoded polyline of [lat, lon] pairs."""
+    if len(coords) == 0:
+        return ''
+    values = np.round(np.asarray(coords, dtype=float) * 10 ** precision).astype(np.int64)
+    deltas = np.diff(values, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+
+    chunks = []
+    for value in ((deltas << 1) ^ (deltas >> 63)).tolist():
+        while value >= 0x20:
+            chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chunks.append(chr(value + 63))
+    return ''.join(chunks)
+
+
+class ShapeIndex:
+
+    def __init__(self, feed, min_tolerance=MIN_TOLERANCE_M):
+        shapes = feed.shapes
+        if shapes is None or shapes.empty:
+            shapes = pd.DataFrame({'shape_id': [], 'shape_pt_lat': [], 'shape_pt_lon': [], 'shape_pt_sequence': []})
+        shapes = shapes.sort_values(['shape_id', 'shape_pt_sequence'], kind='stable')
+
+        shape_codes, shape_ids = pd.factorize(shapes['shape_id'], sort=True)
+        bounds = np.searchsorted(shape_codes, np.arange(len(shape_ids) + 1))
+        self.shape_ranges = dict(zip(shape_ids.astype(str), zip(bounds[:-1].tolist(), bounds[1:].tolist())))
+
+        self.coords = np.column_stack([shapes['shape_pt_lat'].to_numpy(dtype=float),
+                                       shapes['shape_pt_lon'].to_numpy(dtype=float)])
+
+        # Equirectangular projection around the feed's mean latitude, in meters
+        self.lat0 = math.radians(float(np.nanmean(self.coords[:, 0]))) if len(self.coords) else 0.0
+        self.x = np.radians(self.coords[:, 1]) * EARTH_RADIUS_M * math.cos(self.lat0)
+        self.y = np.radians(self.coords[:, 0]) * EARTH_RADIUS_M
+
+        # shape_dist_traveled where the feed has it (the units of stop_times), else NaN
+        if 'shape_dist_traveled' in shapes:
+            self.dist = shapes['shape_dist_traveled'].to_numpy(dtype=float)
+        else:
+            self.dist = np.full(len(shapes), np.nan)
+
+        self.ranks = douglas_peucker_ranks(self.x, self.y, bounds, min_tolerance)
+
+    def __contains__(self, shape_id):
+        return str(shape_id) in self.shape_ranges
+
+    def shape_range(self, shape_id):
+        """(start, end) offsets of a shape's points, (0, 0) if unknown."""
+        return self.shape_ranges.get(str(shape_id), (0, 0))
+
+    def locate(self, shape_id, lat, lon, after=0):
+        """Offset (within the shape) of the point closest to (lat, lon), searching from offset after on."""
+        start, end = self.shape_range(shape_id)
+        start = min(start + after, end)
+        if start == end:
+            return None
+        x = math.radians(lon) * EARTH_RADIUS_M * math.cos(self.lat0)
+        y = math.radians(lat) * EARTH_RADIUS_M
+        return after + int(np.argmin(np.hypot(self.x[start:end] - x, self.y[start:end] - y)))
+
+    def _clip(self, shape_id, start_stop, end_stop):
+        """
+        (first, last, head, tail) for the part of a shape between two stops, each given
+        as (lat, lon, shape_dist_traveled): the offsets of the shape points in between
+        and the [lat, lon] of its two ends. With both distances known the ends are
+        interpolated at those distances along the shape, otherwise they are the points
+        closest to the stops.
+        """
+        start, end = self.shape_range(shape_id)
+        dist, coords = self.dist[start:end], self.coords[start:end]
+        (start_lat, start_lon, start_dist), (end_lat, end_lon, end_dist) = start_stop, end_stop
+
+        if np.isfinite(start_dist) and np.isfinite(end_dist) and np.isfinite(dist).all():
+            first = int(np.searchsorted(dist, start_dist, side='right'))
+            last = int(np.searchsorted(dist, end_dist, side='left')) - 1
+            head, tail = (np.array([np.interp(d, dist, coords[:, 0]), np.interp(d, dist, coords[:, 1])])
+                          for d in (start_dist, end_dist))
+        else:
+            first = self.locate(shape_id, start_lat, start_lon)
+            last = self.locate(shape_id, end_lat, end_lon, after=first)
+            head, tail = coords[first], coords[last]
+            first, last = first + 1, last - 1
+        return first, last, head, tail
+
+    def geometry(self, shape_id, tolerance=None, start_stop=None, end_stop=None):
+        """
+        [lat, lon] array of a shape, simplified to tolerance meters (None: every point)
+        and optionally clipped to the part between start_stop and end_stop, each given
+        as (lat, lon, shape_dist_traveled).
+        """
+        start, end = self.shape_range(shape_id)
+        if start == end:
+            return _NO_POINTS
+        if start_stop is None or end_stop is None:
+            coords, ranks = self.coords[start:end], self.ranks[start:end]
+            return coords[ranks > tolerance] if tolerance else coords
+
+        first, last, head, tail = self._clip(shape_id, start_stop, end_stop)
+        coords, ranks = self.coords[start + first:start + last + 1], self.ranks[start + first:start + last + 1]
+        if tolerance:
+            # Ranks are those of the whole shape; the clipped part adds its own two ends
+            coords = coords[ranks > tolerance]
+        return np.vstack([head, coords, tail])
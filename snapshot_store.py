@@ -0,0 +1,90 @@
+import os
+import json
+import sqlite3
+import datetime
+import threading
+
+
+DEFAULT_SNAPSHOT_DB = os.getenv("ANALYTICS_SNAPSHOT_DB", "analytics_snapshots.db")
+
+
+def dump_payload(payload):
+    """Serialise a payload the way Flask's jsonify does (sorted keys, compact)."""
+    return json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+
+
+class SnapshotStore:
+    """
+    Precomputed per-date analytics payloads, one row per (endpoint, date).
+
+    Payloads are stored as ready-to-send JSON text so serving a materialized date
+    is a single primary-key lookup with no pandas work at all. The store lives in
+    its own SQLite file so the text-to-SQL schema of nyc_gtfs.db is unaffected.
+    Every row carries the key of the feed it was computed from (feed_snapshot's
+    zip_digest), and only the rows of the loaded feed are served: after the zip or
+    the cleaning changes, dates fall back to live computation until re-materialized.
+    """
+
+    def __init__(self, db_path=DEFAULT_SNAPSHOT_DB):
+        self.db_path = db_path
+        self._local = threading.local()
+
+    def _reader(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+            self._local.conn = conn
+        return conn
+
+    def get(self, endpoint, date, feed_key):
+        """JSON text for (endpoint, date) materialized from the feed_key feed, or None to fall back to live computation."""
+        if not os.path.exists(self.db_path):
+            return None
+        try:
+            row = self._reader().execute(
+                "SELECT payload FROM AnalyticsSnapshots WHERE endpoint = ? AND date = ? AND feed_key = ?",
+                (endpoint, date, feed_key),
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+        return row[0] if row else None
+
+    def connect(self):
+        """Writable connection with the snapshot schema in place."""
+        conn = sqlite3.connect(self.db_path)
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(AnalyticsSnapshots)")]
+        if columns and 'feed_key' not in columns:
+            # Written before the rows were keyed by feed: none of them can be served
+            conn.execute("DROP TABLE AnalyticsSnapshots")
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS AnalyticsSnapshots (
+            endpoint TEXT NOT NULL,
+            date TEXT NOT NULL,
+            feed_key TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            PRIMARY KEY (endpoint, date)
+        ) WITHOUT ROWID
+        ''')
+        return conn
+
+    def put_many(self, conn, rows, feed_key):
+        """Upsert (endpoint, date, payload_dict) rows of the feed_key feed in one transaction."""
+        created_at = datetime.datetime.now().isoformat(timespec='seconds')
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO AnalyticsSnapshots (endpoint, date, feed_key, payload, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(endpoint, date, feed_key, dump_payload(payload), created_at) for endpoint, date, payload in rows],
+            )
+
+    def materialized_dates(self, feed_key):
+        """Dates that have at least one payload materialized from the feed_key feed."""
+        if not os.path.exists(self.db_path):
+            return []
+        try:
+            rows = self._reader().execute(
+                "SELECT DISTINCT date FROM AnalyticsSnapshots WHERE feed_key = ? ORDER BY date", (feed_key,)
+            ).fetchall()
+        except sqlite3.Error:
+            return []
+        return [row[0] for row in rows]
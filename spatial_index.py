@@ -0,0 +1,132 @@
+"""
+Grid index over point coordinates (the feed's stops), for radius, nearest and bbox
+queries and for the all-pairs walking distances of the journey planner.
+
+Points are projected to meters (equirectangular around the mean latitude) and bucketed
+into square cells. The cells are numbered row by row and the points sorted by cell, so
+the cells of one grid row between two columns are one contiguous slice: a query reads
+one slice per row it spans (found with a vectorized searchsorted) and computes exact
+haversine distances only for those candidates.
+"""
+import math
+
+import numpy as np
+
+
+EARTH_RADIUS_M = 6371000.0
+
+# Side of a grid cell in meters
+DEFAULT_CELL_METERS = 250.0
+
+
+def haversine_meters(lat, lon, lats, lons):
+    """Great-circle distance in meters from (lat, lon) to each of (lats, lons), element-wise."""
+    lat, lon, lats, lons = np.radians(lat), np.radians(lon), np.radians(lats), np.radians(lons)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class SpatialIndex:
+
+    def __init__(self, lats, lons, cell_meters=DEFAULT_CELL_METERS):
+        self.lats = np.asarray(lats, dtype=float)
+        self.lons = np.asarray(lons, dtype=float)
+        self.cell_meters = float(cell_meters)
+
+        # Points without coordinates are never returned
+        valid = np.flatnonzero(np.isfinite(self.lats) & np.isfinite(self.lons))
+        self.lat0 = math.radians(float(self.lats[valid].mean())) if len(valid) else 0.0
+
+        cx, cy = self._cells(self.lats[valid], self.lons[valid])
+        self.min_cx = int(cx.min()) if len(valid) else 0
+        self.min_cy = int(cy.min()) if len(valid) else 0
+        self.columns = int(cx.max()) - self.min_cx + 1 if len(valid) else 1
+        self.rows = int(cy.max()) - self.min_cy + 1 if len(valid) else 0
+
+        keys = (cy - self.min_cy) * self.columns + (cx - self.min_cx)
+        order = np.argsort(keys, kind='stable')
+        self.cell_keys = keys[order]
+        self.points = valid[order]
+
+    def __len__(self):
+        return len(self.points)
+
+    def _cells(self, lats, lons):
+        x = np.radians(lons) * EARTH_RADIUS_M * math.cos(self.lat0)
+        y = np.radians(lats) * EARTH_RADIUS_M
+        return np.floor(x / self.cell_meters).astype(np.int64), np.floor(y / self.cell_meters).astype(np.int64)
+
+    def _cell(self, lat, lon):
+        x = math.radians(lon) * EARTH_RADIUS_M * math.cos(self.lat0)
+        y = math.radians(lat) * EARTH_RADIUS_M
+        return math.floor(x / self.cell_meters) - self.min_cx, math.floor(y / self.cell_meters) - self.min_cy
+
+    def _row_ranges(self, cx0, cy0, cx1, cy1):
+        """(starts, ends) into the sorted points of the grid rows cy0..cy1 between columns cx0 and cx1."""
+        cx0, cx1 = max(cx0, 0), min(cx1, self.columns - 1)
+        cy0, cy1 = max(cy0, 0), min(cy1, self.rows - 1)
+        if cx0 > cx1 or cy0 > cy1:
+            return np.empty(0, np.int64), np.empty(0, np.int64)
+        rows = np.arange(cy0, cy1 + 1) * self.columns
+        return np.searchsorted(self.cell_keys, rows + cx0, side='left'), np.searchsorted(self.cell_keys, rows + cx1, side='right')
+
+    def _candidates(self, min_lat, min_lon, max_lat, max_lon):
+        """Positions of the points in the cells covering a lat/lon box."""
+        starts, ends = self._row_ranges(*self._cell(min_lat, min_lon), *self._cell(max_lat, max_lon))
+        counts = ends - starts
+        offsets = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        return self.points[offsets + np.arange(len(offsets))]
+
+    def _radius_box(self, lat, lon, meters):
+        dlat = math.degrees(meters / EARTH_RADIUS_M)
+        dlon = math.degrees(meters / (EARTH_RADIUS_M * max(math.cos(math.radians(lat)), 1e-6)))
+        return lat - dlat, lon - dlon, lat + dlat, lon + dlon
+
+    def within(self, lat, lon, meters, limit=None):
+        """(positions, meters) of the points within meters of (lat, lon), nearest first, at most limit."""
+        candidates = self._candidates(*self._radius_box(lat, lon, meters))
+        distances = haversine_meters(lat, lon, self.lats[candidates], self.lons[candidates])
+        keep = distances <= meters
+        candidates, distances = candidates[keep], distances[keep]
+
+        order = np.argsort(distances, kind='stable')
+        if limit is not None:
+            order = order[:limit]
+        return candidates[order], distances[order]
+
+    def in_bbox(self, min_lat, min_lon, max_lat, max_lon):
+        """Positions of the points inside a lat/lon box, in index order."""
+        candidates = self._candidates(min_lat, min_lon, max_lat, max_lon)
+        lats, lons = self.lats[candidates], self.lons[candidates]
+        inside = (lats >= min_lat) & (lats <= max_lat) & (lons >= min_lon) & (lons <= max_lon)
+        return np.sort(candidates[inside])
+
+    def pairs_within(self, meters):
+        """(i, j, meters) for every ordered pair of distinct points within meters of each other."""
+        if self.cell_meters < meters:
+            # Fewer, larger cells: each is compared with the 3 x 3 block around it
+            return SpatialIndex(self.lats, self.lons, cell_meters=meters).pairs_within(meters)
+
+        reach = int(math.ceil(meters / self.cell_meters))
+        cells, cell_starts = np.unique(self.cell_keys, return_index=True)
+        cell_ends = np.r_[cell_starts[1:], len(self.cell_keys)]
+
+        pairs_i, pairs_j, pairs_d = [], [], []
+        for key, start, end in zip(cells.tolist(), cell_starts.tolist(), cell_ends.tolist()):
+            codes = self.points[start:end]
+            cy, cx = divmod(key, self.columns)
+
+            # Cells within reach in every direction, one key range per row
+            starts, ends = self._row_ranges(cx - reach, cy - reach, cx + reach, cy + reach)
+            neighbours = np.concatenate([self.points[s:e] for s, e in zip(starts.tolist(), ends.tolist())])
+
+            dist = haversine_meters(self.lats[codes][:, None], self.lons[codes][:, None],
+                                    self.lats[neighbours][None, :], self.lons[neighbours][None, :])
+            i, j = np.nonzero((dist <= meters) & (codes[:, None] != neighbours[None, :]))
+            pairs_i.append(codes[i])
+            pairs_j.append(neighbours[j])
+            pairs_d.append(dist[i, j])
+
+        if not pairs_i:
+            return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0)
+        return np.concatenate(pairs_i), np.concatenate(pairs_j), np.concatenate(pairs_d)
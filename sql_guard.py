@@ -0,0 +1,245 @@
+"""
+Guardrails for the SQL the chat model writes against nyc_gtfs.db.
+
+Before a query runs, its EXPLAIN QUERY PLAN is checked for full scans of the large
+tables (a plain SCAN, or the automatic index SQLite builds by reading a whole table).
+Table names and aliases are compared casefolded, as SQLite does, and a SCAN or
+automatic index step whose name is neither a table, an alias, a CTE nor a subquery
+of the query is rejected outright. A full scan the query can stop early from (no sorting, grouping, DISTINCT, aggregates
+or compound selects) is kept, since the injected LIMIT bounds it; any other is
+rejected. Every query gets an outer LIMIT and runs under a time budget enforced with
+sqlite's progress handler. The plan, outcome and runtime of each query are logged.
+"""
+import os
+import re
+import time
+import logging
+import sqlite3
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+MAX_ROWS = int(os.getenv("CHAT_QUERY_MAX_ROWS", "200"))
+TIME_BUDGET_S = float(os.getenv("CHAT_QUERY_TIMEOUT_S", "10"))
+
+# Tables with more rows than this may not be read in full
+LARGE_TABLE_ROWS = 100_000
+
+# Virtual machine instructions between two time budget checks
+PROGRESS_STEPS = 10_000
+
+_PLAN_STEP = re.compile(r'^(SCAN|SEARCH) (?:TABLE )?(\S+)(?: AS (\S+))?(.*)$')
+_FROM_OR_JOIN = re.compile(r'\b(FROM|JOIN)\b', re.IGNORECASE)
+# The FROM list / JOIN operand ends at the next clause, join or parenthesis
+_SOURCE_END = re.compile(r'\b(?:WHERE|GROUP|ORDER|LIMIT|HAVING|WINDOW|UNION|INTERSECT|EXCEPT|ON|USING|JOIN|NATURAL|LEFT|RIGHT|'
+                         r'INNER|CROSS|FULL|OUTER|SELECT|VALUES)\b|[()]', re.IGNORECASE)
+_TABLE_REF = re.compile(r'^\s*["`\[]?(\w+)["`\]]?(?:\s+(?:AS\s+)?["`\[]?(\w+)["`\]]?)?\s*$', re.IGNORECASE)
+# Names of CTEs (name AS (...)) and subqueries ((...) AS name)
+_DERIVED = re.compile(r'\b(\w+)\s*(?:\([^()]*\))?\s+AS\s+(?:NOT\s+)?(?:MATERIALIZED\s+)?\(|\)\s*(?:AS\s+)?(\w+)', re.IGNORECASE)
+_NOT_ALIAS = {'where', 'on', 'join', 'inner', 'left', 'right', 'cross', 'natural', 'outer', 'group', 'order',
+              'limit', 'union', 'intersect', 'except', 'using', 'having', 'window'}
+_BLOCKING = re.compile(r'\b(GROUP\s+BY|ORDER\s+BY|DISTINCT|UNION|INTERSECT|EXCEPT|COUNT|SUM|AVG|MIN|MAX|TOTAL|GROUP_CONCAT)\b',
+                       re.IGNORECASE)
+
+
+class GuardrailError(Exception):
+    pass
+
+class QueryRejected(GuardrailError):
+    pass
+
+class QueryTimeout(GuardrailError):
+    pass
+
+
+def strip_query(query):
+    """The query without surrounding whitespace and trailing semicolons."""
+    return query.strip().rstrip(';').strip()
+
+def is_single_statement(query):
+    """
+    Whether query (without its trailing semicolons) is one complete statement. A
+    semicolon inside a string literal, quoted name or comment does not end a
+    statement, which sqlite3.complete_statement tells apart.
+    """
+    if not sqlite3.complete_statement(query + ';'):
+        return False
+    return not any(sqlite3.complete_statement(query[:match.end()]) for match in re.finditer(';', query))
+
+def table_aliases(query):
+    """
+    Alias (or table name) -> table name, both casefolded, for the tables a query
+    reads: the tables of every FROM list, comma separated or not, and every JOIN.
+    """
+    aliases = {}
+    for match in _FROM_OR_JOIN.finditer(query):
+        end = _SOURCE_END.search(query, match.end())
+        sources = query[match.end():end.start() if end else len(query)]
+        if match.group(1).upper() == 'JOIN':
+            sources = sources.split(',')[0]
+        for source in sources.split(','):
+            ref = _TABLE_REF.match(source)
+            if ref is None:
+                continue
+            table, alias = ref.group(1).casefold(), ref.group(2)
+            aliases[table] = table
+            if alias and alias.casefold() not in _NOT_ALIAS:
+                aliases[alias.casefold()] = table
+    return aliases
+
+def derived_names(query):
+    """Casefolded names of the CTEs and subqueries of a query, which the plan scans as tables."""
+    return {(cte or subquery).casefold() for cte, subquery in _DERIVED.findall(query)}
+
+def full_scans(plan, aliases, large_tables, tables=(), derived=()):
+    """
+    (table, plan step) for the steps of plan that read a whole large table, and
+    (None, plan step) for the SCAN and automatic index steps whose name is none of
+    aliases, tables or derived (all casefolded).
+    """
+    large_tables = {table.casefold() for table in large_tables}
+    tables = {table.casefold() for table in tables}
+    scans = []
+    for detail in plan:
+        match = _PLAN_STEP.match(detail)
+        if match is None or detail.startswith('SCAN CONSTANT ROW'):
+            continue
+        kind, name, alias, rest = match.groups()
+        key = (alias or name).casefold()
+        if key not in aliases and '.' in key:  # schema.table
+            key = key.rsplit('.', 1)[1]
+        full = kind == 'SCAN' or 'AUTOMATIC' in rest
+        if key in aliases:
+            table = aliases[key]
+        elif key in tables:
+            table = key
+        elif key in derived or name.startswith('('):
+            continue
+        else:
+            if full:
+                scans.append((None, detail))
+            continue
+        if table in large_tables and full:
+            scans.append((table, detail))
+    return scans
+
+def with_limit(query, max_rows):
+    """query with at most max_rows rows."""
+    return f"SELECT * FROM ({query}) LIMIT {int(max_rows)}"
+
+
+class QueryGuard:
+
+    def __init__(self, db_path, max_rows=MAX_ROWS, time_budget_s=TIME_BUDGET_S, large_table_rows=LARGE_TABLE_ROWS,
+                 immutable=False):
+        self.db_path = db_path
+        self.immutable = immutable
+        self.max_rows = max_rows
+        self.time_budget_s = time_budget_s
+        self.large_table_rows = large_table_rows
+        self._local = threading.local()
+        self._tables = (None, None, None)  # (db version, tables, large tables)
+
+    def version(self):
+        """Changes whenever the database file is replaced or rewritten (inode, mtime and size)."""
+        stat = os.stat(self.db_path)
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _conn(self):
+        """
+        This thread's connection, opened again when the database file changed since:
+        db_builder swaps in a new file with os.replace, and an open connection (an
+        immutable one above all) would go on reading the old one.
+        """
+        conn = getattr(self._local, 'conn', None)
+        version = self.version()
+        if conn is not None and self._local.version != version:
+            conn.close()
+            conn = None
+        if conn is None:
+            mode = "immutable=1" if self.immutable else "mode=ro"
+            conn = sqlite3.connect(f"file:{self.db_path}?{mode}", uri=True, check_same_thread=False)
+            self._local.conn, self._local.version = conn, version
+        return conn
+
+    def tables(self):
+        """Names of the tables of the database."""
+        self.large_tables()
+        return self._tables[1]
+
+    def large_tables(self):
+        """Tables above large_table_rows rows (max(rowid), so no table is counted in full)."""
+        version = self.version()
+        if self._tables[0] != version:
+            conn = self._conn()
+            names = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+            large = set()
+            for name in names:
+                try:
+                    rows = conn.execute(f'SELECT max(rowid) FROM "{name}"').fetchone()[0]
+                except sqlite3.Error:  # WITHOUT ROWID tables
+                    rows = conn.execute(f'SELECT count(*) FROM "{name}"').fetchone()[0]
+                if (rows or 0) > self.large_table_rows:
+                    large.add(name)
+            self._tables = (version, names, large)
+        return self._tables[2]
+
+    def explain(self, query):
+        """The detail lines of the query plan."""
+        return [row[3] for row in self._conn().execute(f"EXPLAIN QUERY PLAN {query}")]
+
+    def check(self, query):
+        """
+        (query to run, plan) for an LLM query: a single read-only statement whose
+        plan passes the full scan rule, with the LIMIT applied. Raises QueryRejected.
+        """
+        query = strip_query(query)
+        if not re.match(r'^(SELECT|WITH)\b', query, re.IGNORECASE):
+            raise QueryRejected("Only SELECT queries can be run.")
+        if not is_single_statement(query):
+            raise QueryRejected("Only a single SQL statement can be run.")
+
+        try:
+            plan = self.explain(query)
+        except sqlite3.Error as e:
+            raise QueryRejected(f"Invalid SQL: {e}")
+
+        scans = full_scans(plan, table_aliases(query), self.large_tables(), self.tables(), derived_names(query))
+        unresolved = [detail for table, detail in scans if table is None]
+        if unresolved:
+            raise QueryRejected(f"Could not tell which table the query reads in {'; '.join(unresolved)}; "
+                                f"name the tables it reads directly.")
+        if scans and (_BLOCKING.search(query) or any('TEMP B-TREE' in detail or 'AUTOMATIC' in detail for _, detail in scans)):
+            tables = ', '.join(sorted({table for table, _ in scans}))
+            raise QueryRejected(f"The query reads all of {tables}; filter it on indexed columns instead "
+                                f"(plan: {'; '.join(plan)}).")
+
+        return with_limit(query, self.max_rows), plan
+
+    def run(self, query):
+        """Check and run query; returns {query, plan, rows, elapsed_ms}. Raises QueryRejected or QueryTimeout."""
+        start = time.perf_counter()
+        try:
+            guarded, plan = self.check(query)
+        except QueryRejected as e:
+            logger.warning("rejected query=%r reason=%s", query, e)
+            raise
+
+        conn = self._conn()
+        deadline = start + self.time_budget_s
+        conn.set_progress_handler(lambda: int(time.perf_counter() > deadline), PROGRESS_STEPS)
+        try:
+            rows = conn.execute(guarded).fetchall()
+        except sqlite3.OperationalError as e:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            if 'interrupted' in str(e):
+                logger.warning("timeout query=%r plan=%s elapsed_ms=%.0f", guarded, '; '.join(plan), elapsed_ms)
+                raise QueryTimeout(f"The query ran longer than {self.time_budget_s:g} s and was stopped.")
+            raise
+        finally:
+            conn.set_progress_handler(None, 0)
+
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        logger.info("ran query=%r plan=%s rows=%d elapsed_ms=%.1f", guarded, '; '.join(plan), len(rows), elapsed_ms)
+        return {'query': guarded, 'plan': plan, 'rows': rows, 'elapsed_ms': round(elapsed_ms, 1)}
@@ -26,15 +26,30 @@ function TrainModel({ onClose }) {
     const [featureImportances, setFeatureImportances] = useState([]);
     const [isLoading, setIsLoading] = useState(false);
     const [error, setError] = useState(null);
+    const [progress, setProgress] = useState(null);
 
-    // Function to trigger model training
+    // Function to trigger model training: start a job, then poll it until it finishes
     const trainModel = async () => {
         setIsLoading(true);
         setError(null);
+        setProgress(null);
 
         try {
-            const response = await axios.post(`${baseURL}/train_model`);
-            const { mse, mae, feature_importance } = response.data;
+            const started = await axios.post(`${baseURL}/train_model`);
+            const jobId = started.data.job_id;
+
+            let job = started.data;
+            while (!["succeeded", "failed", "cancelled"].includes(job.status)) {
+                await new Promise((resolve) => setTimeout(resolve, 2000));
+                const response = await axios.get(`${baseURL}/train_model/${jobId}`);
+                job = response.data;
+                setProgress(job.progress);
+            }
+
+            if (job.status !== "succeeded") {
+                throw new Error(job.error || `Training job ${job.status}`);
+            }
+            const { mse, mae, feature_importance } = job.result;
 
             // Set the state with the response data
             setMSE(mse);
@@ -74,8 +89,13 @@ function TrainModel({ onClose }) {
 
             {/* Show loading spinner during training */}
             {isLoading && (
-                <Flex justifyContent="center">
+                <Flex justifyContent="center" alignItems="center" gap={3}>
                     <Spinner size="lg" />
+                    {progress && (
+                        <Text>
+                            {progress.stage} ({Math.round(progress.progress * 100)}%)
+                        </Text>
+                    )}
                 </Flex>
             )}
 
@@ -0,0 +1,83 @@
+"""
+Background loading of the server state and a breakdown of where startup time goes.
+
+The Flask app is importable (and answers /healthz) right away; the GTFS feed and
+the indexes built on top of it are loaded by a BackgroundLoader thread, and /readyz
+reports when they are available.
+"""
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+
+class StartupTimer:
+    """Wall clock time of the named startup phases, in the order they ran."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases[name] = time.perf_counter() - start
+
+    def report(self):
+        """Phase durations in milliseconds plus the time since the timer was created."""
+        with self._lock:
+            phases = {name: round(seconds * 1000, 1) for name, seconds in self.phases.items()}
+        return {'phases_ms': phases, 'since_start_ms': round((time.perf_counter() - self.started) * 1000, 1)}
+
+    def format_report(self):
+        report = self.report()
+        width = max((len(name) for name in report['phases_ms']), default=0)
+        lines = [f"  {name:<{width}}  {ms:>10.1f} ms" for name, ms in report['phases_ms'].items()]
+        return '\n'.join(['Startup timings:'] + lines + [f"  {'total':<{width}}  {report['since_start_ms']:>10.1f} ms"])
+
+
+class BackgroundLoader:
+    """
+    Runs load(timer) once in a daemon thread. `ready` is set when it returned; if it
+    raised, `error` holds the traceback and the loader never becomes ready.
+    """
+
+    def __init__(self, load, timer=None):
+        self.load = load
+        self.timer = timer or StartupTimer()
+        self.ready = threading.Event()
+        self.error = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='feed-loader', daemon=True)
+                self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            self.load(self.timer)
+        except Exception:
+            self.error = traceback.format_exc()
+        else:
+            self.ready.set()
+
+    def wait(self, timeout=None):
+        return self.ready.wait(timeout)
+
+    def status(self):
+        if self.ready.is_set():
+            state = 'ready'
+        elif self.error is not None:
+            state = 'failed'
+        else:
+            state = 'loading'
+        return {'status': state, 'error': self.error, 'startup': self.timer.report()}
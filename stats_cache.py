@@ -0,0 +1,111 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+DEFAULT_MAX_BYTES = int(os.getenv("ROUTE_STATS_CACHE_MB", "256")) * 1024 * 1024
+
+
+def frame_nbytes(df):
+    """Deep in-memory size of a DataFrame in bytes."""
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+class StatsCache:
+    """
+    Memoizes the gtfs_kit trip/route stats used by the /api/* analytics endpoints.
+
+    trip_stats is computed once per feed load. route_stats is computed per date and
+    kept in an LRU cache that evicts the least recently used dates once the total
+    size of the cached frames exceeds max_bytes.
+
+    Callers always get a copy, so handlers are free to mutate what they receive.
+    """
+
+    def __init__(self, feed, max_bytes=DEFAULT_MAX_BYTES):
+        self.feed = feed
+        self.max_bytes = max_bytes
+
+        self._trip_stats = None
+        self._route_stats = OrderedDict()  # date -> (route_stats, nbytes)
+        self._nbytes = 0
+
+        self._lock = threading.Lock()
+        self._trip_stats_lock = threading.Lock()
+        self._date_locks = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get_trip_stats(self):
+        if self._trip_stats is None:
+            with self._trip_stats_lock:
+                if self._trip_stats is None:
+                    from feed_snapshot import gtfs_kit_feed
+
+                    # gtfs_kit parses the stop times from their strings
+                    self._trip_stats = gtfs_kit_feed(self.feed).compute_trip_stats()
+        return self._trip_stats
+
+    def trip_stats(self):
+        """Trip stats for the whole feed (computed on first use)."""
+        return self._get_trip_stats().copy()
+
+    def route_stats(self, date):
+        """Route stats for a single YYYYMMDD date, served from the LRU cache when possible."""
+        with self._lock:
+            if date in self._route_stats:
+                self._route_stats.move_to_end(date)
+                self.hits += 1
+                return self._route_stats[date][0].copy()
+            date_lock = self._date_locks.setdefault(date, threading.Lock())
+
+        # Concurrent requests for the same date wait for a single computation
+        with date_lock:
+            with self._lock:
+                if date in self._route_stats:
+                    self._route_stats.move_to_end(date)
+                    self.hits += 1
+                    return self._route_stats[date][0].copy()
+                self.misses += 1
+
+            route_stats = self.feed.compute_route_stats(self._get_trip_stats(), dates=[date])
+            self._store(date, route_stats)
+
+        with self._lock:
+            self._date_locks.pop(date, None)
+
+        return route_stats.copy()
+
+    def _store(self, date, route_stats):
+        nbytes = frame_nbytes(route_stats)
+        with self._lock:
+            if nbytes > self.max_bytes:
+                return
+            self._route_stats[date] = (route_stats, nbytes)
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self._route_stats.popitem(last=False)
+                self._nbytes -= evicted_nbytes
+                self.evictions += 1
+
+    def clear(self):
+        """Drop every cached frame, e.g. after the feed is reloaded."""
+        with self._lock:
+            self._trip_stats = None
+            self._route_stats.clear()
+            self._nbytes = 0
+
+    def stats(self):
+        """Hit/miss counters and current cache occupancy."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'cached_dates': list(self._route_stats.keys()),
+                'cached_bytes': self._nbytes,
+                'max_bytes': self.max_bytes,
+                'trip_stats_cached': self._trip_stats is not None,
+            }
@@ -0,0 +1,71 @@
+"""
+Paginated, projected and streamed JSON for the feed table endpoints.
+
+Rows are serialised chunk by chunk straight from the column arrays, so the size of
+a response never turns into a matching amount of transient Python dicts.
+"""
+import json
+
+
+DEFAULT_CHUNK_ROWS = 1000
+
+
+def parse_fields(fields_arg, columns):
+    """Columns selected by ?fields=a,b,c (all columns when absent)."""
+    if not fields_arg:
+        return list(columns)
+
+    fields = [field.strip() for field in fields_arg.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in columns]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+def parse_page(cursor_arg, limit_arg, total):
+    """
+    Row range selected by ?cursor=&limit=. The cursor is the row offset to resume
+    from; the returned next_cursor is None on the last page.
+    """
+    start = int(cursor_arg) if cursor_arg else 0
+    limit = int(limit_arg) if limit_arg else None
+    if start < 0 or (limit is not None and limit <= 0):
+        raise ValueError("cursor must be >= 0 and limit must be > 0")
+
+    stop = total if limit is None else min(total, start + limit)
+    next_cursor = str(stop) if stop < total else None
+    return start, stop, next_cursor
+
+def iter_records(df, fields, start, stop, fill_na=None, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """Yield lists of JSON-encoded rows of df[start:stop], one chunk at a time."""
+    # jsonify sorts keys, keep the same layout
+    keys = sorted(fields)
+
+    for chunk_start in range(start, stop, chunk_rows):
+        chunk = df.iloc[chunk_start:min(chunk_start + chunk_rows, stop)]
+
+        columns = []
+        for key in keys:
+            column = chunk[key]
+            if fill_na is not None:
+                if column.dtype == 'category':
+                    column = column.astype(object)
+                column = column.fillna(fill_na)
+            columns.append(column.tolist())
+
+        yield [json.dumps(dict(zip(keys, values))) for values in zip(*columns)]
+
+def json_array_stream(chunks):
+    """Chunked JSON array body."""
+    yield '['
+    first = True
+    for rows in chunks:
+        if rows:
+            yield ('' if first else ',') + ','.join(rows)
+            first = False
+    yield ']'
+
+def ndjson_stream(chunks):
+    """Newline delimited JSON body, one row per line."""
+    for rows in chunks:
+        if rows:
+            yield '\n'.join(rows) + '\n'